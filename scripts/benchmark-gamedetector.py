@@ -0,0 +1,56 @@
+import argparse
+import os
+import re
+import sys
+import timeit
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from gamedetector import GameDetector  # noqa: E402
+
+parser = argparse.ArgumentParser(description='Compare game detection performance against the previous implementation')
+parser.add_argument('--number', help='Number of detections per window title', type=int, default=20000)
+parser.add_argument('--games', help='Number of configured games (defaults to all known games)', type=int)
+args = parser.parse_args()
+
+
+class LegacyGameDetector:
+    """
+    Previous implementation: test every known game's membership in a list of configured games,
+    then run a separate regex match per game
+    """
+    def __init__(self, known_games: dict, configured_games: list) -> None:
+        self.known_games = known_games
+        self.configured_games = configured_games
+        self.game_regexes = {key: re.compile(pattern, flags=re.IGNORECASE) for key, pattern in known_games.items()}
+
+    def match_game(self, window_title: str) -> Optional[str]:
+        return next(
+            (key for key in self.known_games.keys() if key in self.configured_games and
+             self.game_regexes[key].match(window_title)),
+            None
+        )
+
+
+detector = GameDetector()
+known_games = detector._GameDetector__KNOWN_GAMES
+configured_games = detector.get_known_games()[:args.games]
+detector.set_configured_games(configured_games)
+legacy = LegacyGameDetector(known_games, configured_games)
+
+titles = {
+    'no game (desktop)': 'Program Manager',
+    'literal title, listed early': 'Apex Legends',
+    'literal title, listed late': 'World of Warcraft',
+    'regex title': 'BF2 (v1.5.3153-802.0, pid: 1234)',
+    'unconfigured game': 'Some Other Game',
+}
+
+print(f'{len(configured_games)} configured games, {args.number} detections per title')
+print(f'{"window title":<30} {"legacy (µs)":>12} {"compiled (µs)":>14} {"speedup":>8}')
+for label, title in titles.items():
+    assert legacy.match_game(title) == detector.match_game(title), f'Results differ for "{title}"'
+    legacy_time = timeit.timeit(lambda: legacy.match_game(title), number=args.number) / args.number * 1e6
+    compiled_time = timeit.timeit(lambda: detector.match_game(title), number=args.number) / args.number * 1e6
+    print(f'{label:<30} {legacy_time:>12.2f} {compiled_time:>14.2f} {legacy_time / compiled_time:>7.1f}x')
@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Dict, Optional
+
+import aiohttp
+import yaml
+
+from standins import RelayStandIn, HelixStandIn, create_redemption
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(
+    description='Run the client against local stand-ins for the 0xQWERTY and Twitch APIs and measure '
+                'redemption latency and throughput'
+)
+parser.add_argument('--bursts', help='Number of redemption bursts', type=int, default=5)
+parser.add_argument('--burst-size', help='Number of redemptions per burst', type=int, default=50)
+parser.add_argument('--burst-interval', help='Seconds between bursts', type=float, default=1.0)
+parser.add_argument('--rewards', help='Number of configured rewards', type=int, default=10)
+parser.add_argument('--status-delay', help='Seconds the Twitch stand-in takes to answer status updates',
+                    type=float, default=0.05)
+parser.add_argument('--timeout', help='Seconds to wait for all redemptions to be handled', type=float, default=60.0)
+parser.add_argument('--client-port', help='Port for the client to listen on', type=int, default=8765)
+parser.add_argument('--log-level', help='Client log level (e.g. debug to measure the cost of logging)', type=str,
+                    default='warning')
+parser.add_argument('--transport', help='How the client receives redemptions', choices=['relay', 'eventsub'],
+                    default='relay')
+parser.add_argument('--output', help='File to write results to as JSON (written to stdout if not given)', type=str)
+args = parser.parse_args()
+
+GAME = 'Rocket League'
+WINDOW_TITLE = 'Rocket League (64-bit, DX11, Cooked)'
+BROADCASTER = {'id': '123456', 'login': 'benchmark', 'display_name': 'benchmark'}
+TOKEN = 'benchmark-token'
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if len(values) == 0:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None, 'mean': None}
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        return ordered[min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+    return {
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'max': ordered[-1],
+        'mean': statistics.fmean(ordered)
+    }
+
+
+def write_client_files(directory: str, reward_ids: List[str]) -> None:
+    client_config = {
+        'logLevel': args.log_level,
+        'autoFulfill': True,
+        'refund': False,
+        'rewards': [
+            {
+                'id': reward_id,
+                'title': f'Benchmark reward {i}',
+                'cost': 100,
+                'actions': {GAME: {'type': 'keypress', 'value': 'space'}}
+            } for (i, reward_id) in enumerate(reward_ids)
+        ]
+    }
+    with open(os.path.join(directory, 'config.yaml'), 'w') as f:
+        yaml.dump(client_config, f, sort_keys=False)
+    with open(os.path.join(directory, 'token-cache.json'), 'w') as f:
+        json.dump({'accessToken': TOKEN, 'expiresAt': None, 'broadcaster': BROADCASTER}, f)
+
+
+async def sample_event_loop_lag(session: aiohttp.ClientSession, url: str, samples: List[float]) -> None:
+    while True:
+        try:
+            async with session.get(url) as resp:
+                match = re.search(r'^qwerty_event_loop_lag_seconds (\S+)$', await resp.text(), re.MULTILINE)
+                if match is not None:
+                    samples.append(float(match.group(1)))
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+
+
+async def main() -> dict:
+    relay = RelayStandIn()
+    helix = HelixStandIn(BROADCASTER, TOKEN, status_delay=args.status_delay)
+    await relay.start()
+    await helix.start()
+
+    reward_ids = [f'reward-{i}' for i in range(args.rewards)]
+    for i, reward_id in enumerate(reward_ids):
+        helix.add_reward(reward_id, f'Benchmark reward {i}', 100)
+
+    workdir = tempfile.mkdtemp(prefix='0xqwerty-benchmark-')
+    write_client_files(workdir, reward_ids)
+    record_path = os.path.join(workdir, 'keypresses.jsonl')
+
+    env = {
+        **os.environ,
+        'QWERTY_API_BASE_URL': relay.base_url,
+        'QWERTY_TWITCH_HELIX_BASE_URL': f'{helix.base_url}/helix',
+        'QWERTY_TWITCH_VALIDATE_URL': f'{helix.base_url}/oauth2/validate',
+        'QWERTY_TWITCH_EVENTSUB_URL': helix.eventsub_url,
+        'QWERTY_LISTEN_PORT': str(args.client_port)
+    }
+    client = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, 'src', 'main.py'), '--input-backend', 'recording',
+         '--input-record-path', record_path, '--window-title', WINDOW_TITLE, '--transport', args.transport],
+        cwd=workdir, env=env
+    )
+
+    try:
+        started_at = time.time()
+        if args.transport == 'relay':
+            await relay.wait_for_join(f'streamer:{BROADCASTER["login"]}', timeout=30.0)
+            # Joining happens before reward setup, wait for the eventsub registration marking the end of setup
+            while len(relay.subscribed_reward_ids) == 0:
+                await asyncio.sleep(0.05)
+        else:
+            # Subscriptions are created once connected, which happens at the end of setup
+            while len(helix.eventsub_subscriptions) < len(reward_ids):
+                if time.time() - started_at > 30.0:
+                    raise TimeoutError('Client did not subscribe to redemptions via EventSub')
+                await asyncio.sleep(0.05)
+        ready_after = time.time() - started_at
+
+        lag_samples: List[float] = []
+        async with aiohttp.ClientSession() as session:
+            lag_sampler = asyncio.create_task(
+                sample_event_loop_lag(session, f'http://127.0.0.1:{args.client_port}/metrics', lag_samples)
+            )
+
+            sent_at: Dict[str, float] = {}
+            first_sent_at = time.time()
+            for burst in range(args.bursts):
+                for i in range(args.burst_size):
+                    redemption = create_redemption(BROADCASTER, reward_ids[i % len(reward_ids)])
+                    sent_at[redemption['id']] = time.time()
+                    if args.transport == 'relay':
+                        await relay.emit_redemption(BROADCASTER['login'], redemption)
+                    else:
+                        await helix.send_notification(redemption)
+                if burst < args.bursts - 1:
+                    await asyncio.sleep(args.burst_interval)
+
+            completed = await helix.wait_for_status_updates(set(sent_at.keys()), args.timeout)
+            lag_sampler.cancel()
+    finally:
+        client.terminate()
+        client.wait()
+        await relay.stop()
+        await helix.stop()
+
+    latencies = [helix.status_updates[i] - t for (i, t) in sent_at.items() if i in helix.status_updates]
+    last_update_at = max(helix.status_updates.values(), default=first_sent_at)
+
+    keypresses = []
+    if os.path.isfile(record_path):
+        with open(record_path, 'r') as f:
+            keypresses = [e['time'] for e in map(json.loads, filter(str.strip, f)) if e['down']]
+
+    return {
+        'transport': args.transport,
+        'parameters': vars(args),
+        'readyAfter': ready_after,
+        'completed': completed,
+        'sent': len(sent_at),
+        'settled': len(latencies),
+        'keypresses': len(keypresses),
+        'statusRequests': helix.status_requests,
+        'throughput': len(latencies) / (last_update_at - first_sent_at) if last_update_at > first_sent_at else None,
+        'latency': percentiles(latencies),
+        'eventLoopLag': percentiles(lag_samples)
+    }
+
+
+results = asyncio.run(main())
+if args.output is not None:
+    with open(args.output, 'w') as o:
+        json.dump(results, o, indent=2)
+else:
+    print(json.dumps(results, indent=2))
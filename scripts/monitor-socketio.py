@@ -1,13 +1,20 @@
 import argparse
 import asyncio
+import gzip
+import json
+import time
 
 import socketio
 
 parser = argparse.ArgumentParser(description='Monitor rooms on a socket.io server')
 parser.add_argument('--rooms', help='Names of rooms to monitor', nargs='+', type=str, required=True)
 parser.add_argument('--server', help='Server to connect to', type=str, default='https://0xqwerty-api.cetteup.com')
+parser.add_argument('--capture', help='Append received redemptions to this gzip compressed JSON lines file '
+                                      '(can be replayed using replay-redemptions.py)', type=str)
 args = parser.parse_args()
 
+capture = gzip.open(args.capture, 'at', encoding='utf-8') if args.capture is not None else None
+
 sio = socketio.AsyncClient()
 
 
@@ -18,7 +25,12 @@ def message(data):
 
 @sio.on('redemption')
 async def on_message(data):
+    received_at = time.time()
     print('Channel points redeemed: ', data)
+    if capture is not None:
+        capture.write(json.dumps({'time': received_at, 'data': data}) + '\n')
+        # Flush every redemption so a capture is usable even if the monitor is killed
+        capture.flush()
 
 
 @sio.event
@@ -43,4 +55,8 @@ async def main():
     await sio.wait()
 
 
-asyncio.run(main())
+try:
+    asyncio.run(main())
+finally:
+    if capture is not None:
+        capture.close()
@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import time
+import uuid
+from typing import List, Tuple, Optional
+
+from standins import RelayStandIn
+
+parser = argparse.ArgumentParser(
+    description='Replay redemptions captured by monitor-socketio.py from a local socket.io server '
+                '(point the client at it by setting QWERTY_API_BASE_URL)'
+)
+parser.add_argument('capture', help='Capture file (gzip compressed JSON lines) to replay', type=str)
+parser.add_argument('--speed', help='Replay speed multiplier, 0 replays as fast as possible', type=float, default=1.0)
+parser.add_argument('--host', help='Host to listen on', type=str, default='127.0.0.1')
+parser.add_argument('--port', help='Port to listen on', type=int, default=8080)
+parser.add_argument('--broadcaster-login', help='Replay all redemptions to this broadcaster instead of the recorded '
+                                                'ones (required if the capture does not record them)', type=str)
+parser.add_argument('--new-ids', help='Give every replayed redemption a new id (allows replaying a capture '
+                                      'repeatedly against the same client)', dest='new_ids', action='store_true')
+parser.add_argument('--loops', help='Number of times to replay the capture', type=int, default=1)
+args = parser.parse_args()
+
+
+def load_capture(path: str) -> List[Tuple[float, dict]]:
+    redemptions = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                redemptions.append(json.loads(line))
+        except (EOFError, json.JSONDecodeError):
+            # Capture was not closed properly (e.g. monitor got killed), use everything up to the last complete line
+            pass
+    return sorted(((r['time'], r['data']) for r in redemptions), key=lambda r: r[0])
+
+
+def get_broadcaster_login(data: dict) -> Optional[str]:
+    # Redemptions relayed by the 0xQWERTY API and received from Twitch EventSub name the broadcaster differently
+    return args.broadcaster_login or data.get('broadcaster_login') or data.get('broadcaster_user_login')
+
+
+async def replay(relay: RelayStandIn, redemptions: List[Tuple[float, dict]]) -> None:
+    recorded_start = redemptions[0][0]
+    started_at = time.perf_counter()
+    for recorded_at, data in redemptions:
+        if args.speed > 0:
+            delay = (recorded_at - recorded_start) / args.speed - (time.perf_counter() - started_at)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if args.new_ids:
+            data = {**data, 'id': str(uuid.uuid4())}
+        await relay.emit_redemption(data['broadcaster_login'], data)
+
+
+async def main() -> None:
+    redemptions = load_capture(args.capture)
+    if len(redemptions) == 0:
+        print('Capture does not contain any redemptions')
+        return
+    missing = sum(1 for (_, d) in redemptions if get_broadcaster_login(d) is None)
+    if missing > 0:
+        print(f'{missing} redemptions do not record their broadcaster, pass --broadcaster-login to replay them')
+        sys.exit(1)
+    redemptions = [(t, {**d, 'broadcaster_login': get_broadcaster_login(d)}) for (t, d) in redemptions]
+
+    duration = redemptions[-1][0] - redemptions[0][0]
+    logins = {d['broadcaster_login'] for (_, d) in redemptions}
+    print(f'Loaded {len(redemptions)} redemptions for {", ".join(sorted(logins))} spanning {duration:.1f} seconds')
+
+    relay = RelayStandIn(args.host, args.port)
+    await relay.start()
+    try:
+        print(f'Waiting for client(s) to join on {relay.base_url}')
+        await asyncio.gather(*[relay.wait_for_join(f'streamer:{login}', timeout=None) for login in logins])
+
+        for loop in range(args.loops):
+            started_at = time.perf_counter()
+            await replay(relay, redemptions)
+            elapsed = time.perf_counter() - started_at
+            print(f'Replayed {len(redemptions)} redemptions in {elapsed:.2f} seconds '
+                  f'({len(redemptions) / elapsed if elapsed > 0 else float("inf"):.1f}/s, loop {loop + 1}/{args.loops})')
+    finally:
+        await relay.stop()
+
+
+asyncio.run(main())
@@ -0,0 +1,383 @@
+"""
+Local stand-ins for the 0xQWERTY API (socket.io relay) and the Twitch API (including EventSub WebSockets),
+used by the benchmark and replay scripts
+"""
+import asyncio
+import json
+import time
+import uuid
+from typing import Dict, List, Optional, Set
+
+import socketio
+from aiohttp import web
+
+
+class RelayStandIn:
+    """
+    Stand-in for the 0xQWERTY API: relays redemptions to clients in streamer rooms via socket.io
+    """
+    host: str
+    port: int
+    sio: socketio.AsyncServer
+    app: web.Application
+    joined: Dict[str, asyncio.Event]
+    subscribed_reward_ids: List[str]
+
+    __runner: Optional[web.AppRunner] = None
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.sio = socketio.AsyncServer(async_mode='aiohttp')
+        self.app = web.Application()
+        self.sio.attach(self.app)
+        self.app.router.add_post('/client/eventsub-setup', self.eventsub_setup)
+        self.joined = {}
+        self.subscribed_reward_ids = []
+        self.sio.on('join', self.on_join)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self) -> None:
+        self.__runner = web.AppRunner(self.app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.host, self.port)
+        await site.start()
+        # Pick up actual port if a random one was requested
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    async def on_join(self, sid: str, room: str) -> None:
+        await self.sio.enter_room(sid, room)
+        self.joined.setdefault(room, asyncio.Event()).set()
+
+    async def wait_for_join(self, room: str, timeout: float) -> None:
+        await asyncio.wait_for(self.joined.setdefault(room, asyncio.Event()).wait(), timeout)
+
+    async def eventsub_setup(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.subscribed_reward_ids = body.get('reward_ids', [])
+        return web.json_response({})
+
+    async def emit_redemption(self, login: str, redemption: dict) -> None:
+        await self.sio.emit('redemption', redemption, room=f'streamer:{login}')
+
+    async def disconnect_clients(self) -> None:
+        """
+        Drop all client connections (as happens when the 0xQWERTY API restarts)
+        """
+        self.joined = {}
+        for sid in [sid for (sid, _) in self.sio.manager.get_participants('/', None)]:
+            await self.sio.disconnect(sid)
+
+
+class HelixStandIn:
+    """
+    Stand-in for the parts of the Twitch API used by the client, recording when redemption status updates arrive
+    """
+    host: str
+    port: int
+    app: web.Application
+    broadcaster: dict
+    token: str
+    rewards: Dict[str, dict]
+    status_updates: Dict[str, float]
+    status_requests: int
+    status_delay: float
+    # Redemption id -> redemption, in the format returned by Twitch (status updates remove them)
+    unfulfilled: Dict[str, dict]
+    # EventSub session id -> connection, subscription id -> subscription
+    eventsub_sessions: Dict[str, web.WebSocketResponse]
+    eventsub_subscriptions: Dict[str, dict]
+
+    __runner: Optional[web.AppRunner] = None
+    __updated: Optional[asyncio.Event] = None
+    __expected: Set[str]
+
+    def __init__(self, broadcaster: dict, token: str, host: str = '127.0.0.1', port: int = 0,
+                 status_delay: float = 0.0) -> None:
+        """
+        @param broadcaster: Broadcaster record returned for the token
+        @param token: The only access token considered valid
+        @param status_delay: Seconds to delay status update responses by (simulating Twitch's latency)
+        """
+        self.host = host
+        self.port = port
+        self.broadcaster = broadcaster
+        self.token = token
+        self.status_delay = status_delay
+        self.rewards = {}
+        self.status_updates = {}
+        self.status_requests = 0
+        self.unfulfilled = {}
+        self.eventsub_sessions = {}
+        self.eventsub_subscriptions = {}
+        self.__expected = set()
+        self.app = web.Application()
+        self.app.router.add_get('/oauth2/validate', self.validate)
+        self.app.router.add_get('/helix/users', self.users)
+        self.app.router.add_get('/helix/channel_points/custom_rewards', self.get_rewards)
+        self.app.router.add_post('/helix/channel_points/custom_rewards', self.create_reward)
+        self.app.router.add_patch('/helix/channel_points/custom_rewards', self.update_reward)
+        self.app.router.add_get('/helix/channel_points/custom_rewards/redemptions', self.get_redemptions)
+        self.app.router.add_patch('/helix/channel_points/custom_rewards/redemptions', self.update_redemptions)
+        self.app.router.add_post('/helix/eventsub/subscriptions', self.create_subscription)
+        self.app.router.add_delete('/helix/eventsub/subscriptions', self.delete_subscription)
+        self.app.router.add_get('/eventsub', self.eventsub)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def eventsub_url(self) -> str:
+        return f'ws://{self.host}:{self.port}/eventsub'
+
+    async def start(self) -> None:
+        self.__runner = web.AppRunner(self.app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    def add_reward(self, reward_id: str, title: str, cost: int) -> None:
+        self.rewards[reward_id] = {'id': reward_id, 'title': title, 'cost': cost}
+
+    def is_authorized(self, request: web.Request, scheme: str = 'Bearer') -> bool:
+        return request.headers.get('Authorization') == f'{scheme} {self.token}'
+
+    async def validate(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request, 'OAuth'):
+            return web.json_response({'status': 401, 'message': 'invalid access token'}, status=401)
+        return web.json_response({
+            'client_id': 'stand-in',
+            'login': self.broadcaster['login'],
+            'user_id': self.broadcaster['id'],
+            'scopes': ['channel:read:redemptions', 'channel:manage:redemptions'],
+            'expires_in': 3600
+        })
+
+    async def users(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            return web.Response(status=401)
+        return web.json_response({'data': [self.broadcaster]})
+
+    async def get_rewards(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            return web.Response(status=401)
+        return web.json_response({'data': list(self.rewards.values())})
+
+    async def create_reward(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            return web.Response(status=401)
+        body = await request.json()
+        reward_id = str(uuid.uuid4())
+        self.add_reward(reward_id, body['title'], body['cost'])
+        return web.json_response({'data': [self.rewards[reward_id]]})
+
+    async def update_reward(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            return web.Response(status=401)
+        reward = self.rewards.get(request.query.get('id'))
+        if reward is None:
+            return web.Response(status=404)
+        reward.update({k: v for (k, v) in (await request.json()).items() if k in ['title', 'cost']})
+        return web.json_response({'data': [reward]})
+
+    def add_unfulfilled(self, redemption: dict) -> None:
+        """
+        Record a redemption (as created by create_redemption) as waiting for its status to be set,
+        e.g. to simulate it having been made while the client was disconnected
+        """
+        self.unfulfilled[redemption['id']] = {
+            'id': redemption['id'],
+            'broadcaster_id': redemption['broadcaster_id'],
+            'broadcaster_login': redemption['broadcaster_login'],
+            'user_login': redemption['user_login'],
+            'user_input': '',
+            'status': 'UNFULFILLED',
+            'reward': {'id': redemption['reward_id'], 'title': '', 'cost': 0, 'prompt': ''},
+            'redeemed_at': redemption['redeemed_at']
+        }
+
+    async def get_redemptions(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            return web.Response(status=401)
+        if request.query.get('status') != 'UNFULFILLED':
+            return web.json_response({'data': [], 'pagination': {}})
+        redemptions = sorted(
+            [r for r in self.unfulfilled.values() if r['reward']['id'] == request.query.get('reward_id')],
+            key=lambda r: r['redeemed_at'],
+            reverse=request.query.get('sort') == 'NEWEST'
+        )
+        # Cursors are plain offsets here
+        offset = int(request.query.get('after', 0))
+        first = int(request.query.get('first', 20))
+        page = redemptions[offset:offset + first]
+        cursor = str(offset + first) if offset + first < len(redemptions) else None
+        return web.json_response({'data': page, 'pagination': {'cursor': cursor} if cursor is not None else {}})
+
+    async def update_redemptions(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            return web.Response(status=401)
+        received_at = time.time()
+        self.status_requests += 1
+        status = (await request.json())['status']
+        redemption_ids = request.query.getall('id')
+        for redemption_id in redemption_ids:
+            self.status_updates.setdefault(redemption_id, received_at)
+            self.unfulfilled.pop(redemption_id, None)
+        if self.__updated is not None and self.__expected.issubset(self.status_updates.keys()):
+            self.__updated.set()
+        if self.status_delay > 0:
+            await asyncio.sleep(self.status_delay)
+        return web.json_response({'data': [
+            {'id': redemption_id, 'status': status, 'reward': {'id': request.query.get('reward_id')}}
+            for redemption_id in redemption_ids
+        ]})
+
+    async def create_subscription(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            return web.Response(status=401)
+        body = await request.json()
+        session_id = body.get('transport', {}).get('session_id')
+        if session_id not in self.eventsub_sessions:
+            return web.Response(status=400)
+        subscription = {
+            'id': str(uuid.uuid4()),
+            'status': 'enabled',
+            'type': body['type'],
+            'version': body['version'],
+            'condition': body['condition'],
+            'transport': {'method': 'websocket', 'session_id': session_id}
+        }
+        self.eventsub_subscriptions[subscription['id']] = subscription
+        return web.json_response({'data': [subscription]}, status=202)
+
+    async def delete_subscription(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            return web.Response(status=401)
+        if self.eventsub_subscriptions.pop(request.query.get('id'), None) is None:
+            return web.Response(status=404)
+        return web.Response(status=204)
+
+    async def eventsub(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        keepalive = int(request.query.get('keepalive_timeout_seconds', 10))
+        # Connections to a reconnect URL take over the previous connection's session (and thereby subscriptions)
+        session_id = request.query.get('session_id') or str(uuid.uuid4())
+        previous = self.eventsub_sessions.get(session_id)
+        self.eventsub_sessions[session_id] = ws
+        await ws.send_str(self.__create_eventsub_message('session_welcome', {'session': {
+            'id': session_id,
+            'status': 'connected',
+            'keepalive_timeout_seconds': keepalive,
+            'reconnect_url': None
+        }}))
+        if previous is not None:
+            await previous.close()
+
+        try:
+            while not ws.closed:
+                try:
+                    msg = await ws.receive(timeout=keepalive)
+                    if msg.type in [web.WSMsgType.CLOSE, web.WSMsgType.CLOSING, web.WSMsgType.CLOSED]:
+                        break
+                except asyncio.TimeoutError:
+                    await ws.send_str(self.__create_eventsub_message('session_keepalive', {}))
+        finally:
+            # Subscriptions of a session are gone once it is closed (unless taken over by a reconnect)
+            if self.eventsub_sessions.get(session_id) is ws:
+                del self.eventsub_sessions[session_id]
+                self.eventsub_subscriptions = {
+                    i: s for (i, s) in self.eventsub_subscriptions.items()
+                    if s['transport']['session_id'] != session_id
+                }
+        return ws
+
+    async def send_notification(self, redemption: dict) -> None:
+        """
+        Send a redemption (as created by create_redemption) to EventSub sessions subscribed to its reward
+        """
+        event = {
+            'id': redemption['id'],
+            'broadcaster_user_id': redemption['broadcaster_id'],
+            'broadcaster_user_login': redemption['broadcaster_login'],
+            'user_login': redemption['user_login'],
+            'user_input': '',
+            'status': 'unfulfilled',
+            'reward': {'id': redemption['reward_id'], 'title': '', 'cost': 0, 'prompt': ''},
+            'redeemed_at': redemption['redeemed_at']
+        }
+        for subscription in list(self.eventsub_subscriptions.values()):
+            condition = subscription['condition']
+            if condition.get('broadcaster_user_id') != event['broadcaster_user_id'] or \
+                    condition.get('reward_id', event['reward']['id']) != event['reward']['id']:
+                continue
+            ws = self.eventsub_sessions.get(subscription['transport']['session_id'])
+            if ws is not None:
+                await ws.send_str(self.__create_eventsub_message(
+                    'notification',
+                    {'subscription': subscription, 'event': event},
+                    subscription['type']
+                ))
+
+    async def send_reconnect(self) -> None:
+        """
+        Ask all EventSub sessions to reconnect (as Twitch does before maintenance)
+        """
+        for session_id, ws in list(self.eventsub_sessions.items()):
+            await ws.send_str(self.__create_eventsub_message('session_reconnect', {'session': {
+                'id': session_id,
+                'status': 'reconnecting',
+                'keepalive_timeout_seconds': None,
+                'reconnect_url': f'{self.eventsub_url}?session_id={session_id}'
+            }}))
+
+    @staticmethod
+    def __create_eventsub_message(message_type: str, payload: dict, subscription_type: Optional[str] = None) -> str:
+        metadata = {
+            'message_id': str(uuid.uuid4()),
+            'message_type': message_type,
+            'message_timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+        if subscription_type is not None:
+            metadata['subscription_type'] = subscription_type
+            metadata['subscription_version'] = '1'
+        return json.dumps({'metadata': metadata, 'payload': payload})
+
+    async def wait_for_status_updates(self, redemption_ids: Set[str], timeout: float) -> bool:
+        """
+        Wait until status updates for all given redemptions arrived
+        @return: Whether all updates arrived before the timeout
+        """
+        self.__expected = redemption_ids
+        self.__updated = asyncio.Event()
+        if redemption_ids.issubset(self.status_updates.keys()):
+            return True
+        try:
+            await asyncio.wait_for(self.__updated.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def create_redemption(broadcaster: dict, reward_id: str) -> dict:
+    return {
+        'id': str(uuid.uuid4()),
+        'broadcaster_id': broadcaster['id'],
+        'broadcaster_login': broadcaster['login'],
+        'reward_id': reward_id,
+        'user_login': 'viewer',
+        'redeemed_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }
@@ -0,0 +1,88 @@
+from typing import Optional, List
+
+from classes import ChannelConfig
+from eventsub import EventSubClient, EventSubError
+from helix import HelixClient
+from ratelimit import KeypressRateLimiter
+from rewardmanager import RewardManager, RewardManagerError
+from statuswriter import RedemptionStatusWriter
+from tokencache import get_token_cache_path
+
+
+class Channel:
+    """
+    Broadcaster the client handles redemptions for, along with everything needed to act on their behalf on Twitch.
+    Anything not specific to a broadcaster (socket.io connection, HTTP connection pool, input, queue) is shared.
+    """
+    config: ChannelConfig
+    helix: HelixClient
+    rm: RewardManager
+    status_writer: RedemptionStatusWriter
+    rate_limiter: KeypressRateLimiter
+    token_cache_path: str
+    broadcaster: dict
+    # Set if receiving redemptions directly from Twitch, rather than via the 0xQWERTY API
+    eventsub: Optional[EventSubClient] = None
+    # State parameter of the pending browser authentication for this channel
+    auth_state: Optional[str] = None
+    ready: bool = False
+
+    def __init__(self, config: ChannelConfig, helix: HelixClient) -> None:
+        """
+        @param config: Config of the channel
+        @param helix: Twitch API client to use for this channel only (see HelixClient.create_child)
+        """
+        self.config = config
+        self.helix = helix
+        self.rm = RewardManager()
+        self.rm.set_client(helix)
+        self.status_writer = RedemptionStatusWriter(self.rm)
+        self.token_cache_path = get_token_cache_path(config.login)
+        self.broadcaster = {}
+        self.update_rate_limiter()
+
+    @property
+    def name(self) -> str:
+        return self.broadcaster.get('login') or self.config.login or 'broadcaster'
+
+    def set_broadcaster(self, broadcaster: dict) -> None:
+        self.broadcaster = broadcaster
+        self.rm.set_broadcaster_id(broadcaster['id'])
+
+    def get_broadcaster_id(self) -> Optional[str]:
+        return self.broadcaster.get('id')
+
+    def is_expected_broadcaster(self, login: Optional[str]) -> bool:
+        """
+        Check whether a Twitch user is the broadcaster configured for this channel
+        (any user is, unless running in multi-broadcaster mode)
+        """
+        return self.config.login is None or (login is not None and login.lower() == self.config.login)
+
+    def update_config(self, config: ChannelConfig) -> None:
+        self.config = config
+        self.update_rate_limiter()
+
+    def update_rate_limiter(self) -> None:
+        """
+        Recreate the rate limiter from the config (needs to be called whenever reward ids change)
+        """
+        self.rate_limiter = KeypressRateLimiter(self.config.get_rate_limits(), self.config.keypress_rate_limit)
+
+    async def subscribe_to_redemptions(self, reward_ids: Optional[List[str]] = None) -> None:
+        """
+        Subscribe to redemptions of the given rewards via EventSub if set up, else via the 0xQWERTY API
+        @param reward_ids: Ids of all manageable rewards (will be fetched from Twitch if not given)
+        @raise RewardManagerError: If subscriptions could not be set up
+        """
+        if self.eventsub is None:
+            return await self.rm.subscribe_to_redemptions(reward_ids)
+
+        if reward_ids is None:
+            reward_ids = [r.id for r in await self.rm.get_rewards()]
+        try:
+            await self.eventsub.subscribe(self.get_broadcaster_id(), reward_ids)
+        except EventSubError as e:
+            raise RewardManagerError(str(e)) from e
+        # Connect only once there is something to subscribe to, Twitch closes connections without subscriptions
+        self.eventsub.start()
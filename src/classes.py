@@ -1,43 +1,149 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Union, Tuple, Any
 
-import yaml
 from pydantic import BaseModel
 
+from keys import Key, resolve_key
+
 
 class RewardActionType(str, Enum):
     KEYPRESS = 'keypress'
+    # Keep a key pressed for a duration
+    HOLD = 'hold'
+    # Press keys one after another
+    SEQUENCE = 'sequence'
+    # Press keys together (e.g. ctrl+c)
+    CHORD = 'chord'
 
 
-@dataclass
+class RateLimitPolicy(str, Enum):
+    COALESCE = 'coalesce'
+    QUEUE = 'queue'
+    REFUND = 'refund'
+
+
+class RedemptionOutcome(str, Enum):
+    FULFILLED = 'fulfilled'
+    REFUNDED = 'refunded'
+    # No action was taken since the relevant game was not active
+    SKIPPED = 'skipped'
+    # No action was taken since the redemption was only received (after reconnecting) long after it was made
+    EXPIRED = 'expired'
+    FAILED = 'failed'
+
+
+class OverflowPolicy(str, Enum):
+    REFUND = 'refund'
+    DROP = 'drop'
+
+
+def normalize_key_name(name: Any) -> str:
+    """
+    Lowercase a key name, stripping surrounding whitespace unless the name is whitespace only (e.g. " " for space)
+    """
+    if name is None:
+        return ''
+    name = str(name).lower()
+    return name.strip() or name
+
+
+@dataclass(slots=True)
 class RewardAction:
     type: RewardActionType
-    value: str
+    value: Union[str, List[str]]
+    # Milliseconds to hold keys down for (hold and chord actions)
+    duration: Optional[int] = None
+    # Milliseconds between keys (sequence actions)
+    interval: Optional[int] = None
+    keys: Tuple[Key, ...] = field(default=(), repr=False, compare=False)
 
     @staticmethod
     def from_dict(as_dict: dict) -> 'RewardAction':
         return RewardAction(
             type=RewardActionType(as_dict.get('type')),
-            value=as_dict.get('value')
+            value=as_dict.get('value'),
+            duration=as_dict.get('duration'),
+            interval=as_dict.get('interval')
+        )
+
+    def normalize(self) -> 'RewardAction':
+        """
+        Get a copy of the action with its value normalized for execution (key names are lowercase)
+        and its keys resolved to scan codes
+        @raise ValueError: If the action's value is not usable
+        """
+        multi_key = self.type in [RewardActionType.SEQUENCE, RewardActionType.CHORD]
+        if multi_key and isinstance(self.value, list):
+            value = [normalize_key_name(v) for v in self.value]
+        elif not multi_key and not isinstance(self.value, list):
+            value = normalize_key_name(self.value)
+        else:
+            raise ValueError(f'Invalid {self.type.value} action value: "{self.value}" '
+                             f'(expected {"a list of keys" if multi_key else "a single key"})')
+
+        names = value if multi_key else [value]
+        if len(names) == 0 or '' in names:
+            raise ValueError(f'Invalid {self.type.value} action value: "{self.value}"')
+        if self.type is RewardActionType.HOLD and (self.duration is None or self.duration <= 0):
+            raise ValueError(f'Invalid {self.type.value} action duration: "{self.duration}"')
+
+        return RewardAction(
+            type=self.type,
+            value=value,
+            duration=self.duration,
+            interval=self.interval,
+            keys=tuple(resolve_key(name) for name in names)
         )
 
     # Should be called "__dict__" but that confused the PyCharm debugger and
     # makes it impossible to inspect any instance variables
     # https://youtrack.jetbrains.com/issue/PY-43955
     def to_dict(self) -> dict:
-        return {
+        as_dict = {
             'type': self.type.value,
             'value': self.value
         }
+        if self.duration is not None:
+            as_dict['duration'] = self.duration
+        if self.interval is not None:
+            as_dict['interval'] = self.interval
 
+        return as_dict
 
-@dataclass
+
+@dataclass(slots=True)
+class RateLimitConfig:
+    rate: float
+    burst: int
+    policy: RateLimitPolicy
+    max_wait: int
+
+    @staticmethod
+    def from_dict(as_dict: dict) -> 'RateLimitConfig':
+        return RateLimitConfig(
+            rate=as_dict.get('rate'),
+            burst=as_dict.get('burst', 1),
+            policy=RateLimitPolicy(as_dict.get('policy', RateLimitPolicy.COALESCE.value)),
+            max_wait=as_dict.get('maxWait', 1000)
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'policy': self.policy.value,
+            'maxWait': self.max_wait
+        }
+
+
+@dataclass(slots=True)
 class RewardConfig:
     id: Optional[str]
     title: str
     cost: int
     actions: Dict[str, RewardAction]
+    rate_limit: Optional[RateLimitConfig] = None
 
     @staticmethod
     def from_dict(as_dict: dict) -> 'RewardConfig':
@@ -48,11 +154,12 @@ class RewardConfig:
             actions={
                 key: RewardAction.from_dict(action_dict)
                 for (key, action_dict) in as_dict.get('actions', dict()).items()
-            }
+            },
+            rate_limit=RateLimitConfig.from_dict(as_dict['rateLimit']) if 'rateLimit' in as_dict else None
         )
 
     def to_dict(self) -> dict:
-        return {
+        as_dict = {
             'id': self.id,
             'title': self.title,
             'cost': self.cost,
@@ -60,14 +167,210 @@ class RewardConfig:
                 key: action.to_dict() for (key, action) in self.actions.items()
             }
         }
+        if self.rate_limit is not None:
+            as_dict['rateLimit'] = self.rate_limit.to_dict()
 
+        return as_dict
 
-@dataclass
+
+@dataclass(slots=True)
+class QueueConfig:
+    depth: int
+    overflow: OverflowPolicy
+    # Milliseconds an action may wait for its keys to be released by earlier actions (None if there is no limit)
+    max_key_wait: Optional[int] = None
+
+    @staticmethod
+    def from_dict(as_dict: dict) -> 'QueueConfig':
+        return QueueConfig(
+            depth=as_dict.get('depth', 64),
+            overflow=OverflowPolicy(as_dict.get('overflow', OverflowPolicy.REFUND.value)),
+            max_key_wait=as_dict.get('maxKeyWait')
+        )
+
+    def to_dict(self) -> dict:
+        as_dict = {
+            'depth': self.depth,
+            'overflow': self.overflow.value
+        }
+        if self.max_key_wait is not None:
+            as_dict['maxKeyWait'] = self.max_key_wait
+
+        return as_dict
+
+
+@dataclass(slots=True)
+class WindowTrackerConfig:
+    enabled: bool
+    interval: int
+    max_staleness: int
+
+    @staticmethod
+    def from_dict(as_dict: dict) -> 'WindowTrackerConfig':
+        return WindowTrackerConfig(
+            enabled=as_dict.get('enabled', False),
+            interval=as_dict.get('interval', 250),
+            max_staleness=as_dict.get('maxStaleness', 1000)
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'interval': self.interval,
+            'maxStaleness': self.max_staleness
+        }
+
+
+ActionMap = Dict[str, RewardAction]
+
+
+@dataclass(slots=True)
+class BroadcasterConfig:
+    """
+    Rewards of a single broadcaster in multi-broadcaster mode, optionally overriding client-wide settings
+    """
+    login: str
+    rewards: List[RewardConfig]
+    auto_fulfill: Optional[bool] = None
+    refund: Optional[bool] = None
+    keypress_rate_limit: Optional[RateLimitConfig] = None
+
+    @staticmethod
+    def from_dict(as_dict: dict) -> 'BroadcasterConfig':
+        return BroadcasterConfig(
+            login=str(as_dict.get('login')).lower(),
+            rewards=[
+                RewardConfig.from_dict(r) for r in as_dict.get('rewards', list())
+            ],
+            auto_fulfill=as_dict.get('autoFulfill'),
+            refund=as_dict.get('refund'),
+            keypress_rate_limit=RateLimitConfig.from_dict(as_dict['keypressRateLimit'])
+            if 'keypressRateLimit' in as_dict else None
+        )
+
+    def to_dict(self) -> dict:
+        as_dict = {
+            'login': self.login
+        }
+        if self.auto_fulfill is not None:
+            as_dict['autoFulfill'] = self.auto_fulfill
+        if self.refund is not None:
+            as_dict['refund'] = self.refund
+        if self.keypress_rate_limit is not None:
+            as_dict['keypressRateLimit'] = self.keypress_rate_limit.to_dict()
+        as_dict['rewards'] = [
+            reward.to_dict() for reward in self.rewards
+        ]
+
+        return as_dict
+
+
+@dataclass(slots=True)
+class ChannelConfig:
+    """
+    Settings in effect for handling a broadcaster's redemptions (client-wide settings merged with the broadcaster's)
+    """
+    # Configured login of the broadcaster, None if not running in multi-broadcaster mode
+    login: Optional[str]
+    auto_fulfill: bool
+    refund: bool
+    keypress_rate_limit: Optional[RateLimitConfig]
+    # Shared with the client config, so ids added during setup end up in the client config as well
+    rewards: List[RewardConfig]
+    dispatch_table: Dict[str, ActionMap] = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.build_dispatch_table()
+
+    def build_dispatch_table(self) -> None:
+        """
+        (Re-)build the map of reward id to normalized per-game actions used to handle redemptions.
+        Must be called whenever reward ids change. The table is built separately and then swapped in,
+        so redemptions handled concurrently see either the old or the new table but never a partial one.
+        @raise ValueError: If any action is not valid
+        """
+        dispatch_table = {}
+        for reward in self.rewards:
+            # Rewards without an id have not been set up on Twitch yet, so they cannot be redeemed
+            if reward.id is None:
+                continue
+            dispatch_table[reward.id] = {
+                game: action.normalize() for (game, action) in reward.actions.items()
+            }
+
+        self.dispatch_table = dispatch_table
+
+    def get_actions(self, reward_id: str) -> Optional[ActionMap]:
+        return self.dispatch_table.get(reward_id)
+
+    def get_configured_games(self) -> List[str]:
+        return list(set([key for r in self.rewards for key in r.actions.keys()]))
+
+    def get_rate_limits(self) -> Dict[str, RateLimitConfig]:
+        return {r.id: r.rate_limit for r in self.rewards if r.id is not None and r.rate_limit is not None}
+
+
+@dataclass(slots=True)
 class ClientConfig:
     log_level: str
     auto_fulfill: bool
     refund: bool
+    queue: QueueConfig
+    window_tracker: WindowTrackerConfig
+    keypress_rate_limit: Optional[RateLimitConfig]
     rewards: List[RewardConfig]
+    broadcasters: List[BroadcasterConfig] = field(default_factory=list)
+    channels: Dict[Optional[str], ChannelConfig] = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.build_channels()
+
+    def build_channels(self) -> None:
+        """
+        Build the effective config per broadcaster, keyed by login (a single channel keyed None, if no broadcasters
+        are configured)
+        @raise ValueError: If any action is not valid or broadcasters are not configured properly
+        """
+        if len(self.broadcasters) == 0:
+            self.channels = {None: ChannelConfig(
+                login=None,
+                auto_fulfill=self.auto_fulfill,
+                refund=self.refund,
+                keypress_rate_limit=self.keypress_rate_limit,
+                rewards=self.rewards
+            )}
+            return
+
+        if len(self.rewards) > 0:
+            raise ValueError('Rewards need to be configured per broadcaster when configuring broadcasters')
+
+        channels = {}
+        for b in self.broadcasters:
+            if b.login in channels:
+                raise ValueError(f'Broadcaster is configured more than once: "{b.login}"')
+            channels[b.login] = ChannelConfig(
+                login=b.login,
+                auto_fulfill=b.auto_fulfill if b.auto_fulfill is not None else self.auto_fulfill,
+                refund=b.refund if b.refund is not None else self.refund,
+                keypress_rate_limit=b.keypress_rate_limit
+                if b.keypress_rate_limit is not None else self.keypress_rate_limit,
+                rewards=b.rewards
+            )
+        self.channels = channels
+
+    def build_dispatch_table(self) -> None:
+        """
+        (Re-)build the dispatch tables of all channels
+        @raise ValueError: If any action is not valid
+        """
+        for channel in self.channels.values():
+            channel.build_dispatch_table()
+
+    def is_multi_broadcaster(self) -> bool:
+        return len(self.broadcasters) > 0
+
+    def get_configured_games(self) -> List[str]:
+        return list(set([game for c in self.channels.values() for game in c.get_configured_games()]))
 
     @staticmethod
     def from_dict(as_dict: dict) -> 'ClientConfig':
@@ -75,29 +378,81 @@ class ClientConfig:
             log_level=as_dict.get('logLevel', 'info').upper(),
             auto_fulfill=as_dict.get('autoFulfill', False),
             refund=as_dict.get('refund', False),
+            queue=QueueConfig.from_dict(as_dict.get('queue', dict())),
+            window_tracker=WindowTrackerConfig.from_dict(as_dict.get('windowTracker', dict())),
+            keypress_rate_limit=RateLimitConfig.from_dict(as_dict['keypressRateLimit'])
+            if 'keypressRateLimit' in as_dict else None,
             rewards=[
                 RewardConfig.from_dict(r) for r in as_dict.get('rewards', list())
+            ],
+            broadcasters=[
+                BroadcasterConfig.from_dict(b) for b in as_dict.get('broadcasters', list())
             ]
         )
 
     def to_dict(self) -> dict:
-        return {
+        as_dict = {
             'logLevel': self.log_level.lower(),
             'autoFulfill': self.auto_fulfill,
             'refund': self.refund,
-            'rewards': [
+            'queue': self.queue.to_dict(),
+            'windowTracker': self.window_tracker.to_dict()
+        }
+        if self.keypress_rate_limit is not None:
+            as_dict['keypressRateLimit'] = self.keypress_rate_limit.to_dict()
+        if len(self.broadcasters) == 0:
+            as_dict['rewards'] = [
                 reward.to_dict() for reward in self.rewards
             ]
-        }
+        else:
+            as_dict['broadcasters'] = [
+                broadcaster.to_dict() for broadcaster in self.broadcasters
+            ]
 
+        return as_dict
 
-class TokenFromUrlDTO(BaseModel):
-    url: str
 
+@dataclass
+class CustomReward:
+    """
+    Custom channel point reward as returned by the Twitch API
+    """
+    id: str
+    title: str
+    cost: int
+
+    @staticmethod
+    def from_dict(as_dict: dict) -> 'CustomReward':
+        return CustomReward(
+            id=as_dict['id'],
+            title=as_dict['title'],
+            cost=as_dict['cost']
+        )
 
-class YamlDumper(yaml.Dumper):
+
+@dataclass
+class Redemption:
     """
-    From: https://stackoverflow.com/a/39681672
+    Channel point redemption as relayed by the 0xQWERTY API,
+    along with the broadcaster's config in effect when it was received
     """
-    def increase_indent(self, flow=False, indentless=False):
-        return super(YamlDumper, self).increase_indent(flow, False)
+    id: str
+    reward_id: str
+    broadcaster_id: str
+    config: ChannelConfig
+    received_at: float
+    data: dict
+    dequeued_at: Optional[float] = None
+    detected_at: Optional[float] = None
+    pressed_at: Optional[float] = None
+    outcome: Optional[RedemptionOutcome] = None
+    # Details of how the redemption was handled, for tracing
+    window_title: Optional[str] = None
+    game: Optional[str] = None
+    action: Optional[RewardAction] = None
+    # Rate limit decision for the action, if one was taken
+    rate_limit: Optional[str] = None
+
+
+class TokenFromUrlDTO(BaseModel):
+    url: str
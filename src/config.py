@@ -1,14 +1,84 @@
 import os
 
-ROOT_DIR = os.path.dirname(__file__).replace('\\src', '')
+# Resources live next to the src folder when running from source, next to this file when running a bundled build
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) \
+    if os.path.basename(os.path.dirname(os.path.abspath(__file__))) == 'src' else os.path.dirname(__file__)
 PWD = os.getcwd()
 
+# Remote endpoints can be overridden via environment variables, e.g. to run against local stand-ins for benchmarks
 LISTEN_ADDR = '127.0.0.1'
-LISTEN_PORT = 8000
+LISTEN_PORT = int(os.environ.get('QWERTY_LISTEN_PORT', 8000))
 BASE_URL = f'http://localhost:{LISTEN_PORT}'
 REDIRECT_URI = f'{BASE_URL}/s/auth-callback'
 TWITCH_AUTH_BASE_URL = 'https://id.twitch.tv/oauth2/authorize'
 CLIENT_ID = 'jzaeeic6j23u0l2onzm2orovs0uakl'
 SCOPES = ['channel:read:redemptions', 'channel:manage:redemptions']
+TWITCH_VALIDATE_URL = os.environ.get('QWERTY_TWITCH_VALIDATE_URL', 'https://id.twitch.tv/oauth2/validate')
+TWITCH_HELIX_BASE_URL = os.environ.get('QWERTY_TWITCH_HELIX_BASE_URL', 'https://api.twitch.tv/helix')
+TWITCH_EVENTSUB_URL = os.environ.get('QWERTY_TWITCH_EVENTSUB_URL', 'wss://eventsub.wss.twitch.tv/ws')
+TOKEN_CACHE_PATH = os.path.join(PWD, 'token-cache.json')
+# Validated client config, so unchanged configs don't need to be parsed and validated again on startup
+CONFIG_CACHE_PATH = os.path.join(PWD, 'config-cache.json')
+# Bump whenever the cached format changes
+CONFIG_CACHE_VERSION = 1
+# Seconds to wait for further changes before writing rewards' ids, titles and costs back to the client config
+CONFIG_WRITE_DELAY = 0.5
 
-QWERTY_API_BASE_URL = 'https://0xqwerty-api.cetteup.com'
+HTTP_TIMEOUT = 10.0
+HTTP_POOL_SIZE = 16
+HTTP_KEEPALIVE_TIMEOUT = 60.0
+
+HELIX_MAX_RETRIES = 4
+HELIX_BACKOFF_BASE = 0.5
+HELIX_BACKOFF_MAX = 10.0
+# Share of the Helix rate limit bucket reserved for requests that cannot wait
+HELIX_LOW_PRIORITY_RESERVE = 0.2
+
+REWARD_SETUP_CONCURRENCY = 8
+
+# Seconds without events after which Twitch sends a keepalive message (10-600), missing ones mean the connection is dead
+EVENTSUB_KEEPALIVE_TIMEOUT = 10
+EVENTSUB_KEEPALIVE_GRACE = 5.0
+EVENTSUB_WELCOME_TIMEOUT = 10.0
+# Seconds to wait for events still in flight on the old connection after reconnecting
+EVENTSUB_DRAIN_TIMEOUT = 1.0
+EVENTSUB_BACKOFF_BASE = 0.5
+EVENTSUB_BACKOFF_MAX = 30.0
+
+SOCKETIO_BACKOFF_BASE = 0.5
+SOCKETIO_BACKOFF_MAX = 30.0
+# Seconds between connection checks (disconnects are acted on right away, this catches connections lost silently)
+SOCKETIO_WATCHDOG_INTERVAL = 10.0
+
+# Redemptions made while disconnected are fetched from Twitch after reconnecting (within this many seconds)
+GAP_FILL_TIMEOUT = 60.0
+GAP_FILL_CONCURRENCY = 4
+# Seconds before the disconnect to look back as well, covering redemptions in flight and clock differences
+GAP_FILL_MARGIN = 30.0
+# Redemptions older than this (seconds) when fetched are refunded instead of acted on, since the moment has passed
+GAP_FILL_MAX_AGE = 60.0
+
+# Seconds to wait for redemptions to be settled when stopping
+DISPATCHER_DRAIN_TIMEOUT = 5.0
+STATUS_WORKERS = 64
+STATUS_BATCH_SIZE = 50
+STATUS_BATCH_LINGER = 0.05
+
+OUTBOX_PATH = os.path.join(PWD, 'outbox.sqlite3')
+OUTBOX_DRAIN_INTERVAL = 60.0
+OUTBOX_DRAIN_BATCH_SIZE = 200
+# Minimum age of pending status updates before replaying them (younger ones are likely still in flight)
+OUTBOX_REPLAY_DELAY = 30.0
+# Pending status updates are given up on once sending them failed this many times or they reached this age (seconds)
+OUTBOX_MAX_ATTEMPTS = 100
+OUTBOX_MAX_AGE = 24 * 60 * 60
+
+# Redemptions may be redelivered after reconnecting, remember ids long enough to catch those
+REDEMPTION_CACHE_TTL = 15 * 60
+REDEMPTION_CACHE_MAX_SIZE = 50000
+# Number of recent redemptions to keep traces of for inspection
+TRACE_BUFFER_SIZE = 1000
+# Seconds keys stay pressed for on keypresses, games polling input once per frame might miss shorter ones
+KEYPRESS_DURATION = 0.1
+
+QWERTY_API_BASE_URL = os.environ.get('QWERTY_API_BASE_URL', 'https://0xqwerty-api.cetteup.com')
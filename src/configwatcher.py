@@ -0,0 +1,110 @@
+import asyncio
+import os
+from typing import Callable, Awaitable, Optional, Tuple
+
+import yaml
+from jsonschema import ValidationError
+
+from classes import ClientConfig
+from logger import logger
+from utility import parse_client_config, hash_content
+
+
+class ConfigWatcher:
+    """
+    Watches the client config file for changes and hands any new, valid config to a callback
+    """
+    path: str
+    on_change: Callable[[ClientConfig], Awaitable[None]]
+    interval: float
+
+    __stat: Optional[Tuple[float, int]] = None
+    __hash: Optional[str] = None
+    __task: Optional[asyncio.Task] = None
+
+    def __init__(self, path: str, on_change: Callable[[ClientConfig], Awaitable[None]], interval: float = 1.0) -> None:
+        """
+        @param path: Path of the client config file
+        @param on_change: Coroutine function called with the new config whenever the file's content changes
+        @param interval: Seconds between checks for changes
+        """
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+
+    def start(self) -> None:
+        self.refresh()
+        self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+
+    def refresh(self) -> None:
+        """
+        Take note of the file's current content without treating it as a change (e.g. after writing it ourselves)
+        """
+        try:
+            self.__stat = self.__get_stat()
+            with open(self.path, 'r') as f:
+                self.__hash = hash_content(f.read())
+        except OSError as e:
+            logger.error(f'Failed to read client config: {e}')
+
+    def expect(self, previous: str, content: str) -> None:
+        """
+        Take note of content about to be written by ourselves, so it is not treated as a change. Ignored if the
+        previous content was not known yet, as changes made to it by someone else would be missed otherwise.
+        """
+        if hash_content(previous) == self.__hash:
+            self.__hash = hash_content(content)
+
+    def __get_stat(self) -> Tuple[float, int]:
+        stat = os.stat(self.path)
+        return stat.st_mtime, stat.st_size
+
+    async def __run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f'Failed to reload client config: {e}')
+
+    async def check(self) -> None:
+        # Only read the file if it was touched, the actual content may still be unchanged
+        try:
+            stat = self.__get_stat()
+        except OSError:
+            return
+        if stat == self.__stat:
+            return
+        self.__stat = stat
+
+        content = await asyncio.to_thread(self.__read)
+        content_hash = hash_content(content)
+        if content_hash == self.__hash:
+            return
+        self.__hash = content_hash
+
+        try:
+            client_config = await asyncio.to_thread(parse_client_config, content)
+        except yaml.YAMLError as e:
+            logger.error(f'Changed client config is not valid YAML, keeping current config: {e}')
+            return
+        except ValidationError as e:
+            logger.error(f'Changed client config does not match schema, keeping current config: '
+                         f'{e.json_path}: {e.message}')
+            return
+        except ValueError as e:
+            logger.error(f'Changed client config contains invalid values, keeping current config: {e}')
+            return
+
+        logger.info('Client config changed, reloading')
+        await self.on_change(client_config)
+
+    def __read(self) -> str:
+        with open(self.path, 'r') as f:
+            return f.read()
@@ -0,0 +1,245 @@
+import asyncio
+import os
+import shutil
+import sys
+from typing import Optional, Callable, Dict, List, Tuple, Any
+
+import yaml
+from jsonschema import ValidationError
+
+import config
+from classes import ClientConfig
+from logger import logger
+from utility import SafeLoader, ClientConfigError, parse_client_config, save_config_cache, hash_content, \
+    read_config_schema
+
+# Broadcaster login (None if not running in multi-broadcaster mode) -> id, title and cost of each reward
+RewardFields = Dict[Optional[str], List[Dict[str, Any]]]
+# Start and end index of text to replace and the text to replace it with
+Edit = Tuple[int, int, str]
+
+WRITTEN_FIELDS = ['id', 'title', 'cost']
+
+
+class ConfigWriter:
+    """
+    Writes rewards' ids, titles and costs (as assigned/updated during setup) back to the client config file.
+    Only those values are touched, leaving the rest of the file (including comments) as is. Writes happen off the
+    event loop and replace the file atomically, so a crash cannot leave a partially written config behind.
+    Updates scheduled in quick succession are written at once.
+    """
+    path: str
+    delay: float
+    # Called with the file's previous and new content right before it is replaced
+    on_write: Optional[Callable[[str, str], None]]
+
+    __pending: Optional[RewardFields] = None
+    __flushing: asyncio.Event
+    __task: Optional[asyncio.Task] = None
+
+    def __init__(
+            self,
+            path: str,
+            on_write: Optional[Callable[[str, str], None]] = None,
+            delay: float = config.CONFIG_WRITE_DELAY
+    ) -> None:
+        """
+        @param path: Path of the client config file
+        @param on_write: Called with the file's previous and new content right before the file is replaced
+        @param delay: Seconds to wait for further updates before writing
+        """
+        self.path = path
+        self.on_write = on_write
+        self.delay = delay
+        self.__flushing = asyncio.Event()
+
+    def schedule(self, client_config: ClientConfig) -> None:
+        """
+        Write the rewards' current ids, titles and costs to the file shortly
+        """
+        # Take a snapshot now, rewards may change while the write is pending
+        self.__pending = {
+            login: [{key: getattr(r, key) for key in WRITTEN_FIELDS} for r in channel.rewards]
+            for (login, channel) in client_config.channels.items()
+        }
+        if self.__task is None or self.__task.done():
+            self.__task = asyncio.create_task(self.__run())
+
+    async def flush(self) -> None:
+        """
+        Write any pending update right away and wait for it to complete
+        """
+        if self.__task is not None:
+            self.__flushing.set()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__flushing.clear()
+            self.__task = None
+
+    async def __run(self) -> None:
+        while self.__pending is not None:
+            try:
+                await asyncio.wait_for(self.__flushing.wait(), self.delay)
+            except asyncio.TimeoutError:
+                pass
+
+            rewards, self.__pending = self.__pending, None
+            try:
+                written = await self.__write(rewards)
+            except (OSError, yaml.YAMLError) as e:
+                logger.error(f'Failed to write client config: {e}')
+                continue
+
+            # File was changed by someone else while updating it, so try again with the new content
+            if not written and self.__pending is None:
+                self.__pending = rewards
+
+    async def __write(self, rewards: RewardFields) -> bool:
+        """
+        @return: Whether the file was written (or did not need to be)
+        """
+        previous = await asyncio.to_thread(self.__read)
+        content = update_reward_fields(previous, rewards)
+        if content == previous:
+            return True
+
+        if self.on_write is not None:
+            self.on_write(previous, content)
+        return await asyncio.to_thread(self.__replace, previous, content)
+
+    def __read(self) -> str:
+        with open(self.path, 'r') as f:
+            return f.read()
+
+    def __replace(self, previous: str, content: str) -> bool:
+        if self.__read() != previous:
+            return False
+
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copymode(self.path, temp_path)
+        os.replace(temp_path, self.path)
+        self.__update_cache(content)
+        return True
+
+    @staticmethod
+    def __update_cache(content: str) -> None:
+        """
+        Cache the written config, so the next start can still skip parsing and validating it
+        """
+        try:
+            save_config_cache(hash_content(content), hash_content(read_config_schema()), parse_client_config(content))
+        except (yaml.YAMLError, ValidationError, ValueError, ClientConfigError) as e:
+            # Cache only matches the previous content, which is harmless (it is ignored from now on)
+            logger.debug(f'Not caching written client config: {e}')
+
+
+def update_reward_fields(content: str, rewards: RewardFields) -> str:
+    """
+    Update rewards' ids, titles and costs in a client config, leaving everything else (including comments) untouched.
+    Rewards are matched by id or, if they do not have one in the config yet or their id is stale (e.g. the reward was
+    re-created on Twitch), by title.
+    @param content: Client config as YAML
+    @param rewards: Values to write
+    @return: Updated client config as YAML
+    @raise yaml.YAMLError: If the content is not valid YAML
+    """
+    loader = SafeLoader(content)
+    try:
+        root = loader.get_single_node()
+        if not isinstance(root, yaml.MappingNode):
+            return content
+
+        edits = []
+        for (login, reward_nodes) in find_reward_nodes(loader, root):
+            if login not in rewards:
+                continue
+            by_id = {r['id']: r for r in rewards[login] if r['id'] is not None}
+            nodes = [(node, construct_scalars(loader, node)) for node in reward_nodes]
+            # Rewards matched by id take precedence, only the remaining ones can be matched by title
+            matched = {values.get('id') for (_, values) in nodes if values.get('id') in by_id}
+            by_title = {r['title']: r for r in rewards[login] if r['id'] not in matched}
+            for (reward_node, values) in nodes:
+                reward = by_id.get(values.get('id')) or by_title.get(values.get('title'))
+                if reward is not None:
+                    edits.extend(get_edits(content, reward_node, values, reward))
+    finally:
+        loader.dispose()
+
+    # Apply back to front, so earlier edits don't shift the positions of later ones
+    for (start, end, text) in sorted(edits, reverse=True):
+        content = content[:start] + text + content[end:]
+
+    return content
+
+
+def find_reward_nodes(
+        loader: yaml.BaseLoader,
+        root: yaml.MappingNode
+) -> List[Tuple[Optional[str], List[yaml.MappingNode]]]:
+    """
+    Find the nodes of configured rewards, grouped by broadcaster login
+    """
+    def get_rewards(mapping: yaml.MappingNode) -> List[yaml.MappingNode]:
+        node = get_value_node(mapping, 'rewards')
+        if not isinstance(node, yaml.SequenceNode):
+            return []
+        return [n for n in node.value if isinstance(n, yaml.MappingNode)]
+
+    broadcasters = get_value_node(root, 'broadcasters')
+    if not isinstance(broadcasters, yaml.SequenceNode) or len(broadcasters.value) == 0:
+        return [(None, get_rewards(root))]
+
+    found = []
+    for broadcaster in broadcasters.value:
+        if isinstance(broadcaster, yaml.MappingNode):
+            login = construct_scalars(loader, broadcaster).get('login')
+            found.append((str(login).lower(), get_rewards(broadcaster)))
+
+    return found
+
+
+def get_value_node(mapping: yaml.MappingNode, key: str) -> Optional[yaml.Node]:
+    for (key_node, value_node) in mapping.value:
+        if isinstance(key_node, yaml.ScalarNode) and key_node.value == key:
+            return value_node
+
+    return None
+
+
+def construct_scalars(loader: yaml.BaseLoader, mapping: yaml.MappingNode) -> Dict[str, Any]:
+    return {
+        key_node.value: loader.construct_object(value_node)
+        for (key_node, value_node) in mapping.value
+        if isinstance(key_node, yaml.ScalarNode) and isinstance(value_node, yaml.ScalarNode)
+    }
+
+
+def get_edits(content: str, mapping: yaml.MappingNode, values: Dict[str, Any], reward: Dict[str, Any]) -> List[Edit]:
+    edits = []
+    for key in WRITTEN_FIELDS:
+        if reward[key] is None or (key in values and values[key] == reward[key]):
+            continue
+
+        value_node = get_value_node(mapping, key)
+        text = format_scalar(reward[key])
+        if isinstance(value_node, yaml.ScalarNode):
+            start, end = value_node.start_mark.index, value_node.end_mark.index
+            # Empty values (e.g. "id:") end right after the colon
+            if start == end and content[start - 1:start] == ':':
+                text = f' {text}'
+            edits.append((start, end, text))
+        elif value_node is None and len(mapping.value) > 0:
+            # Add missing keys in front of the first one, matching its indentation
+            first_key = mapping.value[0][0]
+            separator = ', ' if mapping.flow_style else f'\n{" " * first_key.start_mark.column}'
+            edits.append((first_key.start_mark.index, first_key.start_mark.index, f'{key}: {text}{separator}'))
+
+    return edits
+
+
+def format_scalar(value: Any) -> str:
+    # Dump as part of a flow sequence, which quotes the value wherever YAML requires it
+    return yaml.safe_dump([value], default_flow_style=True, width=sys.maxsize).strip()[1:-1]
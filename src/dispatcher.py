@@ -0,0 +1,198 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+from typing import Callable, Awaitable, List, Tuple, Union, Optional
+
+import config
+from classes import OverflowPolicy, Redemption
+from logger import logger
+
+# Whether action was taken, or a future resolving to it (for actions which are only started later)
+ExecutionResult = Union[bool, Future]
+
+
+@dataclass
+class DispatcherStats:
+    depth: int
+    capacity: int
+    max_depth: int
+    status_pending: int
+    received: int
+    processed: int
+    dropped: int
+    refunded: int
+
+    def to_dict(self) -> dict:
+        return {
+            'depth': self.depth,
+            'capacity': self.capacity,
+            'maxDepth': self.max_depth,
+            'statusPending': self.status_pending,
+            'received': self.received,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'refunded': self.refunded
+        }
+
+
+class RedemptionDispatcher:
+    """
+    Moves redemption handling off the event loop. Redemptions are buffered in a bounded queue and handed to a
+    single input thread in arrival order (window detection + keypress). Resulting status updates are then handled
+    by a separate set of I/O workers, so slow Twitch API calls never hold up the next keypress. Redemptions whose
+    action was deferred are settled once it was started, without holding up the input thread in the meantime.
+    """
+    execute: Callable[[Redemption], ExecutionResult]
+    settle: Callable[[Redemption, bool], Awaitable[None]]
+    overflow: OverflowPolicy
+    status_workers: int
+
+    __queue: asyncio.Queue
+    __status_queue: asyncio.Queue
+    __input_executor: ThreadPoolExecutor
+    __input_task: Optional[asyncio.Task] = None
+    __stopping: bool = False
+    __tasks: List[asyncio.Task]
+
+    __max_depth: int = 0
+    __received: int = 0
+    __processed: int = 0
+    __dropped: int = 0
+    __refunded: int = 0
+
+    def __init__(
+            self,
+            execute: Callable[[Redemption], ExecutionResult],
+            settle: Callable[[Redemption, bool], Awaitable[None]],
+            depth: int = 64,
+            overflow: OverflowPolicy = OverflowPolicy.REFUND,
+            status_workers: int = 4
+    ) -> None:
+        """
+        @param execute: Blocking function taking action for a redemption, called on the input thread
+                        (returns whether action was taken or a future resolving to it)
+        @param settle: Coroutine function updating a redemption's status, given whether action was taken
+        @param depth: Maximum number of redemptions waiting to be processed
+        @param overflow: What to do with redemptions received while the queue is full
+        @param status_workers: Number of concurrent status updates
+        """
+        self.execute = execute
+        self.settle = settle
+        self.overflow = overflow
+        self.status_workers = status_workers
+        self.__queue = asyncio.Queue(maxsize=depth)
+        self.__status_queue = asyncio.Queue()
+        self.__input_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='input')
+        self.__tasks = []
+
+    def start(self) -> None:
+        self.__input_task = asyncio.create_task(self.__input_worker())
+        self.__tasks.append(self.__input_task)
+        for _ in range(self.status_workers):
+            self.__tasks.append(asyncio.create_task(self.__status_worker()))
+
+    async def stop(self, drain_timeout: float = config.DISPATCHER_DRAIN_TIMEOUT) -> None:
+        """
+        Stop taking action, refunding redemptions still waiting to be processed (after letting the one being processed
+        finish), then give their status updates a moment to be sent before stopping entirely
+        @param drain_timeout: Seconds to wait for pending status updates
+        """
+        self.__stopping = True
+        refunded = 0
+        while not self.__queue.empty():
+            self.__status_queue.put_nowait((self.__queue.get_nowait(), False))
+            self.__queue.task_done()
+            refunded += 1
+        if refunded > 0:
+            logger.warning(f'Refunding {refunded} redemptions not processed before stopping')
+        self.__refunded += refunded
+        # Only the redemption currently being processed is left unfinished
+        await self.__queue.join()
+        if self.__input_task is not None:
+            self.__input_task.cancel()
+            await asyncio.gather(self.__input_task, return_exceptions=True)
+        try:
+            await asyncio.wait_for(self.__status_queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Stopped before all redemptions were settled')
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks.clear()
+        self.__input_executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, redemption: Redemption) -> bool:
+        """
+        Queue a redemption for processing without blocking
+        @return: Whether the redemption was queued (as opposed to being refunded/dropped due to overflow)
+        """
+        self.__received += 1
+        if self.__stopping:
+            logger.warning(f'Received redemption while stopping, refunding redemption ({redemption.id})')
+            self.__refunded += 1
+            self.__status_queue.put_nowait((redemption, False))
+            return False
+        try:
+            self.__queue.put_nowait(redemption)
+        except asyncio.QueueFull:
+            self.__handle_overflow(redemption)
+            return False
+
+        self.__max_depth = max(self.__max_depth, self.__queue.qsize())
+        return True
+
+    def reject(self, redemption: Redemption) -> None:
+        """
+        Skip processing a redemption (no action will be taken) and only settle its status
+        """
+        self.__received += 1
+        self.__processed += 1
+        self.__status_queue.put_nowait((redemption, False))
+
+    def __handle_overflow(self, redemption: Redemption) -> None:
+        if self.overflow is OverflowPolicy.REFUND:
+            logger.warning(f'Redemption queue is full, refunding redemption ({redemption.id})')
+            self.__refunded += 1
+            self.__status_queue.put_nowait((redemption, False))
+        else:
+            logger.warning(f'Redemption queue is full, dropping redemption ({redemption.id})')
+            self.__dropped += 1
+
+    async def __input_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            redemption = await self.__queue.get()
+            try:
+                fulfilled = await loop.run_in_executor(self.__input_executor, self.execute, redemption)
+            except Exception as e:
+                logger.error(f'Failed to process redemption ({redemption.id}): {e}')
+                fulfilled = False
+            finally:
+                self.__queue.task_done()
+
+            self.__processed += 1
+            self.__status_queue.put_nowait((redemption, fulfilled))
+
+    async def __status_worker(self) -> None:
+        while True:
+            item: Tuple[Redemption, ExecutionResult] = await self.__status_queue.get()
+            redemption, result = item
+            try:
+                fulfilled = await asyncio.wrap_future(result) if isinstance(result, Future) else result
+                await self.settle(redemption, fulfilled)
+            except Exception as e:
+                logger.error(f'Failed to settle redemption ({redemption.id}): {e}')
+            finally:
+                self.__status_queue.task_done()
+
+    def get_stats(self) -> DispatcherStats:
+        return DispatcherStats(
+            depth=self.__queue.qsize(),
+            capacity=self.__queue.maxsize,
+            max_depth=self.__max_depth,
+            status_pending=self.__status_queue.qsize(),
+            received=self.__received,
+            processed=self.__processed,
+            dropped=self.__dropped,
+            refunded=self.__refunded
+        )
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import random
+from typing import Optional, Callable, Awaitable, Dict, List, Set
+
+import aiohttp
+
+import config
+import metrics
+from helix import HelixClient, HelixError
+from logger import logger
+
+REDEMPTION_ADD = 'channel.channel_points_custom_reward_redemption.add'
+
+
+class EventSubError(Exception):
+    pass
+
+
+class EventSubClient:
+    """
+    Receives channel point redemptions directly from a Twitch EventSub WebSocket instead of via the 0xQWERTY API
+    (see https://dev.twitch.tv/docs/eventsub/handling-websocket-events/). Twitch ties websocket subscriptions to the
+    user whose token created them, so every broadcaster needs a client of their own.
+    """
+    helix: HelixClient
+    url: str
+    on_redemption: Callable[[dict], Awaitable[None]]
+    # Called when the session was lost and once a new one was established after that (and subscribed to again)
+    on_disconnect: Optional[Callable[[], None]]
+    on_reconnect: Optional[Callable[[], None]]
+
+    __broadcaster_id: Optional[str] = None
+    __reward_ids: Set[str]
+    # Reward id -> id of the subscription to the reward's redemptions in the current session
+    __subscriptions: Dict[str, str]
+    __session_id: Optional[str] = None
+    __keepalive_timeout: float
+    __sync_lock: asyncio.Lock
+    __task: Optional[asyncio.Task] = None
+
+    def __init__(
+            self,
+            helix: HelixClient,
+            on_redemption: Callable[[dict], Awaitable[None]],
+            on_disconnect: Optional[Callable[[], None]] = None,
+            on_reconnect: Optional[Callable[[], None]] = None,
+            url: str = config.TWITCH_EVENTSUB_URL,
+            keepalive_timeout: int = config.EVENTSUB_KEEPALIVE_TIMEOUT
+    ) -> None:
+        """
+        @param helix: Twitch API client to create subscriptions with (using the broadcaster's token)
+        @param on_redemption: Called with every redemption, in the format relayed by the 0xQWERTY API
+        @param on_disconnect: Called when the session was lost (redemptions may be missed until reconnected)
+        @param on_reconnect: Called once a new session was established after losing the previous one
+        @param url: EventSub WebSocket URL
+        @param keepalive_timeout: Seconds without messages after which Twitch should send a keepalive message
+        """
+        self.helix = helix
+        self.on_redemption = on_redemption
+        self.on_disconnect = on_disconnect
+        self.on_reconnect = on_reconnect
+        self.url = f'{url}?keepalive_timeout_seconds={keepalive_timeout}'
+        self.__reward_ids = set()
+        self.__subscriptions = {}
+        self.__keepalive_timeout = keepalive_timeout
+        self.__sync_lock = asyncio.Lock()
+
+    def start(self) -> None:
+        """
+        Connect in the background, staying connected until stopped
+        """
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+
+    def is_connected(self) -> bool:
+        return self.__session_id is not None
+
+    async def subscribe(self, broadcaster_id: str, reward_ids: List[str]) -> None:
+        """
+        Subscribe to redemptions of the given rewards (only), removing subscriptions of any other rewards.
+        If not connected right now, subscriptions are created once connected.
+        @raise EventSubError: If any subscription could not be created or removed
+        """
+        self.__broadcaster_id = broadcaster_id
+        self.__reward_ids = set(reward_ids)
+        if self.__session_id is not None:
+            await self.__sync_subscriptions()
+
+    async def __sync_subscriptions(self) -> None:
+        async with self.__sync_lock:
+            session_id = self.__session_id
+            missing = [r for r in self.__reward_ids if r not in self.__subscriptions]
+            obsolete = [(r, s) for (r, s) in self.__subscriptions.items() if r not in self.__reward_ids]
+            if len(missing) == 0 and len(obsolete) == 0:
+                return
+
+            results = await asyncio.gather(
+                *[self.__create_subscription(session_id, reward_id) for reward_id in missing],
+                *[self.__delete_subscription(reward_id, subscription_id) for (reward_id, subscription_id) in obsolete],
+                return_exceptions=True
+            )
+            errors = [r for r in results if isinstance(r, Exception)]
+            if len(errors) > 0:
+                raise EventSubError(f'Failed to update {len(errors)} EventSub subscriptions: {errors[0]}')
+
+            logger.info(f'Subscribed to redemptions of {len(self.__subscriptions)} managed rewards via EventSub')
+
+    async def __create_subscription(self, session_id: str, reward_id: str) -> None:
+        try:
+            resp = await self.helix.post('eventsub/subscriptions', json={
+                'type': REDEMPTION_ADD,
+                'version': '1',
+                'condition': {
+                    'broadcaster_user_id': self.__broadcaster_id,
+                    'reward_id': reward_id
+                },
+                'transport': {
+                    'method': 'websocket',
+                    'session_id': session_id
+                }
+            })
+        except HelixError as e:
+            raise EventSubError(str(e)) from e
+
+        if not resp.ok:
+            raise EventSubError(f'Failed to subscribe to redemptions of reward {reward_id} '
+                                f'(HTTP/{resp.status}/{resp.reason})')
+
+        # Subscriptions of a session that was lost in the meantime are gone
+        if session_id == self.__session_id:
+            self.__subscriptions[reward_id] = resp.json()['data'][0]['id']
+
+    async def __delete_subscription(self, reward_id: str, subscription_id: str) -> None:
+        try:
+            resp = await self.helix.delete('eventsub/subscriptions', params={'id': subscription_id})
+        except HelixError as e:
+            raise EventSubError(str(e)) from e
+
+        # Subscription not being found means it is gone already
+        if not resp.ok and resp.status != 404:
+            raise EventSubError(f'Failed to unsubscribe from redemptions of reward {reward_id} '
+                                f'(HTTP/{resp.status}/{resp.reason})')
+
+        self.__subscriptions.pop(reward_id, None)
+
+    async def __run(self) -> None:
+        ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        attempt = 0
+        connected_before = False
+        try:
+            while True:
+                try:
+                    if ws is None:
+                        ws = await self.__connect(self.url)
+                        attempt = 0
+                        # Subscriptions only carry over when Twitch asks to reconnect, not to new sessions.
+                        # Twitch closes connections without any subscriptions shortly after welcoming them.
+                        self.__subscriptions = {}
+                        try:
+                            await self.__sync_subscriptions()
+                        except EventSubError as e:
+                            logger.error(str(e))
+                        if connected_before and self.on_reconnect is not None:
+                            self.on_reconnect()
+                        connected_before = True
+                    ws = await self.__receive(ws)
+                except (aiohttp.ClientError, asyncio.TimeoutError, EventSubError) as e:
+                    logger.warning(f'EventSub connection failed: {e.__class__.__name__} {e}')
+                    if ws is not None:
+                        await ws.close()
+                    ws = None
+
+                if ws is None:
+                    # Only report losing a session once, not every failed attempt at establishing a new one
+                    if self.__session_id is not None and self.on_disconnect is not None:
+                        self.on_disconnect()
+                    self.__session_id = None
+                    metrics.eventsub_reconnects.inc()
+                    delay = random.uniform(0, min(config.EVENTSUB_BACKOFF_BASE * 2 ** attempt,
+                                                  config.EVENTSUB_BACKOFF_MAX))
+                    attempt += 1
+                    await asyncio.sleep(delay)
+        finally:
+            self.__session_id = None
+            if ws is not None:
+                await ws.close()
+
+    async def __connect(self, url: str) -> aiohttp.ClientWebSocketResponse:
+        """
+        Connect and wait for the welcome message
+        @raise EventSubError: If Twitch did not welcome the connection
+        """
+        ws = await self.helix.session.ws_connect(url)
+        try:
+            message = await self.__read(ws, config.EVENTSUB_WELCOME_TIMEOUT)
+            if message is None or message.get('metadata', {}).get('message_type') != 'session_welcome':
+                raise EventSubError('Twitch did not send a welcome message')
+        except BaseException:
+            await ws.close()
+            raise
+
+        session = message.get('payload', {}).get('session', {})
+        self.__session_id = session.get('id')
+        self.__keepalive_timeout = session.get('keepalive_timeout_seconds') or self.__keepalive_timeout
+        logger.info('Connection to Twitch EventSub established')
+        return ws
+
+    async def __read(self, ws: aiohttp.ClientWebSocketResponse, timeout: float) -> Optional[dict]:
+        """
+        Read the next message
+        @return: The message or None, if it was not a text message
+        @raise EventSubError: If the connection was closed
+        @raise asyncio.TimeoutError: If no message arrived in time
+        """
+        msg = await ws.receive(timeout=timeout)
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            return json.loads(msg.data)
+        if msg.type in [aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED,
+                        aiohttp.WSMsgType.ERROR]:
+            raise EventSubError(f'Connection closed by Twitch ({ws.close_code})')
+        return None
+
+    async def __receive(self, ws: aiohttp.ClientWebSocketResponse) -> aiohttp.ClientWebSocketResponse:
+        """
+        Handle messages until Twitch asks to reconnect
+        @return: Connection to continue with
+        """
+        while True:
+            # Twitch sends keepalive messages whenever there were no events for a while, so silence means trouble
+            message = await self.__read(ws, self.__keepalive_timeout + config.EVENTSUB_KEEPALIVE_GRACE)
+            if message is None:
+                continue
+
+            message_type = message.get('metadata', {}).get('message_type')
+            if message_type == 'session_reconnect':
+                reconnect_url = message.get('payload', {}).get('session', {}).get('reconnect_url')
+                logger.info('Twitch asked to reconnect to EventSub')
+                new_ws = await self.__connect(reconnect_url)
+                # Events are sent over the old connection until the new one was welcomed, so handle any in flight
+                await self.__drain(ws)
+                return new_ws
+
+            await self.__handle(message)
+
+    async def __drain(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        try:
+            while True:
+                message = await self.__read(ws, config.EVENTSUB_DRAIN_TIMEOUT)
+                if message is not None:
+                    await self.__handle(message)
+        except (aiohttp.ClientError, asyncio.TimeoutError, EventSubError):
+            pass
+        finally:
+            await ws.close()
+
+    async def __handle(self, message: dict) -> None:
+        metadata = message.get('metadata', {})
+        payload = message.get('payload', {})
+        message_type = metadata.get('message_type')
+        if message_type == 'notification' and metadata.get('subscription_type') == REDEMPTION_ADD:
+            event = payload.get('event', {})
+            # Twitch may send the same message more than once, those are caught by the redemption id
+            await self.on_redemption({**event, 'reward_id': event.get('reward', {}).get('id')})
+        elif message_type == 'revocation':
+            subscription = payload.get('subscription', {})
+            reward_id = subscription.get('condition', {}).get('reward_id')
+            self.__subscriptions.pop(reward_id, None)
+            logger.warning(f'Twitch revoked subscription to redemptions of reward {reward_id} '
+                           f'({subscription.get("status")})')
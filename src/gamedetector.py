@@ -1,7 +1,72 @@
 import re
-from typing import Optional
+from dataclasses import dataclass
+from typing import Optional, Dict, List, Callable
 
-import pyautogui
+# Returns the title of the window currently in the foreground (if any)
+WindowTitleProvider = Callable[[], Optional[str]]
+
+# Characters with a special meaning in regular expressions (if not escaped)
+REGEX_METACHARACTERS = set('.^$*+?{}[]|()')
+
+
+def pattern_to_literal(pattern: str) -> Optional[str]:
+    """
+    Get the literal string an anchored pattern (e.g. "^dota 2$") matches
+    @return: The literal string or None, if the pattern is not a plain anchored literal
+    """
+    if not pattern.startswith('^') or not pattern.endswith('$') or pattern.endswith('\\$'):
+        return None
+
+    literal = []
+    chars = iter(pattern[1:-1])
+    for char in chars:
+        if char == '\\':
+            escaped = next(chars, None)
+            # Escaped alphanumerics are character classes (\w, \d, ...) not literals
+            if escaped is None or escaped.isalnum():
+                return None
+            literal.append(escaped)
+        elif char in REGEX_METACHARACTERS:
+            return None
+        else:
+            literal.append(char)
+
+    return ''.join(literal)
+
+
+@dataclass(frozen=True)
+class CompiledGames:
+    """
+    Patterns of configured games, compiled for matching (replaced as a whole whenever the configured games change,
+    so threads matching titles meanwhile always see a consistent state)
+    """
+    # Case folded literal title -> game
+    literals: Dict[str, str]
+    # Single regex combining all remaining patterns (None if there are none)
+    regex: Optional[re.Pattern]
+    # Named group of the combined regex -> game
+    group_games: Dict[str, str]
+
+
+def get_foreground_window_title() -> Optional[str]:
+    import pyautogui
+    return pyautogui.getActiveWindowTitle()
+
+
+class StaticWindowTitleProvider:
+    """
+    Window title provider returning whatever title was last set (for use without an actual desktop, e.g. in tests)
+    """
+    title: Optional[str]
+
+    def __init__(self, title: Optional[str] = None) -> None:
+        self.title = title
+
+    def set_title(self, title: Optional[str]) -> None:
+        self.title = title
+
+    def __call__(self) -> Optional[str]:
+        return self.title
 
 
 class GameDetector:
@@ -82,13 +147,18 @@ class GameDetector:
         'World of Warcraft': '^world of warcraft$'
     }
 
-    __game_regexes: dict = {}
     __configured_games: list = []
+    __compiled: CompiledGames = CompiledGames(literals={}, regex=None, group_games={})
+    __order: Dict[str, int] = {}
 
-    def __init__(self) -> None:
-        # Compile regexes for every known game
-        for key, pattern in self.__KNOWN_GAMES.items():
-            self.__game_regexes[key] = re.compile(pattern, flags=re.IGNORECASE)
+    title_provider: WindowTitleProvider
+
+    def __init__(self, title_provider: WindowTitleProvider = get_foreground_window_title) -> None:
+        """
+        @param title_provider: Source of the foreground window title
+        """
+        self.title_provider = title_provider
+        self.__order = {key: index for (index, key) in enumerate(self.__KNOWN_GAMES.keys())}
 
     def get_known_games(self) -> list:
         return list(self.__KNOWN_GAMES.keys())
@@ -98,21 +168,63 @@ class GameDetector:
         @param configured_games: List of games that currently have rewards configured
         """
         self.__configured_games = configured_games
+        self.__compile()
 
     def get_configured_games(self) -> list:
         return self.__configured_games
 
-    def get_active_game(self) -> Optional[str]:
+    def __compile(self) -> None:
+        """
+        Compile patterns of configured games into a hash map of plain literal titles
+        plus a single regex combining all remaining patterns (one named group per game)
+        """
+        literals = {}
+        alternatives: List[str] = []
+        group_games = {}
+        for key, pattern in self.__KNOWN_GAMES.items():
+            if key not in self.__configured_games:
+                continue
+
+            literal = pattern_to_literal(pattern)
+            if literal is not None:
+                literals.setdefault(literal.casefold(), key)
+            else:
+                group = f'g{len(alternatives)}'
+                alternatives.append(f'(?P<{group}>{pattern})')
+                group_games[group] = key
+
+        self.__compiled = CompiledGames(
+            literals=literals,
+            regex=re.compile('|'.join(alternatives), flags=re.IGNORECASE) if alternatives else None,
+            group_games=group_games
+        )
+
+    def get_active_window_title(self) -> str:
         """
-        Determine which game is active (=open in the foreground)
         Some games' window titles contain leading/trailing spaces or u200b/non-printing spaces (Call of Duty).
         So, strip spaces and replace u200b-s with nothing
         """
-        active_window_title = str(pyautogui.getActiveWindowTitle()).strip().replace('\u200b', '')
-        active_game = next(
-            (key for key in self.__KNOWN_GAMES.keys() if key in self.__configured_games and
-             self.__game_regexes[key].match(active_window_title)),
-            None
-        )
+        return str(self.title_provider()).strip().replace('\u200b', '')
+
+    def get_active_game(self) -> Optional[str]:
+        """
+        Determine which game is active (=open in the foreground)
+        """
+        return self.match_game(self.get_active_window_title())
+
+    def match_game(self, window_title: str) -> Optional[str]:
+        """
+        Determine which configured game a window title belongs to
+        (one hash lookup for plain titles plus at most one regex match)
+        """
+        compiled = self.__compiled
+        literal_match = compiled.literals.get(window_title.casefold())
+        regex_match = None
+        if compiled.regex is not None and (match := compiled.regex.match(window_title)) is not None:
+            regex_match = compiled.group_games[match.lastgroup]
+
+        if literal_match is None or regex_match is None:
+            return literal_match or regex_match
 
-        return active_game
+        # Prefer whichever game is listed first if a title matches both
+        return min(literal_match, regex_match, key=self.__order.get)
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Optional, Any, Mapping, Union, List, Tuple, Dict
+
+import aiohttp
+
+import config
+
+Params = Union[Mapping[str, str], List[Tuple[str, str]]]
+
+
+class HelixError(Exception):
+    pass
+
+
+@dataclass
+class HelixResponse:
+    status: int
+    reason: str
+    headers: Mapping[str, str]
+    text: str
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+    def json(self) -> Any:
+        return json.loads(self.text) if self.text else None
+
+
+class RequestPriority(IntEnum):
+    # Requests required to receive and handle redemptions
+    HIGH = 0
+    # Requests that can be delayed (e.g. status updates), these leave a reserve of the rate limit to high priority ones
+    LOW = 1
+
+
+class HelixScheduler:
+    """
+    Tracks the Helix rate limit bucket based on response headers and paces requests before the limit is hit
+    (see https://dev.twitch.tv/docs/api/guide/#twitch-rate-limits)
+    """
+    low_priority_reserve: float
+
+    __limit: Optional[int] = None
+    __remaining: Optional[int] = None
+    __reset_at: float = 0.0
+    __throttled: int = 0
+
+    def __init__(self, low_priority_reserve: float = config.HELIX_LOW_PRIORITY_RESERVE) -> None:
+        """
+        @param low_priority_reserve: Share of the bucket low priority requests leave untouched
+        """
+        self.low_priority_reserve = low_priority_reserve
+
+    async def acquire(self, priority: RequestPriority) -> None:
+        """
+        Wait until the bucket has room for a request of the given priority
+        """
+        while True:
+            # Bucket is refilled once reset time has passed
+            if self.__remaining is not None and time.time() >= self.__reset_at:
+                self.__remaining = None
+
+            reserve = 0
+            if priority is RequestPriority.LOW and self.__limit is not None:
+                reserve = int(self.__limit * self.low_priority_reserve)
+
+            if self.__remaining is None or self.__remaining > reserve:
+                if self.__remaining is not None:
+                    # Count request against bucket right away, concurrent requests would overshoot the limit otherwise
+                    self.__remaining -= 1
+                return
+
+            self.__throttled += 1
+            await asyncio.sleep(max(self.__reset_at - time.time(), 0.0) + 0.05)
+            if priority is RequestPriority.LOW:
+                # Let any waiting high priority requests go first
+                await asyncio.sleep(0)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        try:
+            limit = headers.get('Ratelimit-Limit')
+            remaining = headers.get('Ratelimit-Remaining')
+            reset = headers.get('Ratelimit-Reset')
+            if limit is not None:
+                self.__limit = int(limit)
+            if remaining is not None:
+                self.__remaining = int(remaining)
+            if reset is not None:
+                self.__reset_at = float(reset)
+        except ValueError:
+            pass
+
+    def get_remaining(self) -> Optional[int]:
+        return self.__remaining
+
+    def get_reset_at(self) -> float:
+        return self.__reset_at
+
+    def get_throttled(self) -> int:
+        return self.__throttled
+
+
+class HelixClient:
+    """
+    Twitch Helix API client built on a single, long-lived aiohttp session, so requests reuse pooled keep-alive
+    connections instead of paying for a new TLS handshake every time
+    """
+    client_id: str
+    base_url: str
+    timeout: aiohttp.ClientTimeout
+    pool_size: int
+
+    scheduler: HelixScheduler
+    max_retries: int
+
+    __session: Optional[aiohttp.ClientSession] = None
+    __parent: Optional['HelixClient'] = None
+    __token: Optional[str] = None
+    __retried: int = 0
+
+    def __init__(
+            self,
+            client_id: str,
+            base_url: str = config.TWITCH_HELIX_BASE_URL,
+            timeout: float = config.HTTP_TIMEOUT,
+            pool_size: int = config.HTTP_POOL_SIZE,
+            max_retries: int = config.HELIX_MAX_RETRIES
+    ) -> None:
+        self.client_id = client_id
+        self.base_url = base_url.rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.scheduler = HelixScheduler()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Shared session, also used for non-Helix requests (which must not carry the Twitch token)
+        """
+        if self.__parent is not None:
+            return self.__parent.session
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT)
+            self.__session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.__session
+
+    def create_child(self) -> 'HelixClient':
+        """
+        Create a client using this client's session (and thereby its connection pool), but its own token and
+        rate limit bucket (Twitch limits requests per token)
+        """
+        child = HelixClient(self.client_id, self.base_url, self.timeout.total, self.pool_size, self.max_retries)
+        child.__parent = self
+        return child
+
+    async def close(self) -> None:
+        # Children share the parent's session, which is closed along with the parent
+        if self.__parent is None and self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+
+    def set_token(self, token: str) -> None:
+        self.__token = token
+
+    def has_token(self) -> bool:
+        return self.__token is not None
+
+    async def request(
+            self,
+            method: str,
+            path: str,
+            params: Optional[Params] = None,
+            json: Optional[Any] = None,
+            timeout: Optional[float] = None,
+            priority: RequestPriority = RequestPriority.HIGH
+    ) -> HelixResponse:
+        """
+        Send a request to the Helix API, waiting for the rate limit to allow it and retrying if Twitch asks to
+        @param method: HTTP method
+        @param path: Path relative to the Helix base url (e.g. "channel_points/custom_rewards")
+        @param params: Query parameters (use a list of tuples to send a parameter multiple times)
+        @param json: JSON body
+        @param timeout: Per-request timeout in seconds, overriding the client's default
+        @param priority: Priority for pacing requests when running low on rate limit
+        """
+        if self.__token is None:
+            raise HelixError('Token is not set')
+
+        # Creating things is not idempotent, so only retry those if Twitch definitely did not process the request
+        idempotent = method in ['GET', 'PATCH', 'DELETE']
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(priority)
+            try:
+                resp = await self.__send(method, path, params, json, timeout)
+            except HelixError:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                await self.__backoff(attempt)
+                attempt += 1
+                continue
+
+            self.scheduler.update(resp.headers)
+            retryable = resp.status == 429 or (resp.status >= 500 and idempotent)
+            if not retryable or attempt >= self.max_retries:
+                return resp
+
+            await self.__backoff(attempt, self.scheduler.get_reset_at() if resp.status == 429 else None)
+            attempt += 1
+
+    async def __backoff(self, attempt: int, reset_at: Optional[float] = None) -> None:
+        """
+        Wait before retrying using exponential backoff with full jitter (or until the rate limit bucket resets)
+        """
+        self.__retried += 1
+        delay = random.uniform(0, min(config.HELIX_BACKOFF_BASE * 2 ** attempt, config.HELIX_BACKOFF_MAX))
+        if reset_at is not None:
+            delay = max(delay, reset_at - time.time())
+        await asyncio.sleep(delay)
+
+    async def __send(
+            self,
+            method: str,
+            path: str,
+            params: Optional[Params],
+            json: Optional[Any],
+            timeout: Optional[float]
+    ) -> HelixResponse:
+        headers = {
+            'Authorization': f'Bearer {self.__token}',
+            'Client-Id': self.client_id
+        }
+        # Only pass a timeout if overridden, passing None would disable the session's default timeout
+        kwargs = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout is not None else {}
+
+        try:
+            async with self.session.request(
+                    method,
+                    f'{self.base_url}/{path.lstrip("/")}',
+                    params=params,
+                    json=json,
+                    headers=headers,
+                    **kwargs
+            ) as resp:
+                return HelixResponse(
+                    status=resp.status,
+                    reason=resp.reason or '',
+                    headers=resp.headers,
+                    text=await resp.text()
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise HelixError(f'{method} {path} failed: {e.__class__.__name__} {e}') from e
+
+    async def validate_token(self, token: str) -> Optional[dict]:
+        """
+        Validate an access token (see https://dev.twitch.tv/docs/authentication/validate-tokens/)
+        @return: Details of the token (login, user_id, scopes, expires_in) or None, if the token is not valid
+        @raise HelixError: If the token could not be validated
+        """
+        try:
+            async with self.session.get(config.TWITCH_VALIDATE_URL, headers={'Authorization': f'OAuth {token}'}) as resp:
+                if resp.status == 401:
+                    return None
+                elif not resp.ok:
+                    raise HelixError(f'Failed to validate token (HTTP/{resp.status}/{resp.reason})')
+                return await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise HelixError(f'Failed to validate token: {e.__class__.__name__} {e}') from e
+
+    def get_stats(self) -> Dict[str, Optional[float]]:
+        return {
+            'rateLimitRemaining': self.scheduler.get_remaining(),
+            'throttled': self.scheduler.get_throttled(),
+            'retried': self.__retried
+        }
+
+    async def get(self, path: str, params: Optional[Params] = None, **kwargs) -> HelixResponse:
+        return await self.request('GET', path, params=params, **kwargs)
+
+    async def post(self, path: str, params: Optional[Params] = None, json: Optional[Any] = None,
+                   **kwargs) -> HelixResponse:
+        return await self.request('POST', path, params=params, json=json, **kwargs)
+
+    async def patch(self, path: str, params: Optional[Params] = None, json: Optional[Any] = None,
+                    **kwargs) -> HelixResponse:
+        return await self.request('PATCH', path, params=params, json=json, **kwargs)
+
+    async def delete(self, path: str, params: Optional[Params] = None, **kwargs) -> HelixResponse:
+        return await self.request('DELETE', path, params=params, **kwargs)
@@ -0,0 +1,291 @@
+import abc
+import ctypes
+import heapq
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Tuple, Optional, Dict, Callable
+
+from classes import RewardAction, RewardActionType
+from keys import Key
+from logger import logger
+
+# Offset (seconds) from the start of an action, key and whether the key is pressed (or released)
+KeyEvent = Tuple[float, Key, bool]
+# Time to send at, tie breaker, keys, whether they are pressed (or released) and, for an action's first keys,
+# the future to resolve once they were pressed
+ScheduledEvent = Tuple[float, int, Tuple[Key, ...], bool, Optional[Future]]
+
+
+class InputBackend(abc.ABC):
+    """
+    Sends key input to the game
+    """
+    def prepare(self) -> None:
+        """
+        Load anything needed to send input ahead of the first keypress (blocking, called once after startup)
+        """
+        pass
+
+    @abc.abstractmethod
+    def send(self, key: Key, down: bool) -> bool:
+        """
+        Press or release a key
+        @return: Whether the input was sent
+        """
+        ...
+
+
+class PyDirectInputBackend(InputBackend):
+    """
+    Sends scan codes via SendInput, using the structures defined by pydirectinput (Windows only).
+    Unlike pydirectinput's own functions, this neither looks up key names nor pauses after every input.
+    """
+    pydirectinput = None
+
+    __inputs: Dict[Tuple[Key, bool], tuple]
+
+    def __init__(self) -> None:
+        self.__inputs = {}
+
+    def prepare(self) -> None:
+        # Only imported once needed, since importing it takes a while
+        if self.pydirectinput is None:
+            import pydirectinput
+            self.pydirectinput = pydirectinput
+
+    def __get_input(self, key: Key, down: bool) -> tuple:
+        cached = self.__inputs.get((key, down))
+        if cached is not None:
+            return cached
+
+        flags = self.pydirectinput.KEYEVENTF_SCANCODE
+        if key.extended:
+            flags |= self.pydirectinput.KEYEVENTF_EXTENDEDKEY
+        if not down:
+            flags |= self.pydirectinput.KEYEVENTF_KEYUP
+        extra = ctypes.c_ulong(0)
+        ii_ = self.pydirectinput.Input_I()
+        ii_.ki = self.pydirectinput.KeyBdInput(0, key.scan_code, flags, 0, ctypes.pointer(extra))
+        x = self.pydirectinput.Input(ctypes.c_ulong(1), ii_)
+        cached = self.__inputs[(key, down)] = (ctypes.pointer(x), ctypes.sizeof(x))
+        return cached
+
+    def send(self, key: Key, down: bool) -> bool:
+        self.prepare()
+        pointer, size = self.__get_input(key, down)
+        # SendInput returns the number of events successfully inserted into the input stream
+        return self.pydirectinput.SendInput(1, pointer, size) == 1
+
+
+class RecordingInputBackend(InputBackend):
+    """
+    Records key input instead of sending it (for use without an actual game, e.g. in tests and benchmarks)
+    """
+    path: Optional[str]
+
+    __events: List[Tuple[str, bool, float]]
+    __lock: threading.Lock
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        """
+        @param path: File to append key input to as JSON lines (optional)
+        """
+        self.path = path
+        self.__events = []
+        self.__lock = threading.Lock()
+
+    def send(self, key: Key, down: bool) -> bool:
+        sent_at = time.time()
+        with self.__lock:
+            self.__events.append((key.name, down, sent_at))
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps({'key': key.name, 'down': down, 'time': sent_at}) + '\n')
+        return True
+
+    def get_events(self) -> List[Tuple[str, bool, float]]:
+        with self.__lock:
+            return list(self.__events)
+
+    def get_presses(self) -> List[Tuple[str, float]]:
+        with self.__lock:
+            return [(name, sent_at) for (name, down, sent_at) in self.__events if down]
+
+
+def create_input_backend(name: str, record_path: Optional[str] = None) -> InputBackend:
+    if name == 'recording':
+        return RecordingInputBackend(record_path)
+    return PyDirectInputBackend()
+
+
+class InputController:
+    """
+    Executes reward actions using an input backend. An action's first keys are pressed right away, while releasing
+    them (and pressing any later keys of sequences) is scheduled on a dedicated input thread. So holding keys never
+    blocks handling other redemptions. Actions using keys still in use by earlier actions are deferred until those
+    keys were released for a moment, so repeated presses of a key are not merged into one. Actions are only deferred
+    for so long though, since a late keypress may end up in whatever window is active by then.
+    """
+    backend: InputBackend
+    keypress_duration: float
+    clock: Callable[[], float]
+
+    __events: List[ScheduledEvent]
+    __held: Dict[Key, int]
+    __available_at: Dict[Key, float]
+    __sequence: itertools.count
+    __condition: threading.Condition
+    __thread: Optional[threading.Thread] = None
+    __stopped: bool = False
+
+    def __init__(
+            self,
+            backend: InputBackend,
+            keypress_duration: float = 0.1,
+            clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        """
+        @param backend: Backend to send input via
+        @param keypress_duration: Seconds keys stay pressed for, unless an action specifies a duration
+        """
+        self.backend = backend
+        self.keypress_duration = keypress_duration
+        self.clock = clock
+        self.__events = []
+        self.__held = {}
+        self.__available_at = {}
+        # Breaks ties between events due at the same time, so they are sent in the order they were scheduled
+        self.__sequence = itertools.count()
+        self.__condition = threading.Condition()
+
+    def start(self) -> None:
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__run, name='input-scheduler', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the input thread, releasing any keys still held. Actions which were deferred and have not been started
+        are dropped, resolving their futures with False (so their redemptions are refunded).
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        with self.__condition:
+            for key in self.__held.keys():
+                self.backend.send(key, False)
+            dropped = [future for (*_, future) in self.__events if future is not None]
+            for future in dropped:
+                future.set_result(False)
+            if len(dropped) > 0:
+                logger.warning(f'Dropped {len(dropped)} deferred actions while stopping')
+            self.__held.clear()
+            self.__available_at.clear()
+            self.__events.clear()
+
+    def get_timeline(self, action: RewardAction) -> List[KeyEvent]:
+        """
+        Get the key events making up a (normalized) action, ordered by offset
+        """
+        duration = action.duration / 1000 if action.duration is not None else self.keypress_duration
+        if action.type is RewardActionType.HOLD:
+            return [(0.0, action.keys[0], True), (duration, action.keys[0], False)]
+        if action.type is RewardActionType.CHORD:
+            return [
+                *[(0.0, key, True) for key in action.keys],
+                *[(duration, key, False) for key in reversed(action.keys)]
+            ]
+        if action.type is RewardActionType.SEQUENCE:
+            # Release keys for as long as they are pressed by default, so repeated keys are recognized as such
+            interval = action.interval / 1000 if action.interval is not None else self.keypress_duration
+            step = self.keypress_duration + interval
+            timeline = []
+            for i, key in enumerate(action.keys):
+                timeline.append((i * step, key, True))
+                timeline.append((i * step + self.keypress_duration, key, False))
+            # Sorting is stable, so a release stays ahead of a press due at the same time
+            return sorted(timeline, key=lambda e: e[0])
+        return [(0.0, action.keys[0], True), (self.keypress_duration, action.keys[0], False)]
+
+    def execute(self, action: RewardAction, delay: float = 0.0, max_delay: Optional[float] = None) -> Optional[Future]:
+        """
+        Press an action's first keys (or schedule them to be pressed, if the action has to be deferred)
+        and schedule the rest of its key events
+        @param delay: Seconds to wait before starting the action
+        @param max_delay: Seconds the action may be deferred for at most (including the delay)
+        @return: Future resolving to whether the first keys were pressed, once they were sent (resolves right away
+                 unless the action was deferred) or None, if the action would have to be deferred for longer
+        """
+        timeline = self.get_timeline(action)
+        started = Future()
+        with self.__condition:
+            now = self.clock()
+            started_at = max([now + delay, *[self.__available_at.get(key, now) for key in action.keys]])
+            if self.__stopped or (max_delay is not None and started_at - now > max_delay):
+                return None
+
+            # Keys pressed/released at the same time are sent together, the first group marks the action's start
+            for i, ((offset, down), events) in enumerate(itertools.groupby(timeline, lambda e: (e[0], e[2]))):
+                keys = tuple(key for (_, key, _) in events)
+                if not down:
+                    # Keep keys released for as long as they would be pressed before using them again
+                    for key in keys:
+                        self.__available_at[key] = started_at + offset + self.keypress_duration
+                future = started if i == 0 else None
+                if started_at + offset <= now:
+                    self.__apply_all(keys, down, future)
+                else:
+                    heapq.heappush(self.__events, (started_at + offset, next(self.__sequence), keys, down, future))
+            self.__condition.notify()
+
+        return started
+
+    def __apply_all(self, keys: Tuple[Key, ...], down: bool, future: Optional[Future]) -> bool:
+        sent = True
+        for key in keys:
+            # Never let a failing backend take down the scheduler thread, else held keys would never be released
+            try:
+                sent = self.__apply(key, down) and sent
+            except Exception as e:
+                logger.error(f'Failed to send input for key {key.name}: {e.__class__.__name__} {e}')
+                sent = False
+        if future is not None:
+            future.set_result(sent)
+        return sent
+
+    def __apply(self, key: Key, down: bool) -> bool:
+        # Keys are reference counted, so a key pressed more than once (e.g. by sequences) is only released at the end
+        held = self.__held.get(key, 0)
+        if down:
+            self.__held[key] = held + 1
+            return self.backend.send(key, True) if held == 0 else True
+        if held > 1:
+            self.__held[key] = held - 1
+            return True
+        self.__held.pop(key, None)
+        return self.backend.send(key, False) if held == 1 else True
+
+    def __run(self) -> None:
+        with self.__condition:
+            while not self.__stopped:
+                if len(self.__events) == 0:
+                    self.__condition.wait()
+                    continue
+                delay = self.__events[0][0] - self.clock()
+                if delay > 0:
+                    self.__condition.wait(delay)
+                    continue
+                _, _, keys, down, future = heapq.heappop(self.__events)
+                if not self.__apply_all(keys, down, future):
+                    logger.error(f'Failed to {"press" if down else "release"} keys '
+                                 f'({", ".join(key.name for key in keys)})')
+
+    def get_held_keys(self) -> List[str]:
+        with self.__condition:
+            return [key.name for key in self.__held.keys()]
@@ -0,0 +1,67 @@
+from typing import NamedTuple, Dict
+
+
+class Key(NamedTuple):
+    """
+    Keyboard key resolved to its (set 1) scan code, as sent to games via SendInput
+    """
+    name: str
+    scan_code: int
+    # Extended keys are sent with an 0xE0 prefix (arrow keys, right ctrl/alt, navigation block...)
+    extended: bool = False
+
+
+# Key names as supported by pydirectinput, plus numpad keys
+_SCAN_CODES = {
+    'escape': 0x01, 'esc': 0x01,
+    'f1': 0x3B, 'f2': 0x3C, 'f3': 0x3D, 'f4': 0x3E, 'f5': 0x3F, 'f6': 0x40,
+    'f7': 0x41, 'f8': 0x42, 'f9': 0x43, 'f10': 0x44, 'f11': 0x57, 'f12': 0x58,
+    'scrolllock': 0x46,
+    '`': 0x29,
+    '1': 0x02, '2': 0x03, '3': 0x04, '4': 0x05, '5': 0x06, '6': 0x07, '7': 0x08, '8': 0x09, '9': 0x0A, '0': 0x0B,
+    '-': 0x0C, '=': 0x0D, 'backspace': 0x0E,
+    'tab': 0x0F,
+    'q': 0x10, 'w': 0x11, 'e': 0x12, 'r': 0x13, 't': 0x14, 'y': 0x15, 'u': 0x16, 'i': 0x17, 'o': 0x18, 'p': 0x19,
+    '[': 0x1A, ']': 0x1B, '\\': 0x2B,
+    'capslock': 0x3A,
+    'a': 0x1E, 's': 0x1F, 'd': 0x20, 'f': 0x21, 'g': 0x22, 'h': 0x23, 'j': 0x24, 'k': 0x25, 'l': 0x26,
+    ';': 0x27, "'": 0x28,
+    'enter': 0x1C, 'return': 0x1C,
+    'shift': 0x2A, 'shiftleft': 0x2A,
+    'z': 0x2C, 'x': 0x2D, 'c': 0x2E, 'v': 0x2F, 'b': 0x30, 'n': 0x31, 'm': 0x32,
+    ',': 0x33, '.': 0x34, '/': 0x35,
+    'shiftright': 0x36,
+    'ctrl': 0x1D, 'ctrlleft': 0x1D,
+    'alt': 0x38, 'altleft': 0x38,
+    ' ': 0x39, 'space': 0x39,
+    'numlock': 0x45,
+    'multiply': 0x37, 'subtract': 0x4A, 'add': 0x4E, 'decimal': 0x53,
+    'num0': 0x52, 'num1': 0x4F, 'num2': 0x50, 'num3': 0x51, 'num4': 0x4B,
+    'num5': 0x4C, 'num6': 0x4D, 'num7': 0x47, 'num8': 0x48, 'num9': 0x49,
+}
+_EXTENDED_SCAN_CODES = {
+    'printscreen': 0x37, 'prntscrn': 0x37, 'prtsc': 0x37, 'prtscr': 0x37,
+    'insert': 0x52, 'home': 0x47, 'pageup': 0x49, 'pagedown': 0x51,
+    'del': 0x53, 'delete': 0x53, 'end': 0x4F,
+    'divide': 0x35,
+    'win': 0x5B, 'winleft': 0x5B, 'winright': 0x5C, 'apps': 0x5D,
+    'altright': 0x38, 'ctrlright': 0x1D,
+    'up': 0x48, 'left': 0x4B, 'down': 0x50, 'right': 0x4D,
+}
+
+KEYS: Dict[str, Key] = {
+    **{name: Key(name, scan_code) for (name, scan_code) in _SCAN_CODES.items()},
+    **{name: Key(name, scan_code, True) for (name, scan_code) in _EXTENDED_SCAN_CODES.items()}
+}
+
+
+def resolve_key(name: str) -> Key:
+    """
+    Resolve a (lowercase) key name to its scan code
+    @raise ValueError: If the key is not known
+    """
+    key = KEYS.get(name)
+    if key is None:
+        raise ValueError(f'Unknown key: "{name}"')
+
+    return key
@@ -1,3 +1,47 @@
+import atexit
+import json
 import logging
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
 logger = logging.getLogger('0xQWERTY')
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, for processing logs with other tools
+    (use by setting a handler's formatter to json in logging.yaml)
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        as_dict = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            as_dict['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(as_dict)
+
+
+def start_queue_listener() -> QueueListener:
+    """
+    Move the root logger's handlers (as configured in logging.yaml) to a separate thread, leaving only a handler that
+    queues records. So logging never blocks the event loop on console or file I/O. Records still queued on exit are
+    written before the process ends.
+    """
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Registered after logging's own exit handler, so this runs first (flushing the queue before handlers are closed)
+    atexit.register(listener.stop)
+    return listener
@@ -1,93 +1,442 @@
+# Imported first to mark the start of the startup profile
+from startupprofiler import StartupProfiler
+
 import argparse
+import asyncio
+import functools
 import logging.config
 import os
-import webbrowser
+import random
+import sqlite3
+import sys
+import time
+import urllib.parse
+from concurrent.futures import Future
 from contextlib import asynccontextmanager
+from typing import Optional, Dict, Set, Awaitable, TYPE_CHECKING
 
-import pydirectinput
 import socketio
 import uvicorn
-from fastapi import FastAPI, Response, status
+from fastapi import FastAPI, Query, Response, status
 from fastapi.requests import Request
 from fastapi.responses import PlainTextResponse, HTMLResponse
-from fastapi.templating import Jinja2Templates
-from oauthlib.oauth2 import MobileApplicationClient
-from requests_oauthlib import OAuth2Session
 
 import config
-from classes import RewardActionType, TokenFromUrlDTO
-from gamedetector import GameDetector
-from logger import logger
+import metrics
+from channel import Channel
+from classes import TokenFromUrlDTO, ClientConfig, Redemption, RedemptionOutcome
+from configwatcher import ConfigWatcher
+from configwriter import ConfigWriter
+from dispatcher import RedemptionDispatcher, ExecutionResult
+from eventsub import EventSubClient
+from gamedetector import GameDetector, StaticWindowTitleProvider
+from helix import HelixClient, HelixError
+from inputbackend import create_input_backend, InputController
+from outbox import StatusOutbox, OutboxEntry
+from logger import logger, start_queue_listener
+from ratelimit import RateLimitDecision
+from redemptioncache import RedemptionCache
 from rewardmanager import RewardManager, RewardManagerError
-from utility import load_client_config, load_logging_config, sleep_sigterm, dump_client_config
+from tracebuffer import TraceBuffer
+from tokencache import CachedToken, load_token_cache, save_token_cache, clear_token_cache
+from windowtracker import ForegroundWindowTracker
+from utility import load_client_config, load_logging_config, get_client_config_path, ClientConfigError
+
+if TYPE_CHECKING:
+    from fastapi.templating import Jinja2Templates
+    from oauthlib.oauth2 import MobileApplicationClient
+
+profiler = StartupProfiler()
+profiler.record('imports', profiler.started_at, time.perf_counter())
 
 parser = argparse.ArgumentParser(
     description='0xQWERTY - Automatically press keys in-game when Twitch viewers redeem channel point rewards'
 )
 parser.add_argument('--version', action='version', version='0xQWERTY-client v1.4.0')
+parser.add_argument('--input-backend', help='How to send keypresses (recording only records them)',
+                    choices=['pydirectinput', 'recording'], default='pydirectinput')
+parser.add_argument('--input-record-path', help='File to write keypresses to when using the recording input backend',
+                    type=str)
+parser.add_argument('--window-title', help='Use a fixed foreground window title instead of the actual one',
+                    type=str)
+parser.add_argument('--transport', help='How to receive redemptions: via the 0xQWERTY API (relay) or directly from '
+                                       'Twitch (eventsub)', choices=['relay', 'eventsub'], default='relay')
+parser.add_argument('--profile-startup', help='Print how long each startup phase took once ready',
+                    dest='profile_startup', action='store_true')
 args = parser.parse_args()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global sio, cc, gameDetector
+    global startup
+
+    # Start up in the background, so the HTTP server gets bound while connecting/authenticating
+    startup = asyncio.create_task(start())
+    startup.add_done_callback(on_startup_done)
+    run_in_background(profiler.measure('http server', wait_until_serving()))
 
-    configured_games = list(set([key for r in cc.rewards for key in r.actions.keys()]))
+    yield
 
-    gameDetector.set_configured_games(configured_games)
+    await stop()
 
-    await sio.connect(config.QWERTY_API_BASE_URL)
-    authorization_url, state = twitch.authorization_url(config.TWITCH_AUTH_BASE_URL)
-    logger.info(f'Opening browser for Twitch authentication ({authorization_url})')
-    webbrowser.open(authorization_url)
 
-    yield
+async def start() -> None:
+    """
+    Load the client config, start handling redemptions and connect to the 0xQWERTY API and Twitch,
+    running any steps which do not depend on each other concurrently
+    """
+    global cc, windowTracker, dispatcher, configWatcher, configWriter, outboxDrainer, lagMonitor, connectionWatchdog
+
+    # Redemptions are only relayed via socket.io when not receiving them from Twitch directly
+    connecting = asyncio.create_task(profiler.measure(
+        'socket.io connect',
+        sio.connect(config.QWERTY_API_BASE_URL)
+    )) if args.transport == 'relay' else None
+
+    try:
+        cc, _ = await asyncio.gather(
+            profiler.measure('client config', asyncio.to_thread(load_client_config)),
+            profiler.measure('outbox', outbox.open())
+        )
+    except ClientConfigError as e:
+        logger.critical(str(e))
+        await shut_down(1)
+        return
+    except (sqlite3.Error, OSError) as e:
+        logger.critical(f'Failed to open status outbox at {outbox.path}: {e}')
+        await shut_down(1)
+        return
+    logger.setLevel(cc.log_level)
 
+    # Every broadcaster gets their own token (and thereby rate limit bucket), but all share one connection pool
+    for login, channel_config in cc.channels.items():
+        channel = channels[login] = Channel(channel_config, helix.create_child())
+        if args.transport == 'eventsub':
+            channel.eventsub = EventSubClient(channel.helix, on_message, record_disconnect, catch_up)
+    index_rewards()
+    authenticating = asyncio.create_task(profiler.measure(
+        'token validation',
+        asyncio.gather(*[authenticate_from_cache(channel) for channel in channels.values()])
+    ))
+
+    with profiler.phase('redemption handling'):
+        gameDetector.set_configured_games(cc.get_configured_games())
+        inputController.start()
+
+        if cc.window_tracker.enabled:
+            windowTracker = ForegroundWindowTracker(
+                gameDetector,
+                interval=cc.window_tracker.interval / 1000,
+                max_staleness=cc.window_tracker.max_staleness / 1000
+            )
+            windowTracker.start()
+
+        outboxDrainer = asyncio.create_task(run_outbox_drainer())
+        dispatcher = RedemptionDispatcher(
+            execute_redemption,
+            settle_redemption,
+            depth=cc.queue.depth,
+            overflow=cc.queue.overflow,
+            status_workers=config.STATUS_WORKERS
+        )
+        dispatcher.start()
+
+        configWatcher = ConfigWatcher(get_client_config_path(), reload_client_config)
+        configWatcher.start()
+        configWriter = ConfigWriter(get_client_config_path(), configWatcher.expect)
+
+        metrics.socketio_connected.set_function(lambda: int(sio.connected))
+        metrics.helix_ratelimit_remaining.set_function(get_helix_ratelimit_remaining)
+        metrics.queue_depth.set_function(lambda: dispatcher.get_stats().depth)
+        lagMonitor = asyncio.create_task(metrics.monitor_event_loop_lag())
+
+    # Load the input backend in the background, rather than when the first redemption comes in
+    run_in_background(asyncio.to_thread(inputController.backend.prepare))
+
+    try:
+        if connecting is not None:
+            await connecting
+            connectionWatchdog = asyncio.create_task(run_connection_watchdog())
+    except socketio.exceptions.ConnectionError as e:
+        logger.critical(f'Failed to connect to 0xqwerty server: {e}')
+        await shut_down(1)
+        return
+
+    authenticated = await authenticating
+    await asyncio.gather(*[
+        complete_setup(channel) for (channel, valid) in zip(channels.values(), authenticated) if valid
+    ])
+    await open_browser_for_authentication()
+
+
+async def shut_down(exit_code: int, seconds: float = 15.0) -> None:
+    """
+    Let uvicorn shut down (and the process exit with the given code), after giving the user some time to read why
+    """
+    global exitCode, shuttingDown
+
+    # Several channels may fail at once, only shut down once
+    if shuttingDown:
+        return
+    shuttingDown = True
+    logger.info(f'Window will close in {seconds} seconds...')
+    await asyncio.sleep(seconds)
+    exitCode = exit_code
+    if server is not None:
+        server.should_exit = True
+
+
+def on_startup_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.critical(f'Startup failed: {task.exception().__class__.__name__} {task.exception()}')
+        run_in_background(shut_down(1))
+
+
+async def stop() -> None:
+    if not startup.done():
+        startup.cancel()
+    await asyncio.gather(startup, return_exceptions=True)
+
+    if configWriter is not None:
+        await configWriter.flush()
+    if configWatcher is not None:
+        await configWatcher.stop()
+    # Stop the watchdog first, else it would reconnect right away
+    if connectionWatchdog is not None:
+        connectionWatchdog.cancel()
     await sio.disconnect()
+    # Stop receiving redemptions before stopping to handle them
+    for channel in channels.values():
+        if channel.eventsub is not None:
+            await channel.eventsub.stop()
+    # Stop input first, so deferred actions are resolved (and their redemptions refunded) before draining
+    inputController.stop()
+    if dispatcher is not None:
+        await dispatcher.stop()
+    if windowTracker is not None:
+        windowTracker.stop()
+    for task in [outboxDrainer, lagMonitor, gapFill, *backgroundTasks]:
+        if task is not None:
+            task.cancel()
+    for channel in channels.values():
+        await channel.status_writer.close()
+    await outbox.close()
+    await helix.close()
+
+
+def run_in_background(coro: Awaitable) -> asyncio.Task:
+    """
+    Run a coroutine without waiting for it, keeping a reference to it until done (the event loop only keeps a weak one,
+    so it could be garbage collected while running otherwise) and logging it if it failed
+    """
+    task = asyncio.create_task(coro)
+    backgroundTasks.add(task)
+    task.add_done_callback(on_background_task_done)
+    return task
 
 
-app = FastAPI(title='0xQWERTY-client', lifespan=lifespan)
-templates = Jinja2Templates(directory=os.path.join(config.ROOT_DIR, 'templates'))
-sio = socketio.AsyncClient(reconnection_attempts=16, logger=True, engineio_logger=True, handle_sigint=False)
+def on_background_task_done(task: asyncio.Task) -> None:
+    backgroundTasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f'Background task failed: {task.exception().__class__.__name__} {task.exception()}')
+
+
+async def wait_until_serving() -> None:
+    # uvicorn only binds once the lifespan startup returned, which does not wait for the background startup
+    while server is not None and not server.started:
+        await asyncio.sleep(0.01)
 
-# Disable pydirectinput failsafe points
-pydirectinput.FAILSAFE = False
 
-broadcaster = {}
-gameDetector = GameDetector()
-rm = RewardManager()
-twitch = OAuth2Session(client=MobileApplicationClient(client_id=config.CLIENT_ID),
-                       redirect_uri=config.REDIRECT_URI, scope=config.SCOPES)
-# Client ID header is not sent by default, so just manually add it to the headers
-twitch.headers['Client-Id'] = config.CLIENT_ID
+@functools.lru_cache(maxsize=1)
+def get_templates() -> 'Jinja2Templates':
+    # Templates are only used for the authentication page, so don't import jinja2 unless that's shown
+    from fastapi.templating import Jinja2Templates
+    return Jinja2Templates(directory=os.path.join(config.ROOT_DIR, 'templates'))
+
+
+@functools.lru_cache(maxsize=1)
+def get_oauth_client() -> 'MobileApplicationClient':
+    # Only needed when authenticating via the browser, not when using a cached token
+    from oauthlib.oauth2 import MobileApplicationClient
+    return MobileApplicationClient(client_id=config.CLIENT_ID)
+
+
+def get_authorization_url(channel: Channel) -> str:
+    """
+    Get the Twitch authorization URL for a channel, the (OAuth) state identifying the channel once redirected back
+    """
+    if channel.auth_state is None:
+        from oauthlib.common import generate_token
+        channel.auth_state = generate_token()
+
+    kwargs = {}
+    if cc.is_multi_broadcaster():
+        # Make Twitch ask which account to use, rather than silently authorizing whoever is logged in
+        kwargs['force_verify'] = 'true'
+    return get_oauth_client().prepare_request_uri(
+        config.TWITCH_AUTH_BASE_URL,
+        redirect_uri=config.REDIRECT_URI,
+        scope=config.SCOPES,
+        state=channel.auth_state,
+        **kwargs
+    )
+
+
+def get_helix_ratelimit_remaining() -> Optional[int]:
+    remaining = [r for c in channels.values() if (r := c.helix.scheduler.get_remaining()) is not None]
+    return min(remaining) if len(remaining) > 0 else None
+
+
+def index_rewards() -> None:
+    """
+    Map reward ids to the channel they belong to (needs to be called whenever reward ids change)
+    """
+    global channelsByRewardId
+    channelsByRewardId = {
+        reward_id: channel for channel in channels.values() for reward_id in channel.config.dispatch_table.keys()
+    }
+
+
+app = FastAPI(title='0xQWERTY-client', lifespan=lifespan)
+# Passing loggers (rather than True) leaves their levels to logging.yaml and keeps the libraries from adding handlers.
+# Reconnecting is left to the connection watchdog, which (unlike socket.io's own reconnection) never gives up.
+sio = socketio.AsyncClient(reconnection=False, logger=logging.getLogger('socketio.client'),
+                           engineio_logger=logging.getLogger('engineio.client'), handle_sigint=False)
+server: Optional[uvicorn.Server] = None
+# Set when shutting down due to an error
+exitCode = 0
+shuttingDown = False
+
+cc: ClientConfig
+startup: asyncio.Task
+# Keyed by configured broadcaster login (None if not running in multi-broadcaster mode)
+channels: Dict[Optional[str], Channel] = {}
+# Authenticated channels, keyed by broadcaster id
+channelsById: Dict[str, Channel] = {}
+channelsByRewardId: Dict[str, Channel] = {}
+dispatcher: Optional[RedemptionDispatcher] = None
+configWatcher: Optional[ConfigWatcher] = None
+configWriter: Optional[ConfigWriter] = None
+outbox = StatusOutbox(config.OUTBOX_PATH)
+outboxDrainer: Optional[asyncio.Task] = None
+lagMonitor: Optional[asyncio.Task] = None
+# Held while replaying pending status updates, so only one replay runs at a time
+outboxLock = asyncio.Lock()
+startedAt = time.time()
+connectedBefore = False
+connectionWatchdog: Optional[asyncio.Task] = None
+# Set on disconnect, so the watchdog does not need to wait for its next check to reconnect
+connectionLost = asyncio.Event()
+# Unix time the connection was lost at, if redemptions made since have not been fetched from Twitch yet
+disconnectedAt: Optional[float] = None
+gapFill: Optional[asyncio.Task] = None
+# Tasks started by run_in_background which are not done yet
+backgroundTasks: Set[asyncio.Task] = set()
+# Held while fetching missed redemptions, so only one gap fill runs at a time
+gapFillLock = asyncio.Lock()
+# Held while rewards are being set up on Twitch, so setup and config reloads don't interfere
+configLock = asyncio.Lock()
+gameDetector = GameDetector(StaticWindowTitleProvider(args.window_title)) \
+    if args.window_title is not None else GameDetector()
+inputController = InputController(
+    create_input_backend(args.input_backend, args.input_record_path),
+    keypress_duration=config.KEYPRESS_DURATION
+)
+windowTracker: Optional[ForegroundWindowTracker] = None
+redemptionCache = RedemptionCache(config.REDEMPTION_CACHE_TTL, config.REDEMPTION_CACHE_MAX_SIZE)
+traces = TraceBuffer(config.TRACE_BUFFER_SIZE)
+# Only used for its connection pool, each channel uses a child client with their own token
+helix = HelixClient(config.CLIENT_ID)
 
 
 @app.get('/s/auth-callback', response_class=HTMLResponse)
 async def render_page(request: Request):
-    return templates.TemplateResponse('auth-callback.html',
-                                      {'request': request, 'app_name': app.title, 'base_url': config.BASE_URL})
+    return get_templates().TemplateResponse('auth-callback.html',
+                                            {'request': request, 'app_name': app.title, 'base_url': config.BASE_URL})
 
 
 @app.get('/a/auth-url', response_class=PlainTextResponse)
-async def auth_url():
-    authorization_url, state = twitch.authorization_url(config.TWITCH_AUTH_BASE_URL)
-    return authorization_url
+async def auth_url(state: Optional[str] = None):
+    # Retry authenticating the channel the failed attempt was for, else continue with the next one
+    channel = next((c for c in channels.values() if state is not None and c.auth_state == state), None) or \
+        next((c for c in channels.values() if c.get_broadcaster_id() is None), None) or \
+        next(iter(channels.values()), None)
+    if channel is None:
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    return get_authorization_url(channel)
+
+
+@app.get('/metrics')
+async def get_metrics():
+    return Response(content=metrics.render_metrics(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.get('/a/queue-stats')
+async def queue_stats():
+    if dispatcher is None:
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    # Stats are tracked per channel, so sum them up
+    status_updates = [c.status_writer.get_stats() for c in channels.values()]
+    helix_stats = [c.helix.get_stats() for c in channels.values()]
+    requests = sum(s['requests'] for s in status_updates)
+    updates = sum(s['updates'] for s in status_updates)
+    return {
+        **dispatcher.get_stats().to_dict(),
+        'statusUpdates': {
+            'requests': requests,
+            'updates': updates,
+            'updatesPerRequest': updates / requests if requests > 0 else None
+        },
+        'deduplication': redemptionCache.get_stats(),
+        'helix': {
+            'rateLimitRemaining': get_helix_ratelimit_remaining(),
+            'throttled': sum(s['throttled'] for s in helix_stats),
+            'retried': sum(s['retried'] for s in helix_stats)
+        }
+    }
+
+
+@app.get('/a/redemptions/recent')
+async def recent_redemptions(
+        reward_id: Optional[str] = None,
+        outcome: Optional[RedemptionOutcome] = None,
+        limit: int = Query(default=50, ge=1, le=config.TRACE_BUFFER_SIZE)
+):
+    return [trace.to_dict() for trace in traces.get_recent(limit, reward_id, outcome)]
 
 
 @app.post('/a/token-from-url', status_code=status.HTTP_204_NO_CONTENT)
 async def auth(dto: TokenFromUrlDTO, response: Response):
-    global broadcaster
+    # The state tells which channel the token is for (several may be authenticated one after another)
+    state = urllib.parse.parse_qs(urllib.parse.urlparse(dto.url).fragment).get('state', [None])[0]
+    channel = next((c for c in channels.values() if state is not None and c.auth_state == state), None)
 
     # Try to store and use token
-    token_valid = True
+    token_valid = channel is not None
     try:
-        twitch.token_from_fragment(dto.url)
-        resp = twitch.get('https://api.twitch.tv/helix/users')
-        if resp.ok:
-            parsed = resp.json()
-            broadcaster = parsed['data'][0]
-        elif resp.status_code == 401:
-            token_valid = False
+        if channel is not None:
+            token = get_oauth_client().parse_request_uri_response(dto.url, state=channel.auth_state)
+            channel.helix.set_token(token['access_token'])
+            resp = await channel.helix.get('users')
+            if resp.ok:
+                parsed = resp.json()
+                user = parsed['data'][0]
+                if channel.is_expected_broadcaster(user.get('login')):
+                    channel.set_broadcaster(user)
+                    channel.auth_state = None
+                    await asyncio.to_thread(save_token_cache, channel.token_cache_path, CachedToken(
+                        access_token=token['access_token'],
+                        expires_at=token.get('expires_at'),
+                        broadcaster=user
+                    ))
+                else:
+                    logger.error(f'Authenticated as {user.get("login")} instead of {channel.config.login}, '
+                                 f'please log in to Twitch as {channel.config.login}')
+                    token_valid = False
+            else:
+                token_valid = False
     except Exception as e:
         logger.error(f'Failed to get current user from Twitch API: {e}')
         token_valid = False
@@ -96,73 +445,495 @@ async def auth(dto: TokenFromUrlDTO, response: Response):
         response.status_code = status.HTTP_401_UNAUTHORIZED
         return
 
-    await sio.emit('join', f'streamer:{broadcaster["login"]}')
+    await complete_setup(channel)
+    await open_browser_for_authentication()
 
-    # Complete reward manager configuration
-    rm.set_broadcaster_id(broadcaster["id"])
-    rm.set_session(twitch)
 
-    modified = False
-    try:
-        modified = rm.setup_rewards(cc.rewards)
-    except RewardManagerError as e:
-        logger.critical(str(e))
-        sleep_sigterm()
+async def open_browser_for_authentication() -> None:
+    """
+    Open the browser for Twitch authentication of the first channel not authenticated yet
+    (one at a time, since the user needs to log in to Twitch as each broadcaster in turn)
+    """
+    channel = next((c for c in channels.values() if c.get_broadcaster_id() is None), None)
+    if channel is None:
+        return
+
+    import webbrowser
+    # Browser redirects back to the auth callback page, so make sure it's being served
+    await wait_until_serving()
+    authorization_url = get_authorization_url(channel)
+    logger.info(f'Opening browser for Twitch authentication of {channel.name} ({authorization_url})')
+    webbrowser.open(authorization_url)
 
-    if modified:
-        dump_client_config(cc)
 
-    # Run subscription setup separately so errors here don't stop us from updating the client config
+async def authenticate_from_cache(channel: Channel) -> bool:
+    """
+    Use the channel's cached token and broadcaster, if the token is still valid
+    @return: Whether the cached token can be used
+    """
+    cached = await asyncio.to_thread(load_token_cache, channel.token_cache_path)
+    if cached is None or cached.is_expired() or not channel.is_expected_broadcaster(cached.broadcaster.get('login')):
+        return False
+
     try:
-        rm.subscribe_to_redemptions()
-    except RewardManagerError as e:
-        logger.critical(str(e))
-        sleep_sigterm()
+        validated = await channel.helix.validate_token(cached.access_token)
+    except HelixError as e:
+        logger.warning(f'Failed to validate cached Twitch token: {e}')
+        return False
+
+    if validated is None or validated.get('user_id') != cached.broadcaster.get('id') or \
+            not all(scope in validated.get('scopes', []) for scope in config.SCOPES):
+        logger.info('Cached Twitch token is no longer valid')
+        await asyncio.to_thread(clear_token_cache, channel.token_cache_path)
+        return False
+
+    channel.helix.set_token(cached.access_token)
+    channel.set_broadcaster(cached.broadcaster)
+    logger.info(f'Using cached Twitch token for {channel.name}')
+    return True
+
+
+async def complete_setup(channel: Channel) -> None:
+    """
+    Join the broadcaster's redemption room (unless using EventSub) and set up their rewards
+    (requires broadcaster and token to be set)
+    """
+    channelsById[channel.get_broadcaster_id()] = channel
+    if channel.eventsub is None:
+        await sio.emit('join', f'streamer:{channel.broadcaster["login"]}')
+
+    async with configLock:
+        try:
+            result = await profiler.measure(f'reward setup ({channel.name})', channel.rm.setup_rewards(
+                channel.config.rewards
+            ))
+        except RewardManagerError as e:
+            logger.critical(str(e))
+            # Don't hold up setup of other channels (or the auth callback) while waiting to shut down
+            run_in_background(shut_down(1))
+            return
+
+        if result.modified:
+            cc.build_dispatch_table()
+            index_rewards()
+            channel.update_rate_limiter()
+            configWriter.schedule(cc)
+
+        # Run subscription setup separately so errors here don't stop us from updating the client config
+        try:
+            await channel.subscribe_to_redemptions(result.reward_ids)
+        except RewardManagerError as e:
+            logger.critical(str(e))
+            run_in_background(shut_down(1))
+            return
+
+    channel.ready = True
+    logger.info(f'Setup complete, listening for redemptions of {channel.name}')
+    if all(c.ready for c in channels.values()) and profiler.mark_ready() and args.profile_startup:
+        print(profiler.format())
 
-    logger.info('Setup complete, listening for redemptions')
+    # Replay any status updates which were not sent before the client last stopped
+    run_in_background(drain_outbox(older_than=startedAt))
+
+
+async def reload_client_config(new_cc: ClientConfig) -> None:
+    """
+    Apply a changed client config, only updating rewards on Twitch that actually changed
+    """
+    global cc
+
+    async with configLock:
+        previous_cc = cc
+        if new_cc.channels.keys() != previous_cc.channels.keys():
+            logger.error('Adding or removing broadcasters requires a restart, keeping current config')
+            return
+
+        modified = False
+        for login, channel in channels.items():
+            # Rewards can only be reconciled once the broadcaster is known, else the initial setup will take care of it
+            if channel.get_broadcaster_id() is not None:
+                try:
+                    modified = await channel.rm.reconcile_rewards(
+                        previous_cc.channels[login].rewards,
+                        new_cc.channels[login].rewards
+                    ) or modified
+                except RewardManagerError as e:
+                    logger.error(f'Failed to apply changed rewards of {channel.name}, keeping current config: {e}')
+                    return
+
+        new_cc.build_dispatch_table()
+        gameDetector.set_configured_games(new_cc.get_configured_games())
+        # Redemptions hold on to the config they were received with, so swapping the reference is all it takes
+        for login, channel in channels.items():
+            channel.update_config(new_cc.channels[login])
+        cc = new_cc
+        index_rewards()
+        logger.setLevel(new_cc.log_level)
+
+        # Only the maximum key wait is read per redemption
+        if (new_cc.queue.depth, new_cc.queue.overflow) != (previous_cc.queue.depth, previous_cc.queue.overflow) or \
+                new_cc.window_tracker != previous_cc.window_tracker:
+            logger.warning('Changed queue/window tracker settings will only take effect after a restart')
+
+        if modified:
+            configWriter.schedule(new_cc)
+
+        for login, channel in channels.items():
+            if channel.get_broadcaster_id() is not None and \
+                    new_cc.channels[login].dispatch_table.keys() != previous_cc.channels[login].dispatch_table.keys():
+                try:
+                    await channel.subscribe_to_redemptions()
+                except RewardManagerError as e:
+                    logger.error(str(e))
+
+        logger.info('Client config reloaded')
 
 
 @sio.event
 async def connect():
+    global connectedBefore
+
     logger.info('Connection to socket.io server established')
+    reconnected = connectedBefore
+    connectedBefore = True
+    if not reconnected:
+        return
+
+    metrics.socketio_reconnects.inc()
+    # Rejoin redemption announcement rooms of channels already set up (initial join is part of the setup)
+    for channel in [c for c in channels.values() if c.ready]:
+        await sio.emit('join', f'streamer:{channel.broadcaster["login"]}')
+    catch_up()
+
+
+def catch_up() -> None:
+    """
+    Catch up on anything missed while disconnected, once reconnected (to the 0xQWERTY API or Twitch EventSub)
+    """
+    if any(channel.ready for channel in channels.values()):
+        # Twitch may have been unreachable as well, so try sending pending status updates again
+        run_in_background(drain_outbox())
+        start_gap_fill()
+
+
+def record_disconnect() -> None:
+    """
+    Remember since when redemptions may have been missed, keeping the earlier time if the connection was lost again
+    before catching up
+    """
+    global disconnectedAt
+
+    if disconnectedAt is None:
+        disconnectedAt = time.time()
 
-    # Rejoin redemption announcement room if broadcaster is already set
-    if broadcaster.get('login') is not None:
-        await sio.emit('join', f'streamer:{broadcaster["login"]}')
+
+def get_redemption_channel(data: dict) -> Optional[Channel]:
+    """
+    Find the channel a redemption belongs to, by broadcaster if known, else by reward
+    """
+    channel = channelsById.get(data.get('broadcaster_user_id') or data.get('broadcaster_id'))
+    if channel is None:
+        channel = channelsByRewardId.get(data.get('reward_id'))
+    if channel is None and not cc.is_multi_broadcaster():
+        channel = channels.get(None)
+    return channel
 
 
 @sio.on('redemption')
 async def on_message(data):
-    logger.debug('Received channel point redemption', data)
+    # Arguments are only formatted if debug logging is enabled
+    logger.debug('Received channel point redemption: %s', data)
+    receive_redemption(data)
+
+
+def receive_redemption(data: dict, expired: bool = False) -> bool:
+    """
+    Hand a redemption over to the dispatcher (unless it was received before)
+    @param expired: Whether the redemption was made too long ago to still take action (it will only be refunded)
+    @return: Whether the redemption was new
+    """
+    channel = get_redemption_channel(data)
+    if channel is None or channel.get_broadcaster_id() is None:
+        logger.info('Received redemption for unknown broadcaster, skipping')
+        return False
+
+    redemption = Redemption(
+        id=data.get('id'),
+        reward_id=data.get('reward_id'),
+        broadcaster_id=channel.get_broadcaster_id(),
+        config=channel.config,
+        received_at=time.perf_counter(),
+        data=data
+    )
+    if redemptionCache.check_and_add(redemption.id):
+        logger.info('Received duplicate redemption, skipping (%s)', redemption.id)
+        return False
+
+    if redemption.config.get_actions(redemption.reward_id) is None:
+        logger.info('Received redemption of unknown reward, skipping')
+        redemption.outcome = RedemptionOutcome.SKIPPED
+        dispatcher.reject(redemption)
+    elif expired:
+        logger.info('Received redemption too late to take action, refunding (%s)', redemption.id)
+        redemption.outcome = RedemptionOutcome.EXPIRED
+        dispatcher.reject(redemption)
+    else:
+        dispatcher.submit(redemption)
+
+    return True
+
+
+def execute_redemption(redemption: Redemption) -> ExecutionResult:
+    """
+    Take action for a redemption if the relevant game is active (runs on the dispatcher's input thread)
+    @return: Whether action was taken, or a future resolving to it once a deferred action was started
+    """
+    redemption.dequeued_at = time.perf_counter()
     fulfilled = False
-    redemption_id = data.get('id')
-    reward_id = data.get('reward_id')
-    reward = next((r for r in cc.rewards if r.id == reward_id), None)
-    active_game = gameDetector.get_active_game()
-    if reward is not None and active_game is not None:
-        action = reward.actions.get(active_game)
-        if action is not None and action.type is RewardActionType.KEYPRESS:
-            logger.info(f'Pressing key for reward redemption ({action.value})')
-            fulfilled = pydirectinput.press([str(action.value)])
-            if not fulfilled:
-                logger.error('Keypress failed')
-    elif reward is not None and active_game is None:
+    actions = redemption.config.get_actions(redemption.reward_id)
+    if actions is None:
+        redemption.outcome = RedemptionOutcome.SKIPPED
+        return fulfilled
+
+    if windowTracker is not None:
+        snapshot = windowTracker.get_current_snapshot()
+        window_title, active_game = snapshot.title, snapshot.game
+    else:
+        window_title = gameDetector.get_active_window_title()
+        active_game = gameDetector.match_game(window_title)
+    redemption.detected_at = time.perf_counter()
+    redemption.window_title = window_title
+    redemption.game = active_game
+    redemption.outcome = RedemptionOutcome.SKIPPED
+    if active_game is not None:
+        action = redemption.action = actions.get(active_game)
+        rate_limiter = channelsById[redemption.broadcaster_id].rate_limiter
+        decision, delay = rate_limiter.acquire(redemption.reward_id) if action is not None else (None, 0.0)
+        redemption.rate_limit = decision.value if decision is not None else None
+        if decision is RateLimitDecision.COALESCE:
+            logger.info('Reward redemption is over rate limit, coalescing with previous keypress')
+            fulfilled = True
+            redemption.outcome = RedemptionOutcome.FULFILLED
+        elif decision is RateLimitDecision.REFUND:
+            logger.info('Reward redemption is over rate limit, skipping')
+            redemption.outcome = RedemptionOutcome.REFUNDED
+        elif action is not None:
+            if decision is RateLimitDecision.QUEUE:
+                logger.info('Reward redemption is over rate limit, delaying keypress by %d ms', delay * 1000)
+            logger.info('Taking %s action for reward redemption (%s)', action.type.value, action.value)
+            # Queued keypresses are scheduled rather than waited for, so the input thread can move on
+            max_key_wait = cc.queue.max_key_wait
+            started = inputController.execute(
+                action,
+                delay,
+                delay + max_key_wait / 1000 if max_key_wait is not None else None
+            )
+            if started is None:
+                logger.info('Keys are still in use by earlier actions for longer than maxKeyWait, refunding')
+                redemption.outcome = RedemptionOutcome.REFUNDED
+                return fulfilled
+
+            def on_started(future: Future) -> None:
+                redemption.pressed_at = time.perf_counter()
+                redemption.outcome = RedemptionOutcome.FULFILLED if future.result() else RedemptionOutcome.FAILED
+                if not future.result():
+                    logger.error('Keypress failed')
+
+            started.add_done_callback(on_started)
+            return started
+    else:
         logger.info('Received redemption while game window was not active, skipping')
 
+    return fulfilled
+
+
+async def settle_redemption(redemption: Redemption, fulfilled: bool) -> None:
     """
     If auto fulfilling/refunding is enabled or no action was taken, update redemption status via Twitch API to
     a) fulfilled, if action was triggered and refunding is not forced
     b) canceled, if no action was taken or refunding is forced (will refund points to user)
     """
-    if cc.auto_fulfill or cc.refund or not fulfilled:
+    rc = redemption.config
+    if redemption.outcome is None:
+        # Redemption was neither processed nor rejected (queue overflow)
+        redemption.outcome = RedemptionOutcome.REFUNDED
+    elif redemption.outcome is RedemptionOutcome.FULFILLED and rc.refund:
+        redemption.outcome = RedemptionOutcome.REFUNDED
+
+    status_started_at = None
+    status = updated = error = None
+    if rc.auto_fulfill or rc.refund or not fulfilled:
+        status_started_at = time.perf_counter()
+        status_fulfilled = fulfilled and not rc.refund
+        status = 'FULFILLED' if status_fulfilled else 'CANCELED'
+        # Record decision first, so the update is not lost if it cannot be sent right now
+        await outbox.append(redemption.id, redemption.reward_id, status_fulfilled, redemption.broadcaster_id)
         try:
-            rm.update_redemption_status(
-                redemption_id,
-                reward_id,
-                fulfilled and not cc.refund
+            updated = await channelsById[redemption.broadcaster_id].status_writer.submit(
+                redemption.id,
+                redemption.reward_id,
+                status_fulfilled
             )
+            await outbox.complete([redemption.id])
+            if not updated:
+                logger.error(f'Twitch did not update reward redemption status ({redemption.id})')
+                redemption.outcome = RedemptionOutcome.FAILED
+        except RewardManagerError as e:
+            if e.is_retryable():
+                logger.error(f'{e}, will retry later')
+            else:
+                logger.error(f'{e}, giving up ({redemption.id})')
+                await outbox.fail([redemption.id])
+            redemption.outcome = RedemptionOutcome.FAILED
+            error = str(e)
+
+    settled_at = time.perf_counter()
+    metrics.observe_redemption(redemption, status_started_at, settled_at)
+    traces.add(redemption, status, updated, error, status_started_at, settled_at)
+
+
+async def run_outbox_drainer() -> None:
+    while True:
+        await asyncio.sleep(config.OUTBOX_DRAIN_INTERVAL)
+        if any(channel.ready for channel in channels.values()):
+            await drain_outbox()
+
+
+async def drain_outbox(older_than: Optional[float] = None) -> None:
+    """
+    Send pending status updates of all channels set up in batches (and compact the outbox afterwards)
+    @param older_than: Only send updates decided on before this (unix) time, defaults to any not likely in flight
+    """
+    if outboxLock.locked():
+        return
+
+    async def replay(channel: Channel, entry: OutboxEntry) -> Optional[bool]:
+        """
+        @return: Whether the update was sent, False if it was given up on or None, if it should be retried later
+        """
+        try:
+            updated = await channel.status_writer.submit(entry.redemption_id, entry.reward_id, entry.fulfilled)
+            traces.record_retry(entry.redemption_id, updated)
+            if not updated:
+                logger.warning(f'Twitch did not update reward redemption status ({entry.redemption_id})')
+            return True
         except RewardManagerError as e:
-            logger.error(str(e))
+            traces.record_retry(entry.redemption_id, None, str(e))
+            if not e.is_retryable() or entry.attempts + 1 >= config.OUTBOX_MAX_ATTEMPTS or \
+                    entry.created_at < time.time() - config.OUTBOX_MAX_AGE:
+                logger.warning(f'{e}, giving up ({entry.redemption_id})')
+                return False
+            return None
+
+    async with outboxLock:
+        if older_than is None:
+            older_than = time.time() - config.OUTBOX_REPLAY_DELAY
+        try:
+            replayed = 0
+            for channel in [c for c in channels.values() if c.ready]:
+                # Updates recorded before multi-broadcaster support can only belong to the one broadcaster
+                while len(entries := await outbox.get_pending(
+                        config.OUTBOX_DRAIN_BATCH_SIZE,
+                        channel.get_broadcaster_id(),
+                        older_than,
+                        include_unassigned=not cc.is_multi_broadcaster()
+                )) > 0:
+                    results = await asyncio.gather(*[replay(channel, e) for e in entries])
+                    sent = [e.redemption_id for (e, r) in zip(entries, results) if r is True]
+                    failed = [e.redemption_id for (e, r) in zip(entries, results) if r is False]
+                    retried = [e.redemption_id for (e, r) in zip(entries, results) if r is None]
+                    await outbox.complete(sent)
+                    await outbox.fail(failed)
+                    await outbox.record_attempts(retried)
+                    replayed += len(sent)
+                    if len(retried) > 0:
+                        logger.warning(f'Failed to send some pending status updates of {channel.name}, '
+                                       f'will retry later')
+                        break
+            if replayed > 0:
+                logger.info(f'Sent {replayed} pending reward redemption status updates')
+            await outbox.compact()
+        except Exception as e:
+            logger.error(f'Failed to send pending status updates: {e}')
+
+
+def start_gap_fill() -> None:
+    global gapFill
+    gapFill = asyncio.create_task(fill_gap())
+
+
+async def fill_gap() -> None:
+    """
+    Fetch redemptions made while disconnected from Twitch and handle any not received yet, taking action on recent ones
+    and refunding older ones. Runs in the background, so redemptions received in the meantime are handled as usual.
+    Gives up after a while, trying again after the next reconnect.
+    """
+    global disconnectedAt
+
+    async with gapFillLock:
+        if disconnectedAt is None:
+            return
+        since = disconnectedAt
+        disconnectedAt = None
+
+        semaphore = asyncio.Semaphore(config.GAP_FILL_CONCURRENCY)
+        received = 0
+
+        async def fetch(channel: Channel, reward_id: str) -> None:
+            nonlocal received
+            async with semaphore:
+                redemptions = await channel.rm.get_unfulfilled_redemptions(
+                    reward_id,
+                    since - config.GAP_FILL_MARGIN
+                )
+
+            # Hand over as soon as fetched, so redemptions are not held back by other rewards' (or a timeout)
+            now = time.time()
+            for data in redemptions:
+                expired = now - RewardManager.get_redeemed_at(data) > config.GAP_FILL_MAX_AGE
+                if receive_redemption({**data, 'reward_id': reward_id}, expired):
+                    received += 1
+                    metrics.gap_filled_redemptions.inc()
+
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*[
+                fetch(channel, reward_id)
+                for channel in channels.values() if channel.ready
+                for reward_id in channel.config.dispatch_table.keys()
+            ], return_exceptions=True), config.GAP_FILL_TIMEOUT)
+            errors = [r for r in results if isinstance(r, Exception)]
+            if len(errors) > 0:
+                raise RewardManagerError(f'{len(errors)} requests failed: {errors[0]}')
+            if received > 0:
+                logger.info(f'Caught up on {received} redemptions made while disconnected')
+        except (RewardManagerError, asyncio.TimeoutError) as e:
+            logger.error(f'Failed to catch up on redemptions made while disconnected, will retry after next '
+                         f'reconnect: {e.__class__.__name__} {e}')
+            disconnectedAt = since if disconnectedAt is None else min(since, disconnectedAt)
+
+
+async def run_connection_watchdog() -> None:
+    """
+    Keep the connection to the 0xQWERTY API up, reconnecting with jittered exponential backoff for however long it takes
+    """
+    attempt = 0
+    while True:
+        if sio.connected:
+            attempt = 0
+            try:
+                await asyncio.wait_for(connectionLost.wait(), config.SOCKETIO_WATCHDOG_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            connectionLost.clear()
+            continue
+
+        delay = random.uniform(0, min(config.SOCKETIO_BACKOFF_BASE * 2 ** attempt, config.SOCKETIO_BACKOFF_MAX))
+        attempt += 1
+        await asyncio.sleep(delay)
+        try:
+            await sio.connect(config.QWERTY_API_BASE_URL)
+        except socketio.exceptions.ConnectionError as e:
+            logger.warning(f'Failed to reconnect to 0xqwerty server (attempt {attempt}): {e}')
 
 
 @sio.event
@@ -173,19 +944,23 @@ def connect_error(data):
 @sio.event
 async def disconnect():
     logger.warning('Disconnected from 0xqwerty server')
+    record_disconnect()
+    connectionLost.set()
 
 
 if __name__ == '__main__':
-    lc = load_logging_config()
-    logging.config.dictConfig(lc)
+    with profiler.phase('logging config'):
+        lc = load_logging_config()
+        logging.config.dictConfig(lc)
+        start_queue_listener()
 
-    cc = load_client_config()
-
-    logger.setLevel(cc.log_level)
-
-    uvicorn.run(
+    # Client config is loaded as part of the (concurrent) startup
+    server = uvicorn.Server(uvicorn.Config(
         app,
         host=config.LISTEN_ADDR,
         port=config.LISTEN_PORT,
-        log_config=lc
-    )
+        # Logging is configured already, applying the config again would replace the queue handler
+        log_config=None
+    ))
+    server.run()
+    sys.exit(exitCode)
@@ -0,0 +1,256 @@
+import abc
+import asyncio
+import bisect
+import math
+import time
+from typing import Tuple, Dict, List, Callable, Optional, Iterable
+
+from classes import Redemption, RedemptionOutcome
+
+LabelValues = Tuple[str, ...]
+# Name suffix, label values, extra label (e.g. a histogram bucket's bound) and value
+Sample = Tuple[str, LabelValues, str, float]
+
+# Latency buckets (seconds), from sub-millisecond keypresses to slow Twitch API calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(abc.ABC):
+    """
+    Minimal Prometheus style metric, rendered in the text exposition format
+    (see https://prometheus.io/docs/instrumenting/exposition_formats/)
+    """
+    type: str
+    name: str
+    documentation: str
+    label_names: Tuple[str, ...]
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        REGISTRY.append(self)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[Sample]:
+        ...
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{self.format_labels(label_values, extra)} {format_value(value)}')
+        return '\n'.join(lines)
+
+    def format_labels(self, label_values: LabelValues, extra: str = '') -> str:
+        pairs = [f'{name}="{value}"' for (name, value) in zip(self.label_names, label_values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class CounterChild:
+    __slots__ = ['value']
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    __children: Dict[LabelValues, CounterChild]
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self.__children = {}
+        # Report metrics without labels right away, even if they were never updated
+        if len(label_names) == 0:
+            self.labels()
+
+    def labels(self, *label_values: str) -> CounterChild:
+        """
+        Get the counter for the given label values (keep a reference to it on hot paths)
+        """
+        child = self.__children.get(label_values)
+        if child is None:
+            child = self.__children.setdefault(label_values, CounterChild())
+        return child
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> Iterable[Sample]:
+        return [('_total', label_values, '', child.value) for (label_values, child) in self.__children.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge reporting either a set value or the result of a function evaluated at scrape time
+    """
+    type = 'gauge'
+
+    function: Optional[Callable[[], Optional[float]]]
+
+    __value: float = 0.0
+
+    def __init__(self, name: str, documentation: str,
+                 function: Optional[Callable[[], Optional[float]]] = None) -> None:
+        super().__init__(name, documentation)
+        self.function = function
+
+    def set(self, value: float) -> None:
+        self.__value = value
+
+    def set_function(self, function: Callable[[], Optional[float]]) -> None:
+        self.function = function
+
+    def samples(self) -> Iterable[Sample]:
+        value = self.function() if self.function is not None else self.__value
+        return [('', (), '', value)] if value is not None else []
+
+
+class HistogramChild:
+    __slots__ = ['bounds', 'counts', 'sum']
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        # One count per bucket plus the implicit +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    buckets: Tuple[float, ...]
+
+    __children: Dict[LabelValues, HistogramChild]
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.__children = {}
+        if len(label_names) == 0:
+            self.labels()
+
+    def labels(self, *label_values: str) -> HistogramChild:
+        """
+        Get the histogram for the given label values (keep a reference to it on hot paths)
+        """
+        child = self.__children.get(label_values)
+        if child is None:
+            child = self.__children.setdefault(label_values, HistogramChild(self.buckets))
+        return child
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def samples(self) -> Iterable[Sample]:
+        samples = []
+        for label_values, child in self.__children.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), child.counts):
+                cumulative += count
+                samples.append(('_bucket', label_values, f'le="{format_value(bound)}"', cumulative))
+            samples.append(('_sum', label_values, '', child.sum))
+            samples.append(('_count', label_values, '', cumulative))
+        return samples
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_metrics() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+redemption_stage_seconds = Histogram(
+    'qwerty_redemption_stage_seconds',
+    'Time spent per redemption handling stage',
+    ('stage',)
+)
+redemption_seconds = Histogram(
+    'qwerty_redemption_seconds',
+    'Time from receiving a redemption to its status being settled'
+)
+redemptions = Counter(
+    'qwerty_redemptions',
+    'Handled redemptions by outcome',
+    ('outcome',)
+)
+socketio_connected = Gauge(
+    'qwerty_socketio_connected',
+    'Whether the connection to the 0xQWERTY socket.io server is established'
+)
+socketio_reconnects = Counter(
+    'qwerty_socketio_reconnects',
+    'Number of times the connection to the 0xQWERTY socket.io server was re-established'
+)
+gap_filled_redemptions = Counter(
+    'qwerty_gap_filled_redemptions',
+    'Number of redemptions made while disconnected which were fetched from Twitch after reconnecting'
+)
+eventsub_reconnects = Counter(
+    'qwerty_eventsub_reconnects',
+    'Number of times the connection to Twitch EventSub was lost and had to be re-established'
+)
+helix_ratelimit_remaining = Gauge(
+    'qwerty_helix_ratelimit_remaining',
+    'Requests left in the current Twitch Helix rate limit bucket'
+)
+queue_depth = Gauge(
+    'qwerty_queue_depth',
+    'Number of redemptions waiting to be processed'
+)
+event_loop_lag_seconds = Gauge(
+    'qwerty_event_loop_lag_seconds',
+    'Most recently measured delay of the event loop'
+)
+
+# Bind labelled children once, so recording a redemption only costs a few attribute lookups and list updates
+_queue_stage = redemption_stage_seconds.labels('queue')
+_detection_stage = redemption_stage_seconds.labels('detection')
+_keypress_stage = redemption_stage_seconds.labels('keypress')
+_status_stage = redemption_stage_seconds.labels('status')
+_outcomes = {outcome: redemptions.labels(outcome.value) for outcome in RedemptionOutcome}
+
+
+def observe_redemption(redemption: Redemption, status_started_at: Optional[float], settled_at: float) -> None:
+    """
+    Record stage timings and outcome of a settled redemption (timestamps are time.perf_counter() values)
+    """
+    if redemption.dequeued_at is not None:
+        _queue_stage.observe(redemption.dequeued_at - redemption.received_at)
+        if redemption.detected_at is not None:
+            _detection_stage.observe(redemption.detected_at - redemption.dequeued_at)
+            if redemption.pressed_at is not None:
+                _keypress_stage.observe(redemption.pressed_at - redemption.detected_at)
+    if status_started_at is not None:
+        _status_stage.observe(settled_at - status_started_at)
+    redemption_seconds.observe(settled_at - redemption.received_at)
+    if redemption.outcome is not None:
+        _outcomes[redemption.outcome].inc()
+
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    """
+    Measure how late the event loop wakes up from sleeping (a busy or blocked loop wakes up late)
+    """
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.set(max(time.perf_counter() - started_at - interval, 0.0))
@@ -0,0 +1,176 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Callable, TypeVar
+
+T = TypeVar('T')
+
+
+@dataclass
+class OutboxEntry:
+    redemption_id: str
+    reward_id: str
+    fulfilled: bool
+    created_at: float
+    # Entries recorded by versions before multi-broadcaster support don't have one
+    broadcaster_id: Optional[str]
+    # Number of times sending the update failed so far
+    attempts: int = 0
+
+
+class StatusOutbox:
+    """
+    Durable journal of redemption status decisions, backed by SQLite in WAL mode. Decisions are appended before the
+    status is sent to Twitch and marked done once Twitch confirmed it, so pending updates survive crashes and outages.
+    Updates which cannot be sent (e.g. Twitch rejected them) are marked done as well, but flagged as failed.
+    The connection is only ever used from a single dedicated thread, so writes never block the event loop.
+    """
+    path: str
+
+    __connection: Optional[sqlite3.Connection] = None
+    __executor: ThreadPoolExecutor
+
+    def __init__(self, path: str) -> None:
+        """
+        @param path: Path of the SQLite database file
+        """
+        self.path = path
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+
+    async def __run(self, func: Callable[[], T]) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, func)
+
+    async def open(self) -> None:
+        await self.__run(self.__open)
+
+    def __open(self) -> None:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        # WAL with synchronous=NORMAL only syncs on checkpoints, which keeps appends cheap while still being durable
+        # across process crashes (only a power loss might lose the most recent entries)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS status_outbox ('
+            '  redemption_id TEXT PRIMARY KEY,'
+            '  reward_id TEXT NOT NULL,'
+            '  fulfilled INTEGER NOT NULL,'
+            '  created_at REAL NOT NULL,'
+            '  done INTEGER NOT NULL DEFAULT 0'
+            ')'
+        )
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(status_outbox)').fetchall()]
+        if 'broadcaster_id' not in columns:
+            connection.execute('ALTER TABLE status_outbox ADD COLUMN broadcaster_id TEXT')
+        if 'attempts' not in columns:
+            connection.execute('ALTER TABLE status_outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+        if 'failed' not in columns:
+            connection.execute('ALTER TABLE status_outbox ADD COLUMN failed INTEGER NOT NULL DEFAULT 0')
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS status_outbox_pending ON status_outbox (done, created_at)'
+        )
+        self.__connection = connection
+
+    async def close(self) -> None:
+        await self.__run(self.__close)
+        self.__executor.shutdown(wait=True)
+
+    def __close(self) -> None:
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    async def append(self, redemption_id: str, reward_id: str, fulfilled: bool, broadcaster_id: str) -> None:
+        """
+        Record a status decision as pending
+        """
+        def append() -> None:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO status_outbox '
+                '(redemption_id, reward_id, fulfilled, created_at, broadcaster_id, done, attempts, failed) '
+                'VALUES (?, ?, ?, ?, ?, 0, 0, 0)',
+                (redemption_id, reward_id, int(fulfilled), time.time(), broadcaster_id)
+            )
+
+        await self.__run(append)
+
+    async def complete(self, redemption_ids: List[str]) -> None:
+        """
+        Mark status decisions as done (=sent to Twitch)
+        """
+        def complete() -> None:
+            self.__connection.executemany(
+                'UPDATE status_outbox SET done = 1 WHERE redemption_id = ?',
+                [(redemption_id,) for redemption_id in redemption_ids]
+            )
+
+        await self.__run(complete)
+
+    async def fail(self, redemption_ids: List[str]) -> None:
+        """
+        Give up on sending status decisions, marking them as done but failed
+        """
+        def fail() -> None:
+            self.__connection.executemany(
+                'UPDATE status_outbox SET done = 1, failed = 1 WHERE redemption_id = ?',
+                [(redemption_id,) for redemption_id in redemption_ids]
+            )
+
+        await self.__run(fail)
+
+    async def record_attempts(self, redemption_ids: List[str]) -> None:
+        """
+        Count a failed attempt at sending status decisions, which stay pending
+        """
+        def record_attempts() -> None:
+            self.__connection.executemany(
+                'UPDATE status_outbox SET attempts = attempts + 1 WHERE redemption_id = ?',
+                [(redemption_id,) for redemption_id in redemption_ids]
+            )
+
+        await self.__run(record_attempts)
+
+    async def get_pending(
+            self,
+            limit: int,
+            broadcaster_id: str,
+            older_than: Optional[float] = None,
+            include_unassigned: bool = False
+    ) -> List[OutboxEntry]:
+        """
+        Get a broadcaster's pending status decisions, oldest first
+        @param limit: Maximum number of entries to return
+        @param broadcaster_id: Broadcaster to return entries of
+        @param older_than: Only return entries created before this (unix) time
+        @param include_unassigned: Also return entries not recorded with a broadcaster
+        """
+        def get_pending() -> List[OutboxEntry]:
+            rows = self.__connection.execute(
+                'SELECT redemption_id, reward_id, fulfilled, created_at, broadcaster_id, attempts FROM status_outbox '
+                'WHERE done = 0 AND (broadcaster_id = ? OR (? AND broadcaster_id IS NULL)) AND created_at < ? '
+                'ORDER BY created_at LIMIT ?',
+                (broadcaster_id, int(include_unassigned), older_than if older_than is not None else time.time(), limit)
+            ).fetchall()
+            return [
+                OutboxEntry(redemption_id=r[0], reward_id=r[1], fulfilled=bool(r[2]), created_at=r[3],
+                            broadcaster_id=r[4], attempts=r[5]) for r in rows
+            ]
+
+        return await self.__run(get_pending)
+
+    async def count_pending(self) -> int:
+        def count_pending() -> int:
+            return self.__connection.execute('SELECT COUNT(*) FROM status_outbox WHERE done = 0').fetchone()[0]
+
+        return await self.__run(count_pending)
+
+    async def compact(self) -> None:
+        """
+        Remove completed (including failed) entries and truncate the write-ahead log
+        """
+        def compact() -> None:
+            self.__connection.execute('DELETE FROM status_outbox WHERE done = 1')
+            self.__connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        await self.__run(compact)
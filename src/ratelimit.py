@@ -0,0 +1,118 @@
+import time
+from enum import Enum
+from typing import Callable, Dict, Optional, List, Tuple
+
+from classes import RateLimitConfig, RateLimitPolicy
+
+
+class TokenBucket:
+    rate: float
+    burst: int
+    clock: Callable[[], float]
+
+    __tokens: float
+    __updated_at: float
+
+    def __init__(self, rate: float, burst: int, clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        @param rate: Tokens added per second
+        @param burst: Maximum number of tokens (the bucket starts out full)
+        @param clock: Monotonic time source
+        """
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.__tokens = float(burst)
+        self.__updated_at = clock()
+
+    def __refill(self) -> None:
+        now = self.clock()
+        self.__tokens = min(float(self.burst), self.__tokens + (now - self.__updated_at) * self.rate)
+        self.__updated_at = now
+
+    def time_until_available(self) -> float:
+        """
+        @return: Seconds until a token is available (0 if one is available now)
+        """
+        self.__refill()
+        if self.__tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.__tokens) / self.rate
+
+    def consume(self) -> None:
+        """
+        Take a token, even if none is available yet (reserving the next one)
+        """
+        self.__refill()
+        self.__tokens -= 1.0
+
+
+class RateLimitDecision(str, Enum):
+    PROCEED = 'proceed'
+    # Proceed, but only once the limit allows it
+    QUEUE = 'queue'
+    COALESCE = 'coalesce'
+    REFUND = 'refund'
+
+
+class KeypressRateLimiter:
+    """
+    Applies per-reward and global token bucket limits to keypresses. Not thread-safe, meant to be used from the
+    (single) input thread only. Every broadcaster (channel) has their own limiter, so the global limit applies to
+    all keypresses of one broadcaster, not across broadcasters. Redemptions over the limit are handled according to
+    the applicable policy:
+    - coalesce: no keypress, redemption is treated as fulfilled (merged with the previous keypress)
+    - queue: reserve the next keypress the limit allows, if that is at most maxWait away, refund otherwise
+    - refund: no keypress, redemption is refunded
+    """
+    __limits: Dict[str, RateLimitConfig]
+    __buckets: Dict[str, TokenBucket]
+    __global_limit: Optional[RateLimitConfig]
+    __global_bucket: Optional[TokenBucket]
+
+    def __init__(
+            self,
+            reward_limits: Dict[str, RateLimitConfig],
+            global_limit: Optional[RateLimitConfig] = None,
+            clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        """
+        @param reward_limits: Map of reward id to rate limit
+        @param global_limit: Rate limit applied to all keypresses (of the broadcaster)
+        """
+        self.__limits = reward_limits
+        self.__buckets = {
+            reward_id: TokenBucket(limit.rate, limit.burst, clock) for (reward_id, limit) in reward_limits.items()
+        }
+        self.__global_limit = global_limit
+        self.__global_bucket = TokenBucket(global_limit.rate, global_limit.burst, clock) \
+            if global_limit is not None else None
+
+    def acquire(self, reward_id: str) -> Tuple[RateLimitDecision, float]:
+        """
+        Ask for permission to press a key for a redemption of the given reward (never blocks)
+        @return: Decision and seconds to wait before pressing the key (only non-zero if queued)
+        """
+        buckets: List[TokenBucket] = [
+            b for b in (self.__buckets.get(reward_id), self.__global_bucket) if b is not None
+        ]
+        if len(buckets) == 0:
+            return RateLimitDecision.PROCEED, 0.0
+
+        decision = RateLimitDecision.PROCEED
+        wait = max(b.time_until_available() for b in buckets)
+        if wait > 0.0:
+            # Reward specific policy takes precedence over the global one
+            limit = self.__limits.get(reward_id, self.__global_limit)
+            if limit.policy is RateLimitPolicy.COALESCE:
+                return RateLimitDecision.COALESCE, 0.0
+            elif limit.policy is RateLimitPolicy.QUEUE and wait <= limit.max_wait / 1000:
+                decision = RateLimitDecision.QUEUE
+            else:
+                return RateLimitDecision.REFUND, 0.0
+
+        # Tokens are taken right away even when queueing, so later redemptions queue up behind this one
+        for bucket in buckets:
+            bucket.consume()
+
+        return decision, wait
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Dict
+
+
+class RedemptionCache:
+    """
+    Bounded cache of recently seen redemption ids used to ignore redeliveries (e.g. after reconnecting)
+    Entries expire after a fixed time, so insertion order equals expiry order and eviction only ever has to
+    look at the oldest entries.
+    """
+    ttl: float
+    max_size: int
+    clock: Callable[[], float]
+
+    __entries: 'OrderedDict[str, float]'
+    __hits: int = 0
+    __evictions: int = 0
+
+    def __init__(self, ttl: float, max_size: int, clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        @param ttl: Seconds to remember a redemption id for
+        @param max_size: Maximum number of remembered ids (oldest ids are evicted early if exceeded)
+        @param clock: Monotonic time source
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.__entries = OrderedDict()
+
+    def check_and_add(self, redemption_id: str) -> bool:
+        """
+        Remember a redemption id
+        @return: Whether the id had already been seen (=the redemption is a duplicate)
+        """
+        now = self.clock()
+        self.__evict(now)
+
+        if redemption_id in self.__entries:
+            self.__hits += 1
+            return True
+
+        self.__entries[redemption_id] = now
+        if len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
+            self.__evictions += 1
+
+        return False
+
+    def __evict(self, now: float) -> None:
+        cutoff = now - self.ttl
+        while self.__entries:
+            # Peek at oldest entry
+            redemption_id, seen_at = next(iter(self.__entries.items()))
+            if seen_at > cutoff:
+                break
+            del self.__entries[redemption_id]
+            self.__evictions += 1
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self.__entries),
+            'hits': self.__hits,
+            'evictions': self.__evictions
+        }
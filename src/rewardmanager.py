@@ -1,55 +1,94 @@
-from typing import List, Optional, Any
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Any, Dict
 
-import requests
-from requests_oauthlib import OAuth2Session
+import aiohttp
 
 import config
-from classes import RewardConfig
+from classes import RewardConfig, CustomReward
+from helix import HelixClient, HelixError, RequestPriority
 from logger import logger
 
 
 class RewardManagerError(Exception):
-    pass
+    # HTTP status Twitch responded with, if the request failed due to an error response
+    status: Optional[int]
+
+    def __init__(self, message: str, status: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+    def is_retryable(self) -> bool:
+        """
+        Whether the request might succeed later, which is not the case for client errors other than an expired token,
+        a timeout or rate limiting (e.g. the redemption was already fulfilled/canceled or does not exist)
+        """
+        return self.status is None or self.status < 400 or self.status >= 500 or self.status in (401, 408, 429)
+
+
+@dataclass
+class RewardSetupResult:
+    modified: bool
+    reward_ids: List[str]
 
 
 class RewardManager:
     broadcaster_id: str
-    session: OAuth2Session
+    client: HelixClient
 
     def set_broadcaster_id(self, broadcaster_id: str) -> None:
         self.broadcaster_id = broadcaster_id
 
-    def set_session(self, session: OAuth2Session) -> None:
-        self.session = session
+    def set_client(self, client: HelixClient) -> None:
+        self.client = client
 
     def ensure_is_ready(self):
         if not hasattr(self, 'broadcaster_id') or not isinstance(self.broadcaster_id, str):
             raise RewardManagerError('Broadcaster is not set')
-        elif not hasattr(self, 'session') or not isinstance(self.session, OAuth2Session):
-            raise RewardManagerError('Session is not set')
+        elif not hasattr(self, 'client') or not isinstance(self.client, HelixClient) or not self.client.has_token():
+            raise RewardManagerError('Client is not set')
 
-    def get_rewards(self) -> List[dict]:
+    async def get_rewards(self) -> List[CustomReward]:
         self.ensure_is_ready()
 
+        rewards = []
+        cursor = None
         try:
-            resp = self.session.get('https://api.twitch.tv/helix/channel_points/custom_rewards',
-                                    params={
-                                        'broadcaster_id': self.broadcaster_id,
-                                        'only_manageable_rewards': 1
-                                    })
-            if resp.ok and self.is_valid_reward_list_response(parsed := resp.json()):
-                return parsed['data']
-            elif not resp.ok:
-                logger.debug(resp.text)
-                raise RewardManagerError(f'Failed to fetch existing rewards from Twitch '
-                                         f'(HTTP/{resp.status_code}/{resp.reason})')
-            else:
-                logger.debug(resp.text)
-                raise RewardManagerError('Twitch returned invalid response when fetching custom rewards')
-        except requests.RequestException as e:
+            # Follow pagination cursors until Twitch has returned all rewards
+            while True:
+                params = {
+                    'broadcaster_id': self.broadcaster_id,
+                    'only_manageable_rewards': 'true'
+                }
+                if cursor is not None:
+                    params['after'] = cursor
+                resp = await self.client.get('channel_points/custom_rewards', params=params)
+                if resp.ok and self.is_valid_reward_list_response(parsed := resp.json()):
+                    rewards.extend(CustomReward.from_dict(r) for r in parsed['data'])
+                elif not resp.ok:
+                    logger.debug(resp.text)
+                    raise RewardManagerError(f'Failed to fetch existing rewards from Twitch '
+                                             f'(HTTP/{resp.status}/{resp.reason})')
+                else:
+                    logger.debug(resp.text)
+                    raise RewardManagerError('Twitch returned invalid response when fetching custom rewards')
+
+                cursor = self.get_pagination_cursor(parsed)
+                if cursor is None or len(parsed['data']) == 0:
+                    return rewards
+        except (HelixError, ValueError) as e:
             logger.debug(e)
             raise RewardManagerError('Failed to fetch existing rewards from Twitch')
 
+    @staticmethod
+    def get_pagination_cursor(parsed_response: dict) -> Optional[str]:
+        pagination = parsed_response.get('pagination')
+        if isinstance(pagination, dict) and isinstance(pagination.get('cursor'), str) and pagination['cursor'] != '':
+            return pagination['cursor']
+
+        return None
+
     @staticmethod
     def is_valid_reward_list_response(parsed_response: Any) -> bool:
         if isinstance(parsed_response, dict) and isinstance(parsed_response.get('data'), list) and \
@@ -65,43 +104,60 @@ class RewardManager:
 
         return False
 
-    def setup_rewards(self, configured_rewards: List[RewardConfig]) -> bool:
+    async def setup_rewards(self, configured_rewards: List[RewardConfig]) -> RewardSetupResult:
+        """
+        Ensure all configured rewards exist on Twitch, using Twitch's data to update any existing rewards
+        @return: Whether any configured rewards were modified and the ids of all manageable rewards
+        """
         modified = False
-        existing_rewards = self.get_rewards()
+        existing_rewards = await self.get_rewards()
+        # Index existing rewards by id and title
+        # (reward titles must be unique, see https://dev.twitch.tv/docs/api/reference#create-custom-rewards)
+        existing_by_id = {r.id: r for r in existing_rewards}
+        existing_by_title = {r.title: r for r in existing_rewards}
+
+        missing_rewards = []
         for reward_config in configured_rewards:
-            # Find existing reward by id or title
-            # (reward titles must be unique, see https://dev.twitch.tv/docs/api/reference#create-custom-rewards)
-            existing_reward = next(
-                (r for r in existing_rewards if r['id'] == reward_config.id or r['title'] == reward_config.title)
-                , None
-            )
+            existing_reward = existing_by_id.get(reward_config.id) or existing_by_title.get(reward_config.title)
             if existing_reward is None:
                 # Any rewards without an id or with a non-existing id need to be created
-                reward_config.id = self.create_reward(reward_config)
-                modified = True
+                missing_rewards.append(reward_config)
             else:
                 # Use data from Twitch to update any existing rewards
-                if existing_reward['id'] != reward_config.id:
-                    reward_config.id = existing_reward['id']
+                if existing_reward.id != reward_config.id:
+                    reward_config.id = existing_reward.id
                     modified = True
 
-                if existing_reward['title'] != reward_config.title:
-                    reward_config.title = existing_reward['title']
+                if existing_reward.title != reward_config.title:
+                    reward_config.title = existing_reward.title
                     modified = True
 
-                if existing_reward['cost'] != reward_config.cost:
-                    reward_config.cost = existing_reward['cost']
+                if existing_reward.cost != reward_config.cost:
+                    reward_config.cost = existing_reward.cost
                     modified = True
 
+        if len(missing_rewards) > 0:
+            semaphore = asyncio.Semaphore(config.REWARD_SETUP_CONCURRENCY)
+
+            async def create(reward_config: RewardConfig) -> None:
+                async with semaphore:
+                    reward_config.id = await self.create_reward(reward_config)
+
+            await asyncio.gather(*[create(r) for r in missing_rewards])
+            modified = True
+
         logger.info(f'All {len(configured_rewards)} configured rewards are (now) setup on Twitch')
-        return modified
+        return RewardSetupResult(
+            modified=modified,
+            reward_ids=list(existing_by_id.keys()) + [r.id for r in missing_rewards]
+        )
 
-    def create_reward(self, reward_config: RewardConfig) -> Optional[str]:
+    async def create_reward(self, reward_config: RewardConfig) -> Optional[str]:
         self.ensure_is_ready()
 
         try:
-            resp = self.session.post(
-                'https://api.twitch.tv/helix/channel_points/custom_rewards',
+            resp = await self.client.post(
+                'channel_points/custom_rewards',
                 params={
                     'broadcaster_id': self.broadcaster_id
                 },
@@ -115,14 +171,74 @@ class RewardManager:
                 return parsed['data'][0]['id']
             elif not resp.ok:
                 logger.debug(resp.text)
-                raise RewardManagerError(f'Failed to create custom reward (HTTP/{resp.status_code}/{resp.reason})')
+                raise RewardManagerError(f'Failed to create custom reward (HTTP/{resp.status}/{resp.reason})')
             else:
                 logger.debug(resp.text)
                 raise RewardManagerError('Twitch returned invalid response when creating custom rewards')
-        except requests.RequestException as e:
+        except (HelixError, ValueError) as e:
             logger.debug(e)
             raise RewardManagerError('Failed to create custom reward')
 
+    async def update_reward(self, reward_config: RewardConfig) -> None:
+        self.ensure_is_ready()
+
+        try:
+            resp = await self.client.patch(
+                'channel_points/custom_rewards',
+                params={
+                    'broadcaster_id': self.broadcaster_id,
+                    'id': reward_config.id
+                },
+                json={
+                    'title': reward_config.title,
+                    'cost': reward_config.cost
+                }
+            )
+
+            if not resp.ok:
+                logger.debug(resp.text)
+                raise RewardManagerError(f'Failed to update custom reward (HTTP/{resp.status}/{resp.reason})')
+            elif not self.is_valid_create_reward_response(resp.json()):
+                logger.debug(resp.text)
+                raise RewardManagerError('Twitch returned invalid response when updating custom reward')
+        except (HelixError, ValueError) as e:
+            logger.debug(e)
+            raise RewardManagerError('Failed to update custom reward')
+
+    async def reconcile_rewards(self, previous_rewards: List[RewardConfig],
+                                configured_rewards: List[RewardConfig]) -> bool:
+        """
+        Apply changes between two versions of the configured rewards to Twitch, only touching rewards that changed
+        (rewards removed from the config are left alone)
+        @return: Whether any configured rewards were modified (e.g. ids were assigned)
+        """
+        previous_by_id = {r.id: r for r in previous_rewards if r.id is not None}
+        previous_by_title = {r.title: r for r in previous_rewards if r.id is not None}
+
+        modified = False
+        unmatched = []
+        for reward_config in configured_rewards:
+            previous = previous_by_id.get(reward_config.id) if reward_config.id is not None \
+                else previous_by_title.get(reward_config.title)
+            if previous is None:
+                unmatched.append(reward_config)
+                continue
+
+            if reward_config.id is None:
+                reward_config.id = previous.id
+                modified = True
+
+            if reward_config.title != previous.title or reward_config.cost != previous.cost:
+                await self.update_reward(reward_config)
+                logger.info(f'Updated reward on Twitch ({reward_config.title})')
+
+        # Rewards we did not know about before might exist on Twitch already, so run the regular setup for those
+        if len(unmatched) > 0:
+            result = await self.setup_rewards(unmatched)
+            modified = result.modified or modified
+
+        return modified
+
     @staticmethod
     def is_valid_create_reward_response(parsed_response: Any) -> bool:
         if RewardManager.is_valid_reward_list_response(parsed_response) and len(parsed_response) == 1:
@@ -130,47 +246,146 @@ class RewardManager:
 
         return False
 
-    def subscribe_to_redemptions(self) -> None:
-        reward_ids = [r['id'] for r in self.get_rewards()]
+    async def subscribe_to_redemptions(self, reward_ids: Optional[List[str]] = None) -> None:
+        """
+        @param reward_ids: Ids of all manageable rewards (will be fetched from Twitch if not given)
+        """
+        if reward_ids is None:
+            reward_ids = [r.id for r in await self.get_rewards()]
 
         if len(reward_ids) == 0:
             logger.warning('No manageable rewards found, aborting eventsub setup')
             return
 
         try:
-            resp = requests.post(f'{config.QWERTY_API_BASE_URL}/client/eventsub-setup', json={
+            # Use the shared session without Helix headers, the 0xQWERTY API must not receive the Twitch token
+            async with self.client.session.post(f'{config.QWERTY_API_BASE_URL}/client/eventsub-setup', json={
                 'broadcaster_id': self.broadcaster_id,
                 'reward_ids': reward_ids
-            })
-
-            if resp.ok:
-                logger.info(f'0xQWERTY API is (now) subscribed to redemptions of {len(reward_ids)} managed rewards')
-            else:
-                logger.debug(resp.text)
-                raise RewardManagerError(f'Failed to setup subscriptions for reward redemptions via 0xQWERTY API'
-                                         f'(HTTP/{resp.status_code}/{resp.reason})')
-        except requests.RequestException as e:
+            }) as resp:
+                if resp.ok:
+                    logger.info(f'0xQWERTY API is (now) subscribed to redemptions of {len(reward_ids)} managed rewards')
+                else:
+                    logger.debug(await resp.text())
+                    raise RewardManagerError(f'Failed to setup subscriptions for reward redemptions via 0xQWERTY API'
+                                             f'(HTTP/{resp.status}/{resp.reason})')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.debug(e)
             raise RewardManagerError('Failed to setup subscriptions for reward redemptions via 0xQWERTY API')
 
-    def update_redemption_status(self, redemption_id: str, reward_id: str, fulfilled: bool = True) -> None:
+    async def update_redemption_status(self, redemption_id: str, reward_id: str, fulfilled: bool = True) -> None:
+        outcomes = await self.update_redemption_statuses([redemption_id], reward_id, fulfilled)
+        if not outcomes.get(redemption_id):
+            raise RewardManagerError('Twitch did not update reward redemption status')
+
+    async def update_redemption_statuses(
+            self,
+            redemption_ids: List[str],
+            reward_id: str,
+            fulfilled: bool = True
+    ) -> Dict[str, bool]:
+        """
+        Update the status of up to 50 redemptions of the same reward with a single request
+        @return: Map of redemption id to whether Twitch confirmed the status update
+        """
         self.ensure_is_ready()
 
+        if len(redemption_ids) > 50:
+            raise RewardManagerError('Cannot update status of more than 50 redemptions at once')
+
+        status = 'FULFILLED' if fulfilled else 'CANCELED'
         try:
-            resp = self.session.patch(
-                'https://api.twitch.tv/helix/channel_points/custom_rewards/redemptions',
-                params={
-                    'id': redemption_id,
-                    'broadcaster_id': self.broadcaster_id,
-                    'reward_id': reward_id
-                },
+            resp = await self.client.patch(
+                'channel_points/custom_rewards/redemptions',
+                params=[
+                    *[('id', redemption_id) for redemption_id in redemption_ids],
+                    ('broadcaster_id', self.broadcaster_id),
+                    ('reward_id', reward_id)
+                ],
                 json={
-                    'status': 'FULFILLED' if fulfilled else 'CANCELED'
-                }
+                    'status': status
+                },
+                priority=RequestPriority.LOW
             )
-            if not resp.ok:
+            if resp.ok and self.is_valid_redemption_list_response(parsed := resp.json()):
+                updated = {r['id'] for r in parsed['data'] if r['status'] == status}
+                return {redemption_id: redemption_id in updated for redemption_id in redemption_ids}
+            elif not resp.ok:
+                logger.debug(resp.text)
                 raise RewardManagerError(f'Failed to update reward redemption status '
-                                         f'(HTTP/{resp.status_code}/{resp.reason})')
-        except requests.RequestException as e:
+                                         f'(HTTP/{resp.status}/{resp.reason})', resp.status)
+            else:
+                logger.debug(resp.text)
+                raise RewardManagerError('Twitch returned invalid response when updating reward redemption status')
+        except (HelixError, ValueError) as e:
             logger.debug(e)
             raise RewardManagerError('Failed to update reward redemption status')
+
+    async def get_unfulfilled_redemptions(self, reward_id: str, redeemed_after: float) -> List[dict]:
+        """
+        Fetch redemptions of a reward whose status was not set yet, newest first
+        @param redeemed_after: Only fetch redemptions redeemed after this (unix) time
+        @return: Redemptions in the format returned by Twitch
+        """
+        self.ensure_is_ready()
+
+        redemptions = []
+        cursor = None
+        try:
+            # Follow pagination cursors until reaching redemptions redeemed before the given time
+            while True:
+                params = {
+                    'broadcaster_id': self.broadcaster_id,
+                    'reward_id': reward_id,
+                    'status': 'UNFULFILLED',
+                    'sort': 'NEWEST',
+                    'first': '50'
+                }
+                if cursor is not None:
+                    params['after'] = cursor
+                resp = await self.client.get(
+                    'channel_points/custom_rewards/redemptions',
+                    params=params,
+                    priority=RequestPriority.LOW
+                )
+                if resp.ok and self.is_valid_redemption_list_response(parsed := resp.json()):
+                    page = [r for r in parsed['data'] if self.get_redeemed_at(r) > redeemed_after]
+                    redemptions.extend(page)
+                elif not resp.ok:
+                    logger.debug(resp.text)
+                    raise RewardManagerError(f'Failed to fetch unfulfilled reward redemptions from Twitch '
+                                             f'(HTTP/{resp.status}/{resp.reason})')
+                else:
+                    logger.debug(resp.text)
+                    raise RewardManagerError('Twitch returned invalid response when fetching reward redemptions')
+
+                cursor = self.get_pagination_cursor(parsed)
+                # Any redemption being left out means all following ones were redeemed even earlier
+                if cursor is None or len(page) < len(parsed['data']):
+                    return redemptions
+        except (HelixError, ValueError) as e:
+            logger.debug(e)
+            raise RewardManagerError('Failed to fetch unfulfilled reward redemptions from Twitch')
+
+    @staticmethod
+    def get_redeemed_at(redemption_dto: dict) -> float:
+        """
+        @return: Unix time the redemption was redeemed at
+        @raise ValueError: If the redemption does not contain a valid timestamp
+        """
+        return datetime.fromisoformat(redemption_dto.get('redeemed_at') or '').timestamp()
+
+    @staticmethod
+    def is_valid_redemption_list_response(parsed_response: Any) -> bool:
+        if isinstance(parsed_response, dict) and isinstance(parsed_response.get('data'), list) and \
+                all(RewardManager.is_valid_redemption_dto(elem) for elem in parsed_response['data']):
+            return True
+
+        return False
+
+    @staticmethod
+    def is_valid_redemption_dto(redemption_dto: Any) -> bool:
+        if isinstance(redemption_dto, dict) and all(key in redemption_dto for key in ['id', 'status']):
+            return True
+
+        return False
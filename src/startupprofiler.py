@@ -0,0 +1,59 @@
+import time
+from contextlib import contextmanager
+from typing import List, Tuple, Iterator, Optional, Awaitable, TypeVar
+
+T = TypeVar('T')
+
+# main.py imports this module before anything else, so this marks the start of importing all other modules
+IMPORTED_AT = time.perf_counter()
+
+
+class StartupProfiler:
+    """
+    Records how long each startup phase took. Phases may run concurrently, so each is recorded with when it started
+    (relative to the start of the profile) as well as its duration.
+    """
+    started_at: float
+    ready_at: Optional[float] = None
+
+    __phases: List[Tuple[str, float, float]]
+
+    def __init__(self, started_at: float = IMPORTED_AT) -> None:
+        self.started_at = started_at
+        self.__phases = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started_at, time.perf_counter())
+
+    async def measure(self, name: str, awaitable: Awaitable[T]) -> T:
+        with self.phase(name):
+            return await awaitable
+
+    def record(self, name: str, started_at: float, ended_at: float) -> None:
+        self.__phases.append((name, started_at, ended_at))
+
+    def mark_ready(self) -> bool:
+        """
+        Mark startup as completed
+        @return: Whether this was the first time startup was marked completed
+        """
+        if self.ready_at is not None:
+            return False
+        self.ready_at = time.perf_counter()
+        return True
+
+    def format(self) -> str:
+        lines = [
+            'Startup profile (seconds)',
+            f'  {"phase":<24} {"start":>8} {"duration":>9}'
+        ]
+        for name, started_at, ended_at in sorted(self.__phases, key=lambda p: p[1]):
+            lines.append(f'  {name:<24} {started_at - self.started_at:>8.3f} {ended_at - started_at:>9.3f}')
+        if self.ready_at is not None:
+            lines.append(f'  {"ready":<24} {self.ready_at - self.started_at:>8.3f}')
+        return '\n'.join(lines)
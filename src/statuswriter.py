@@ -0,0 +1,105 @@
+import asyncio
+from typing import Dict, List, Tuple, Optional, Set
+
+import config
+from logger import logger
+from rewardmanager import RewardManager, RewardManagerError
+
+BatchKey = Tuple[str, bool]
+PendingUpdate = Tuple[str, asyncio.Future]
+
+
+class RedemptionStatusWriter:
+    """
+    Coalesces redemption status updates into batched requests. Updates are grouped by reward and status and sent
+    once a batch is full or has been lingering for a short while, whichever comes first.
+    """
+    rm: RewardManager
+    max_batch_size: int
+    linger: float
+
+    __pending: Dict[BatchKey, List[PendingUpdate]]
+    __timers: Dict[BatchKey, asyncio.TimerHandle]
+    __flushes: Set[asyncio.Task]
+
+    __requests: int = 0
+    __updates: int = 0
+
+    def __init__(
+            self,
+            rm: RewardManager,
+            max_batch_size: int = config.STATUS_BATCH_SIZE,
+            linger: float = config.STATUS_BATCH_LINGER
+    ) -> None:
+        """
+        @param rm: Reward manager to send status updates through
+        @param max_batch_size: Maximum number of redemptions per request (Twitch accepts up to 50)
+        @param linger: Seconds to wait for more updates before sending an incomplete batch
+        """
+        self.rm = rm
+        self.max_batch_size = max_batch_size
+        self.linger = linger
+        self.__pending = {}
+        self.__timers = {}
+        self.__flushes = set()
+
+    async def submit(self, redemption_id: str, reward_id: str, fulfilled: bool) -> bool:
+        """
+        Queue a status update and wait for the batch containing it to be sent
+        @return: Whether Twitch confirmed the status update for this redemption
+        @raise RewardManagerError: If the batch request failed as a whole
+        """
+        future = asyncio.get_running_loop().create_future()
+        key = (reward_id, fulfilled)
+        batch = self.__pending.setdefault(key, [])
+        batch.append((redemption_id, future))
+
+        if len(batch) >= self.max_batch_size:
+            self.__flush(key)
+        elif key not in self.__timers:
+            self.__timers[key] = asyncio.get_running_loop().call_later(self.linger, self.__flush, key)
+
+        return await future
+
+    def __flush(self, key: BatchKey) -> None:
+        timer = self.__timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self.__pending.pop(key, None)
+        if not batch:
+            return
+
+        task = asyncio.create_task(self.__send(key, batch))
+        self.__flushes.add(task)
+        task.add_done_callback(self.__flushes.discard)
+
+    async def __send(self, key: BatchKey, batch: List[PendingUpdate]) -> None:
+        reward_id, fulfilled = key
+        self.__requests += 1
+        self.__updates += len(batch)
+        logger.debug('Updating status of %d redemptions of reward %s', len(batch), reward_id)
+        try:
+            outcomes = await self.rm.update_redemption_statuses([i for (i, _) in batch], reward_id, fulfilled)
+            for redemption_id, future in batch:
+                if not future.done():
+                    future.set_result(outcomes.get(redemption_id, False))
+        except RewardManagerError as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def close(self) -> None:
+        """
+        Send any pending updates and wait for all requests to complete
+        """
+        for key in list(self.__pending.keys()):
+            self.__flush(key)
+        await asyncio.gather(*self.__flushes, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Optional[float]]:
+        return {
+            'requests': self.__requests,
+            'updates': self.__updates,
+            'updatesPerRequest': self.__updates / self.__requests if self.__requests > 0 else None
+        }
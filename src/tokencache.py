@@ -0,0 +1,127 @@
+import ctypes
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional, Callable
+
+import config
+from logger import logger
+
+
+@dataclass
+class CachedToken:
+    access_token: str
+    expires_at: Optional[float]
+    broadcaster: dict
+
+    @staticmethod
+    def from_dict(as_dict: dict) -> 'CachedToken':
+        return CachedToken(
+            access_token=as_dict['accessToken'],
+            expires_at=as_dict.get('expiresAt'),
+            broadcaster=as_dict['broadcaster']
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'accessToken': self.access_token,
+            'expiresAt': self.expires_at,
+            'broadcaster': self.broadcaster
+        }
+
+    def is_expired(self, margin: float = 60.0) -> bool:
+        return self.expires_at is not None and self.expires_at - margin < time.time()
+
+
+class DataBlob(ctypes.Structure):
+    _fields_ = [('cbData', ctypes.c_uint32), ('pbData', ctypes.POINTER(ctypes.c_char))]
+
+
+# Fail rather than prompting the user, e.g. if the data was protected by another user
+CRYPTPROTECT_UI_FORBIDDEN = 0x01
+
+
+def call_dpapi(func: Callable, data: bytes) -> bytes:
+    """
+    Pass data through CryptProtectData or CryptUnprotectData (which share their signature)
+    @raise OSError: If the call failed
+    """
+    buffer = ctypes.create_string_buffer(data, len(data))
+    data_in = DataBlob(len(data), ctypes.cast(buffer, ctypes.POINTER(ctypes.c_char)))
+    data_out = DataBlob()
+    if not func(ctypes.byref(data_in), None, None, None, None, CRYPTPROTECT_UI_FORBIDDEN, ctypes.byref(data_out)):
+        raise ctypes.WinError()
+    try:
+        return ctypes.string_at(data_out.pbData, data_out.cbData)
+    finally:
+        ctypes.windll.kernel32.LocalFree(data_out.pbData)
+
+
+def protect(data: bytes) -> bytes:
+    """
+    Encrypt data for the current user via DPAPI on Windows, where file permissions don't keep other users out
+    (elsewhere data is returned as is and only protected by the cache's file permissions)
+    """
+    if sys.platform != 'win32':
+        return data
+    return call_dpapi(ctypes.windll.crypt32.CryptProtectData, data)
+
+
+def unprotect(data: bytes) -> bytes:
+    # Caches written before tokens were protected (or on other platforms) are plain JSON
+    if sys.platform != 'win32' or data.lstrip().startswith(b'{'):
+        return data
+    return call_dpapi(ctypes.windll.crypt32.CryptUnprotectData, data)
+
+
+def get_token_cache_path(login: Optional[str] = None) -> str:
+    """
+    Get the path of a broadcaster's token cache (a single cache is used unless running in multi-broadcaster mode)
+    """
+    if login is None:
+        return config.TOKEN_CACHE_PATH
+    root, ext = os.path.splitext(config.TOKEN_CACHE_PATH)
+    return f'{root}.{login}{ext}'
+
+
+def load_token_cache(path: str) -> Optional[CachedToken]:
+    """
+    Read a token cache (blocking, so call it off the event loop)
+    """
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, 'rb') as f:
+            return CachedToken.from_dict(json.loads(unprotect(f.read())))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f'Failed to load cached Twitch token, ignoring it: {e}')
+        return None
+
+
+def save_token_cache(path: str, token: CachedToken) -> None:
+    """
+    Write token cache readable by the current user only, encrypted via DPAPI on Windows and restricted by file
+    permissions elsewhere (written to a temporary file first, so a crash never leaves a partially written cache behind).
+    Blocking, so call it off the event loop.
+    """
+    temp_path = f'{path}.tmp'
+    try:
+        data = protect(json.dumps(token.to_dict()).encode('utf-8'))
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.error(f'Failed to write Twitch token cache: {e}')
+
+
+def clear_token_cache(path: str) -> None:
+    try:
+        if os.path.isfile(path):
+            os.remove(path)
+    except OSError as e:
+        logger.error(f'Failed to remove Twitch token cache: {e}')
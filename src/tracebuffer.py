@@ -0,0 +1,160 @@
+import time
+from dataclasses import dataclass
+from typing import Optional, List, Dict
+
+from classes import Redemption, RedemptionOutcome
+
+
+@dataclass
+class RedemptionTrace:
+    """
+    What happened to a redemption, from receiving it to its status being settled on Twitch
+    """
+    redemption_id: str
+    reward_id: str
+    broadcaster_id: str
+    user_login: Optional[str]
+    # Unix time the redemption was received at
+    received_at: float
+    window_title: Optional[str]
+    game: Optional[str]
+    action: Optional[dict]
+    rate_limit: Optional[str]
+    outcome: Optional[RedemptionOutcome]
+    # Milliseconds spent per stage
+    timings: Dict[str, Optional[float]]
+    # Status requested from Twitch (None if the status was left as is)
+    status: Optional[str] = None
+    # Whether Twitch confirmed the status update (None if it is still pending or was not requested)
+    status_updated: Optional[bool] = None
+    status_error: Optional[str] = None
+    # Number of times the status update was resent from the outbox
+    status_retries: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            'redemptionId': self.redemption_id,
+            'rewardId': self.reward_id,
+            'broadcasterId': self.broadcaster_id,
+            'userLogin': self.user_login,
+            'receivedAt': self.received_at,
+            'windowTitle': self.window_title,
+            'game': self.game,
+            'action': self.action,
+            'rateLimit': self.rate_limit,
+            'outcome': self.outcome.value if self.outcome is not None else None,
+            'timings': self.timings,
+            'status': self.status,
+            'statusUpdated': self.status_updated,
+            'statusError': self.status_error,
+            'statusRetries': self.status_retries
+        }
+
+
+def to_milliseconds(started_at: Optional[float], ended_at: Optional[float]) -> Optional[float]:
+    if started_at is None or ended_at is None:
+        return None
+    return round((ended_at - started_at) * 1000, 3)
+
+
+class TraceBuffer:
+    """
+    Keeps traces of the most recent redemptions in a ring buffer of fixed size, overwriting the oldest trace once
+    full. Memory use is bounded by the capacity, no matter how many redemptions are handled. Not thread-safe, meant
+    to be used from the event loop.
+    """
+    capacity: int
+
+    __slots: List[Optional[RedemptionTrace]]
+    # Redemption id -> slot, for updating traces of redemptions whose status is resent later
+    __index: Dict[str, int]
+    __next: int = 0
+
+    def __init__(self, capacity: int) -> None:
+        """
+        @param capacity: Number of traces to keep
+        """
+        self.capacity = capacity
+        self.__slots = [None] * capacity
+        self.__index = {}
+
+    def add(
+            self,
+            redemption: Redemption,
+            status: Optional[str],
+            status_updated: Optional[bool],
+            status_error: Optional[str],
+            status_started_at: Optional[float],
+            settled_at: float
+    ) -> None:
+        """
+        Record the trace of a settled redemption (timestamps are time.perf_counter() values)
+        """
+        replaced = self.__slots[self.__next]
+        if replaced is not None and self.__index.get(replaced.redemption_id) == self.__next:
+            del self.__index[replaced.redemption_id]
+
+        action = redemption.action
+        self.__slots[self.__next] = RedemptionTrace(
+            redemption_id=redemption.id,
+            reward_id=redemption.reward_id,
+            broadcaster_id=redemption.broadcaster_id,
+            user_login=redemption.data.get('user_login'),
+            received_at=time.time() - (time.perf_counter() - redemption.received_at),
+            window_title=redemption.window_title,
+            game=redemption.game,
+            action={'type': action.type.value, 'value': action.value} if action is not None else None,
+            rate_limit=redemption.rate_limit,
+            outcome=redemption.outcome,
+            timings={
+                'queue': to_milliseconds(redemption.received_at, redemption.dequeued_at),
+                'detection': to_milliseconds(redemption.dequeued_at, redemption.detected_at),
+                'keypress': to_milliseconds(redemption.detected_at, redemption.pressed_at),
+                'status': to_milliseconds(status_started_at, settled_at),
+                'total': to_milliseconds(redemption.received_at, settled_at)
+            },
+            status=status,
+            status_updated=status_updated,
+            status_error=status_error
+        )
+        self.__index[redemption.id] = self.__next
+        self.__next = (self.__next + 1) % self.capacity
+
+    def record_retry(self, redemption_id: str, updated: Optional[bool], error: Optional[str] = None) -> None:
+        """
+        Record the result of resending a redemption's status update (ignored if the trace was overwritten already)
+        @param updated: Whether Twitch confirmed the update, None if it could not be sent
+        """
+        slot = self.__index.get(redemption_id)
+        if slot is None:
+            return
+
+        trace = self.__slots[slot]
+        trace.status_retries += 1
+        trace.status_updated = updated
+        trace.status_error = error
+
+    def get_recent(
+            self,
+            limit: int,
+            reward_id: Optional[str] = None,
+            outcome: Optional[RedemptionOutcome] = None
+    ) -> List[RedemptionTrace]:
+        """
+        Get the most recent traces, newest first
+        @param limit: Maximum number of traces to return
+        @param reward_id: Only return traces of this reward
+        @param outcome: Only return traces with this outcome
+        """
+        traces = []
+        for i in range(1, self.capacity + 1):
+            trace = self.__slots[(self.__next - i) % self.capacity]
+            if trace is None or len(traces) >= limit:
+                break
+            if (reward_id is None or trace.reward_id == reward_id) and (outcome is None or trace.outcome is outcome):
+                traces.append(trace)
+
+        return traces
+
+    def __len__(self) -> int:
+        return len(self.__index)
@@ -1,76 +1,188 @@
+import functools
+import hashlib
 import json
 import os
-import signal
 import sys
 import time
+from typing import Optional
 
 import yaml
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
+from jsonschema.protocols import Validator
+from jsonschema.validators import validator_for
 
 import config
-from classes import ClientConfig, YamlDumper
+from classes import ClientConfig
 from logger import logger
 
+# Parsing with libyaml is much faster, fall back to the pure Python loader where it is not available
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-def sleep_exit(exit_code: int, seconds: float = 15.0):
-    logger.info(f'Window will close in {seconds} seconds...')
-    time.sleep(seconds)
-    sys.exit(exit_code)
 
-
-def sleep_sigterm(seconds: float = 15.0):
+class ClientConfigError(Exception):
     """
-    Sleeps for `seconds` and then sends SIGTERM to itself
-    (which is the easiest way of somewhat cleanly exiting once uvicorn is running)
+    Raised if the client config (or the schema to validate it against) cannot be loaded
     """
+    pass
+
+
+def sleep_exit(exit_code: int, seconds: float = 15.0):
     logger.info(f'Window will close in {seconds} seconds...')
     time.sleep(seconds)
-    os.kill(os.getpid(), signal.SIGTERM)
+    sys.exit(exit_code)
 
 
 def load_logging_config() -> dict:
     logging_config_path = os.path.join(config.ROOT_DIR, 'logging.yaml')
     try:
         with open(logging_config_path, 'r') as f:
-            return yaml.safe_load(f)
+            return yaml.load(f, Loader=SafeLoader)
     except (OSError, yaml.YAMLError) as e:
         logger.critical(f'Failed to load logging config from {logging_config_path}: {e}')
         sleep_exit(1)
 
 
-def load_client_config() -> ClientConfig:
+def get_client_config_path() -> str:
+    return os.path.join(config.PWD, 'config.yaml')
+
+
+@functools.lru_cache(maxsize=1)
+def read_config_schema() -> str:
+    """
+    @raise ClientConfigError: If the schema cannot be read
+    """
     schema_path = os.path.join(config.ROOT_DIR, 'config.schema.json')
     try:
         with open(schema_path, 'r') as s:
-            schema = json.load(s)
-    except (OSError, json.JSONDecodeError) as e:
-        logger.critical(f'Failed to load config JSON schema from {schema_path}: {e}')
-        sleep_exit(1)
+            return s.read()
+    except OSError as e:
+        raise ClientConfigError(f'Failed to load config JSON schema from {schema_path}: {e}') from e
 
-    client_config_path = os.path.join(config.PWD, 'config.yaml')
+
+@functools.lru_cache(maxsize=1)
+def load_config_schema() -> dict:
+    """
+    @raise ClientConfigError: If the schema cannot be read or is not valid JSON
+    """
+    try:
+        return json.loads(read_config_schema())
+    except json.JSONDecodeError as e:
+        raise ClientConfigError(f'Failed to load config JSON schema: {e}') from e
+
+
+@functools.lru_cache(maxsize=1)
+def get_config_validator() -> Validator:
+    """
+    Get a validator for the config schema, checking the schema itself only once
+    (rather than on every validation, as jsonschema.validate does)
+    """
+    schema = load_config_schema()
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def validate_client_config(client_config: dict) -> None:
+    """
+    @raise ValidationError: If the client config does not match the schema
+    """
+    # Report the most relevant error, same as jsonschema.validate
+    error = best_match(get_config_validator().iter_errors(client_config))
+    if error is not None:
+        raise error
+
+
+def parse_client_config(content: str) -> ClientConfig:
+    """
+    Parse and validate client config
+    @param content: Client config as YAML
+    @raise yaml.YAMLError: If the content is not valid YAML
+    @raise ValidationError: If the client config does not match the schema
+    @raise ValueError: If the client config contains invalid values
+    """
+    client_config = yaml.load(content, Loader=SafeLoader)
+    validate_client_config(client_config)
+    return ClientConfig.from_dict(client_config)
+
+
+def hash_content(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def load_config_cache(config_hash: str, schema_hash: str) -> Optional[dict]:
+    """
+    Get the cached client config, if it was cached for the same config and schema
+    @return: Validated client config as dict or None, if there is no matching cached config
+    """
+    try:
+        with open(config.CONFIG_CACHE_PATH, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(cached, dict) or cached.get('version') != config.CONFIG_CACHE_VERSION or \
+            cached.get('configHash') != config_hash or cached.get('schemaHash') != schema_hash or \
+            not isinstance(cached.get('config'), dict):
+        return None
+
+    return cached['config']
+
+
+def save_config_cache(config_hash: str, schema_hash: str, client_config: ClientConfig) -> None:
+    # Write to a temporary file first, so a crash cannot leave a partially written cache behind
+    temp_path = f'{config.CONFIG_CACHE_PATH}.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'version': config.CONFIG_CACHE_VERSION,
+                'configHash': config_hash,
+                'schemaHash': schema_hash,
+                'config': client_config.to_dict()
+            }, f)
+        os.replace(temp_path, config.CONFIG_CACHE_PATH)
+    except (OSError, TypeError, ValueError) as e:
+        # The cache only speeds up startup, so just go without
+        logger.warning(f'Failed to write client config cache: {e}')
+
+
+def load_client_config() -> ClientConfig:
+    """
+    Load the client config, skipping parsing and validation if it is unchanged since it was last loaded
+    @raise ClientConfigError: If the client config cannot be loaded or is invalid
+    """
+    client_config_path = get_client_config_path()
     try:
         with open(client_config_path, 'r') as c:
-            client_config = yaml.safe_load(c)
-    except (OSError, yaml.YAMLError) as e:
-        logger.critical(f'Failed to load client config from {client_config_path}: {e}')
-        sleep_exit(1)
+            content = c.read()
+    except OSError as e:
+        raise ClientConfigError(f'Failed to load client config from {client_config_path}: {e}') from e
+
+    config_hash, schema_hash = hash_content(content), hash_content(read_config_schema())
+    cached = load_config_cache(config_hash, schema_hash)
+    if cached is not None:
+        try:
+            return ClientConfig.from_dict(cached)
+        except Exception as e:
+            logger.debug(f'Ignoring invalid client config cache: {e}')
+
+    try:
+        client_config = yaml.load(content, Loader=SafeLoader)
+    except yaml.YAMLError as e:
+        raise ClientConfigError(f'Failed to load client config from {client_config_path}: {e}') from e
 
     # Ensure actual client config matches schema
     try:
-        validate(client_config, schema)
+        validate_client_config(client_config)
     except ValidationError as e:
-        logger.critical(f'Client config does not match schema: {e.json_path}: {e.message}')
-        sleep_exit(1)
-
-    return ClientConfig.from_dict(client_config)
+        raise ClientConfigError(f'Client config does not match schema: {e.json_path}: {e.message}') from e
 
-
-def dump_client_config(client_config: ClientConfig) -> None:
-    client_config_path = os.path.join(config.PWD, 'config.yaml')
     try:
-        with open(client_config_path, 'w') as c:
-            yaml.dump(client_config.to_dict(), c, sort_keys=False, Dumper=YamlDumper, default_flow_style=False)
-    except (OSError, yaml.YAMLError) as e:
-        logger.error(f'Failed to write client config: {e}')
+        parsed = ClientConfig.from_dict(client_config)
+    except ValueError as e:
+        raise ClientConfigError(f'Client config contains invalid values: {e}') from e
+
+    save_config_cache(config_hash, schema_hash, parsed)
+    return parsed
 
 
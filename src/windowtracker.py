@@ -0,0 +1,87 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from gamedetector import GameDetector
+from logger import logger
+
+
+@dataclass(frozen=True)
+class WindowSnapshot:
+    title: str
+    game: Optional[str]
+    observed_at: float
+
+
+class ForegroundWindowTracker:
+    """
+    Polls the foreground window on a background thread, so redemptions can read the active game
+    from the latest snapshot instead of querying the OS themselves
+    """
+    detector: GameDetector
+    interval: float
+    max_staleness: float
+
+    __snapshot: Optional[WindowSnapshot] = None
+    __stop_event: threading.Event
+    __thread: Optional[threading.Thread] = None
+
+    def __init__(self, detector: GameDetector, interval: float = 0.25, max_staleness: float = 1.0) -> None:
+        """
+        @param detector: Detector used to get the foreground window title and match it to a game
+        @param interval: Seconds between polls
+        @param max_staleness: Maximum age of a snapshot in seconds before the window is queried directly instead
+        """
+        self.detector = detector
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.__stop_event = threading.Event()
+
+    def start(self) -> None:
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__run, name='window-tracker', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self) -> None:
+        while not self.__stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f'Failed to determine foreground window: {e}')
+            self.__stop_event.wait(self.interval)
+
+    def poll(self) -> WindowSnapshot:
+        """
+        Query the foreground window and publish the result as the current snapshot
+        """
+        title = self.detector.get_active_window_title()
+        snapshot = WindowSnapshot(title=title, game=self.detector.match_game(title), observed_at=time.monotonic())
+        # Snapshots are immutable and replaced with a single assignment, so readers always see a consistent one
+        self.__snapshot = snapshot
+        return snapshot
+
+    def get_snapshot(self) -> Optional[WindowSnapshot]:
+        return self.__snapshot
+
+    def get_current_snapshot(self) -> WindowSnapshot:
+        """
+        Get the current snapshot (or a fresh one, if the current one is stale)
+        """
+        snapshot = self.__snapshot
+        if snapshot is None or time.monotonic() - snapshot.observed_at > self.max_staleness:
+            snapshot = self.poll()
+
+        return snapshot
+
+    def get_active_game(self) -> Optional[str]:
+        """
+        Determine which game is active based on the current snapshot (or a fresh poll, if the snapshot is stale)
+        """
+        return self.get_current_snapshot().game